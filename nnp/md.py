@@ -6,57 +6,1364 @@ The module ``nnp.md`` provide tools to run molecular dynamics with a potential
 defined by PyTorch.
 """
 
+import os
+import json
+import time
+import queue
+import threading
+import itertools
+import multiprocessing
+import multiprocessing.connection
 import torch
+import torch.distributed
 from torch import Tensor
 from nnp import pbc
-from typing import Callable, Sequence
+from nnp.profiling import Profiler
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+import numpy as np
+import ase
+import ase.units
 import ase.calculators.calculator
+from ase.calculators.singlepoint import SinglePointCalculator
 
 
+###############################################################################
+# Forces and stress are derivatives of the same energy, so they should be
+# computed together from a single backward pass. Stress is computed with the
+# strain trick: both coordinates and cell are multiplied by a ``scaling``
+# matrix that equals identity, and the derivative of energy with respect to it
+# is the stress times volume.
+#
+# This derivative also splits into a per-atom part, the outer product of the
+# coordinates and the gradient of each atom, and a part coming from the
+# explicit dependence of the energy on the cell. Per-atom virials are the
+# per-atom parts, plus an equal share of the cell part, so that they sum to the
+# total. They are only well defined up to such a choice.
+class Derivatives(NamedTuple):
+    forces: Tensor
+    virial: Optional[Tensor]
+    atomic_virials: Optional[Tensor]
+
+
+def derivatives(energies: Tensor, coordinates: Tensor, scaling: Optional[Tensor] = None,
+                atomic_virials: bool = False) -> Derivatives:
+    """Compute forces and virials from one backward pass.
+
+    Arguments:
+        energies: energies computed from ``coordinates @ scaling``. Any shape is
+            allowed, for example scalar, per-molecule or per-atom energies, the
+            derivatives are computed for their sum.
+        coordinates: Tensor of shape ``(atoms, 3)`` or ``(molecules, atoms, 3)``
+            that requires grad.
+        scaling: optional identity matrix of shape ``(3, 3)`` or ``(molecules, 3, 3)``
+            that requires grad, by which both coordinates and cell are multiplied.
+        atomic_virials: whether to compute per-atom virials. Requires ``scaling``.
+
+    Returns:
+        A namedtuple ``(forces, virial, atomic_virials)`` where ``virial`` is the
+        derivative of energy with respect to ``scaling``, of shape ``(3, 3)`` or
+        ``(molecules, 3, 3)``, that is stress times volume, and ``atomic_virials``
+        has shape ``(atoms, 3, 3)`` or ``(molecules, atoms, 3, 3)``. They are
+        ``None`` if not requested.
+    """
+    inputs = [coordinates]
+    if scaling is not None:
+        inputs.append(scaling)
+    grads = torch.autograd.grad([energies.sum()], inputs)
+    gradient = grads[0]
+    assert gradient is not None
+    virial: Optional[Tensor] = None
+    atomic: Optional[Tensor] = None
+    if scaling is not None:
+        virial = grads[1]
+        assert virial is not None
+        if atomic_virials:
+            atomic = coordinates.detach().unsqueeze(-1) * gradient.unsqueeze(-2)
+            remainder = virial - atomic.sum(-3)
+            atomic = atomic + remainder.unsqueeze(-3) / coordinates.shape[-2]
+    return Derivatives(-gradient, virial, atomic)
+
+
+###############################################################################
+# The potential does not have to run in double precision. Single precision is
+# usually accurate enough for a neural network, and is much faster and uses
+# half of the memory. But rounding errors of single precision would be too
+# large for other parts of the calculation: wrapping coordinates into the
+# central box subtracts large numbers, and the sum of many atomic energies or
+# the sum over many pairs of the virial lose digits. So :class:`Calculator`
+# keeps coordinates, cell, wrapping and the strain in double precision, only
+# converts them to ``dtype`` when calling ``func``, and converts the energies
+# back to double before summing. Autograd converts the gradients back to
+# double as well, so the virial, which sums over all atoms, is accumulated in
+# double precision.
 class Calculator(ase.calculators.calculator.Calculator):
     """ASE Calculator that wraps a neural network potential
 
     Arguments:
-        func (callable): A fucntion that .
+        func (callable): A function that takes chemical symbols, coordinates,
+            cell and pbc and returns the energy, either as a scalar or as
+            per-atom energies of shape ``(atoms,)``. Per-atom energies are
+            available as the ``energies`` property.
         overwrite (bool): After wrapping atoms into central box, whether
             to replace the original positions stored in :class:`ase.Atoms`
             object with the wrapped positions.
+        neighborlist (:class:`nnp.pbc.VerletList`): If specified, this neighbor
+            list is kept across calls and ``func`` is called with an extra
+            argument ``neighbors``, which is a :class:`nnp.pbc.PairList` of
+            pairs within ``cutoff + skin``.
+        dtype (torch.dtype): the dtype of the tensors that ``func`` is called
+            with, see below.
+        profiler (:class:`nnp.profiling.Profiler`): optional profiler to record
+            the phases of calculations. A disabled profiler is created if not
+            specified, available as attribute ``profiler``.
     """
 
-    implemented_properties = ['energy', 'forces', 'stress', 'free_energy']
+    implemented_properties = ['energy', 'energies', 'forces', 'stress', 'stresses', 'free_energy']
+    _derivative_properties = ['forces', 'stress', 'stresses']
 
-    def __init__(self, func: Callable[[Sequence[str], Tensor, Tensor, Tensor], Tensor],
-                 overwrite: bool = False):
+    def __init__(self, func: Callable[..., Tensor], overwrite: bool = False,
+                 neighborlist: Optional[pbc.VerletList] = None, dtype: torch.dtype = torch.double,
+                 profiler: Optional[Profiler] = None):
         super(Calculator, self).__init__()
         self.func = func
+        self.dtype = dtype
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
         self.overwrite = overwrite
+        self.neighborlist = neighborlist
+        self._symbols: Optional[List[str]] = None
+        self._cell: Optional[Tensor] = None
+        self._inv_cell: Optional[Tensor] = None
+        self._pbc: Optional[Tensor] = None
+        self._pbc_enabled = False
+
+    # Chemical symbols, cell and pbc rarely change during a simulation, so we
+    # keep their tensors and only update them when ASE tells us that they have
+    # changed.
+    def _update_cache(self, system_changes):
+        if self._symbols is None or 'numbers' in system_changes:
+            self._symbols = self.atoms.get_chemical_symbols()
+            self.profiler.count('symbols_updates')
+        if self._cell is None or 'cell' in system_changes:
+            self._cell = torch.tensor(self.atoms.get_cell(complete=True).array, dtype=torch.double)
+            self._inv_cell = torch.inverse(self._cell)
+            self.profiler.count('cell_updates')
+        if self._pbc is None or 'pbc' in system_changes:
+            self._pbc = torch.tensor(self.atoms.get_pbc(), dtype=torch.bool)
+            self._pbc_enabled = bool(self._pbc.any().item())
+            self.profiler.count('pbc_updates')
+
+    # Properties already computed for unchanged atoms are returned by ASE
+    # without calling calculate, so requests that neither calculated nor hit
+    # the cache in calculate are also counted as cache hits.
+    def get_property(self, name, atoms=None, allow_calculation=True):
+        profiler = self.profiler
+        profiler.count('requests')
+        calls = profiler.counters.get('calculations', 0) + profiler.counters.get('cache_hits', 0)
+        result = super(Calculator, self).get_property(name, atoms, allow_calculation)
+        if profiler.counters.get('calculations', 0) + profiler.counters.get('cache_hits', 0) == calls:
+            profiler.count('cache_hits')
+        return result
 
     def calculate(self, atoms=None, properties=['energy'],
                   system_changes=ase.calculators.calculator.all_changes):
+        if not system_changes and all(p in self.results for p in properties):
+            self.profiler.count('cache_hits')
+            return
+        self.profiler.count('calculations')
         super(Calculator, self).calculate(atoms, properties, system_changes)
-        coordinates = torch.from_numpy(self.atoms.get_positions()).requires_grad_('forces' in properties)
-        cell = coordinates.new_tensor(self.atoms.get_cell(complete=True).array)
-        pbc_ = torch.tensor(self.atoms.get_pbc(), dtype=torch.bool)
-        pbc_enabled = pbc_.any().item()
+        self._update_cache(system_changes)
+        # When no derivatives are needed, there is no need to build the graph.
+        # Verlet lists keep tensors across calls, which must not be inference
+        # tensors, so in that case we just disable gradients.
+        if any(p in self._derivative_properties for p in properties):
+            self._calculate(properties)
+        elif self.neighborlist is not None:
+            with torch.no_grad():
+                self._calculate(properties)
+        else:
+            with torch.inference_mode():
+                self._calculate(properties)
+
+    def _calculate(self, properties):
+        energies, coordinates, scaling = self._forward(properties)
+        self._store(properties, energies, coordinates, scaling)
 
-        if pbc_enabled:
+    def _forward(self, properties) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        # convert, wrap and call the potential, returns energies, the
+        # coordinates to differentiate with, and the scaling for stress
+        assert self._cell is not None and self._pbc is not None
+        need_stress = 'stress' in properties or 'stresses' in properties
+        need_derivatives = any(p in self._derivative_properties for p in properties)
+        profiler = self.profiler
+        with profiler.phase('to_tensor'):
+            coordinates = torch.from_numpy(self.atoms.get_positions())
+        cell = self._cell
+        pbc_ = self._pbc
+
+        # Wrapping only translates atoms by lattice vectors, so we can just
+        # differentiate with respect to the wrapped coordinates.
+        if self._pbc_enabled:
+            with profiler.phase('wrap'):
+                coordinates = pbc.map2central(cell, coordinates, pbc_, self._inv_cell)
+        coordinates.requires_grad_(need_derivatives)
+        scaled_coordinates = coordinates
+
+        scaling: Optional[Tensor] = None
+        if need_stress:
+            scaling = torch.eye(3, dtype=cell.dtype, requires_grad=True)
+            scaled_coordinates = coordinates @ scaling
+            cell = cell @ scaling
+        scaled_coordinates = scaled_coordinates.to(self.dtype)
+        cell = cell.to(self.dtype)
+
+        if self.neighborlist is not None:
+            with profiler.phase('neighborlist'):
+                neighbors = self.neighborlist(cell, scaled_coordinates, pbc_)
+            with profiler.phase('forward'):
+                energies = self.func(self._symbols, scaled_coordinates, cell, pbc_, neighbors)
+        else:
+            with profiler.phase('forward'):
+                energies = self.func(self._symbols, scaled_coordinates, cell, pbc_)
+        energies = energies.double()
+        if profiler.enabled:
+            profiler.outputs('to_tensor', coordinates)
+            profiler.outputs('forward', energies)
+            profiler.graph('forward', energies)
+        return energies, coordinates, scaling
+
+    def _store(self, properties, energies: Tensor, coordinates: Tensor, scaling: Optional[Tensor]):
+        need_derivatives = any(p in self._derivative_properties for p in properties)
+        profiler = self.profiler
+        with profiler.phase('to_numpy'):
+            self.results['energy'] = self.results['free_energy'] = energies.sum().item()
+            if energies.dim() > 0:
+                self.results['energies'] = energies.detach().cpu().numpy()
+
+        if need_derivatives:
+            with profiler.phase('backward'):
+                forces, virial, atomic_virials = derivatives(energies, coordinates, scaling,
+                                                             'stresses' in properties)
+            profiler.outputs('backward', forces)
+            with profiler.phase('to_numpy'):
+                self.results['forces'] = forces.cpu().numpy()
+                if virial is not None:
+                    volume = self.atoms.get_volume()
+                    self.results['stress'] = (virial / volume).cpu().numpy()
+                if atomic_virials is not None:
+                    self.results['stresses'] = (atomic_virials / volume).cpu().numpy()
+
+
+###############################################################################
+# Committees
+# ----------
+#
+# The spread of the predictions of a committee of models, trained from
+# different initializations or on different subsets of data, estimates the
+# uncertainty of the prediction, for example to select structures for active
+# learning. Running each member with its own :class:`Calculator` repeats the
+# conversion, the wrapping and the neighbor search for each member, and calls
+# backward once for each member. Instead, :class:`EnsembleCalculator` calls a
+# ``func`` that evaluates all members together, for example as one stacked
+# model sharing the same neighbor list, and returns energies with a leading
+# ``members`` dimension. The forces of all members are then computed from one
+# backward pass batched over members, with ``is_grads_batched``.
+def member_derivatives(energies: Tensor, coordinates: Tensor, scaling: Optional[Tensor] = None) -> Derivatives:
+    """Compute forces and virials of each member of a committee from one batched backward pass.
+
+    Arguments:
+        energies: energies of shape ``(members,)`` or ``(members, atoms)``
+            computed from ``coordinates @ scaling``.
+        coordinates: Tensor of shape ``(atoms, 3)`` that requires grad.
+        scaling: optional identity matrix of shape ``(3, 3)`` that requires grad,
+            see :func:`derivatives`.
+
+    Returns:
+        A namedtuple ``(forces, virial, atomic_virials)`` where ``forces`` has
+        shape ``(members, atoms, 3)``, ``virial`` has shape ``(members, 3, 3)``
+        or is ``None``, and ``atomic_virials`` is always ``None``.
+    """
+    totals = energies.reshape(energies.shape[0], -1).sum(-1)
+    inputs = [coordinates]
+    if scaling is not None:
+        inputs.append(scaling)
+    grad_outputs = torch.eye(totals.shape[0], dtype=totals.dtype, device=totals.device)
+    grads = torch.autograd.grad([totals], inputs, [grad_outputs], is_grads_batched=True)
+    virial = grads[1] if scaling is not None else None
+    return Derivatives(-grads[0], virial, None)
+
+
+class EnsembleCalculator(Calculator):
+    """ASE calculator for a committee of models.
+
+    Arguments:
+        func (callable): the same as :class:`Calculator`, except that it returns
+            the energies of all members, of shape ``(members,)`` or
+            ``(members, atoms)``.
+
+    Other arguments are the same as :class:`Calculator`. The ``energy``,
+    ``energies``, ``forces`` and ``stress`` properties are the means over
+    members. The energies and forces of each member are available as the
+    ``member_energies`` and ``member_forces`` properties, and the variance of
+    the forces of each atom, summed over the three directions, as the
+    ``force_variances`` property. Per-atom stresses are not supported.
+    """
+
+    implemented_properties = ['energy', 'energies', 'forces', 'stress', 'free_energy',
+                              'member_energies', 'member_forces', 'force_variances']
+    _derivative_properties = ['forces', 'stress', 'member_forces', 'force_variances']
+
+    def _store(self, properties, energies: Tensor, coordinates: Tensor, scaling: Optional[Tensor]):
+        profiler = self.profiler
+        with profiler.phase('to_numpy'):
+            member_energies = energies.detach().reshape(energies.shape[0], -1).sum(-1)
+            self.results['member_energies'] = member_energies.cpu().numpy()
+            self.results['energy'] = self.results['free_energy'] = member_energies.mean().item()
+            if energies.dim() > 1:
+                self.results['energies'] = energies.detach().mean(0).cpu().numpy()
+
+        if any(p in self._derivative_properties for p in properties):
+            with profiler.phase('backward'):
+                forces, virial, _ = member_derivatives(energies, coordinates, scaling)
+            profiler.outputs('backward', forces)
+            with profiler.phase('to_numpy'):
+                mean_forces = forces.mean(0)
+                variances = ((forces - mean_forces) ** 2).sum(-1).mean(0)
+                self.results['member_forces'] = forces.cpu().numpy()
+                self.results['forces'] = mean_forces.cpu().numpy()
+                self.results['force_variances'] = variances.cpu().numpy()
+                if virial is not None:
+                    self.results['stress'] = (virial.mean(0) / self.atoms.get_volume()).cpu().numpy()
+
+
+###############################################################################
+# TorchScript
+# -----------
+#
+# :class:`Calculator` glues the wrapping, the strain, the potential and
+# ``torch.autograd.grad`` together in Python. To deploy a potential without
+# Python, or to let the TorchScript compiler optimize the whole calculation,
+# :class:`ForceField` bundles all of them in a single module that can be
+# compiled by :func:`torch.jit.script`, frozen by :func:`torch.jit.freeze` and
+# saved to one file. Since strings are not supported well by TorchScript, the
+# potential takes an integer tensor of species, for example atomic numbers,
+# instead of chemical symbols.
+#
+# TorchScript optimizes a graph after it has seen a few inputs, so the first
+# calls are slow. :func:`warmup` runs these calls on an example input, before
+# the timing critical part of a simulation.
+class Results(NamedTuple):
+    energy: Tensor
+    forces: Tensor
+    stress: Optional[Tensor]
+
+
+class ForceField(torch.nn.Module):
+    """Compute energy, forces and stress of a potential in one scriptable module.
+
+    Arguments:
+        potential (:class:`torch.nn.Module`): a scriptable module that takes
+            species of shape ``(atoms,)``, coordinates of shape ``(atoms, 3)``,
+            cell of shape ``(3, 3)`` and pbc of shape ``(3,)``, and returns the
+            energy, either as a scalar or as per-atom energies.
+        stress (bool): whether to compute the stress.
+    """
+
+    def __init__(self, potential: torch.nn.Module, stress: bool = False):
+        super().__init__()
+        self.potential = potential
+        self.stress = stress
+
+    def forward(self, species: Tensor, coordinates: Tensor, cell: Tensor, pbc_: Tensor) -> Results:
+        """Returns a namedtuple ``(energy, forces, stress)``, where ``stress``
+        has shape ``(3, 3)``, or is ``None`` if not requested."""
+        coordinates = coordinates.detach()
+        if bool(pbc_.any()):
             coordinates = pbc.map2central(cell, coordinates, pbc_)
+        coordinates.requires_grad_(True)
+        scaling: Optional[Tensor] = None
+        scaled_coordinates = coordinates
+        scaled_cell = cell
+        if self.stress:
+            scaling = torch.eye(3, dtype=cell.dtype, device=cell.device).requires_grad_(True)
+            scaled_coordinates = coordinates @ scaling
+            scaled_cell = cell @ scaling
+        energies = self.potential(species, scaled_coordinates, scaled_cell, pbc_)
+        forces, virial, _ = derivatives(energies, coordinates, scaling)
+        stress: Optional[Tensor] = None
+        if virial is not None:
+            stress = virial / torch.det(cell).abs()
+        return Results(energies.detach().sum(), forces, stress)
+
+
+def warmup(module: Callable[..., Results], species: Tensor, coordinates: Tensor, cell: Tensor,
+           pbc_: Tensor, steps: int = 3):
+    """Call the module a few times on an example input, to let TorchScript optimize it."""
+    for _ in range(steps):
+        module(species, coordinates, cell, pbc_)
+
+
+###############################################################################
+# Integrators
+# -----------
+#
+# Running dynamics with ASE requires converting positions from NumPy to PyTorch
+# and forces back at every step. For small and medium systems, this overhead is
+# comparable to the cost of the potential itself. The integrators below keep
+# coordinates, velocities and masses as tensors during the whole simulation,
+# and only create :class:`ase.Atoms` objects on demand.
+#
+# We use the units of ASE: Angstrom, eV, amu, and the ASE time unit, for
+# example ``5 * ase.units.fs`` is a time step of 5 femtoseconds.
+#
+# Many independent trajectories of the same molecule, for example with different
+# random seeds or temperatures, could be run together as replicas. The state
+# tensors then have a leading ``replicas`` dimension, and the potential is
+# called once per step for all replicas with coordinates of shape
+# ``(replicas, atoms, 3)``, cell of shape ``(replicas, 3, 3)`` and pbc of shape
+# ``(replicas, 3)``. It should return energies of shape ``(replicas,)`` or
+# ``(replicas, atoms)``. Since replicas are independent, one backward pass of
+# the summed energy gives the forces of all replicas.
+class Dynamics:
+    """Base class of molecular dynamics integrators running on tensors.
+
+    Arguments:
+        atoms (:class:`ase.Atoms` or list of :class:`ase.Atoms`): the initial
+            positions, velocities, masses, cell and pbc are taken from it. If a
+            list is given, each of them is a replica, and they must have the
+            same chemical symbols.
+        func (callable): the potential, with the same signature as the ``func``
+            of :class:`Calculator`.
+        timestep (float): the time step in ASE time unit.
+        neighborlist (:class:`nnp.pbc.VerletList`): optional neighbor list,
+            see :class:`Calculator`. Not supported for replicas.
+        dtype (torch.dtype): dtype of the state tensors.
+        device (torch.device): device of the state tensors.
+    """
+
+    def __init__(self, atoms: Union[ase.Atoms, Sequence[ase.Atoms]], func: Callable[..., Tensor],
+                 timestep: float, neighborlist: Optional[pbc.VerletList] = None,
+                 dtype: torch.dtype = torch.double, device: Optional[torch.device] = None):
+        self.func = func
+        self.timestep = timestep
+        self.neighborlist = neighborlist
+        images: List[ase.Atoms] = [atoms] if isinstance(atoms, ase.Atoms) else list(atoms)
+        self.replicas = not isinstance(atoms, ase.Atoms)
+        self.symbols = images[0].get_chemical_symbols()
+        if any(a.get_chemical_symbols() != self.symbols for a in images):
+            raise ValueError('All replicas must have the same chemical symbols')
+        if self.replicas and neighborlist is not None:
+            raise ValueError('Neighbor lists are not supported for replicas')
+
+        def stack(arrays, dtype):
+            result = torch.tensor(np.stack(arrays), dtype=dtype, device=device)
+            return result if self.replicas else result[0]
+
+        self.coordinates = stack([a.get_positions() for a in images], dtype)
+        self.velocities = stack([a.get_velocities() for a in images], dtype)
+        self.masses = stack([images[0].get_masses()], dtype)
+        if self.replicas:
+            self.masses = self.masses[0]
+        self.cell = stack([a.get_cell(complete=True).array for a in images], dtype)
+        self.pbc = stack([a.get_pbc() for a in images], torch.bool)
+        self._pbc_enabled = bool(self.pbc.any().item())
+        self._inv_cell = torch.inverse(self.cell)
+        self.nsteps = 0
+        self.observers: List[Tuple[Callable, int, tuple, dict]] = []
+        self.energy = self.forces = self.coordinates.new_zeros(())
+        self.compute_forces()
+
+    @property
+    def degrees_of_freedom(self) -> int:
+        return 3 * self.masses.shape[-1]
+
+    def _evaluate(self, func: Callable[..., Tensor]) -> Tuple[Tensor, Tensor]:
+        # wrap atoms and compute the energy and forces of the given potential
+        if self.replicas:
+            self.coordinates = pbc.batched_map2central(self.cell, self.coordinates, self.pbc)
+        elif self._pbc_enabled:
+            self.coordinates = pbc.map2central(self.cell, self.coordinates, self.pbc, self._inv_cell)
+        coordinates = self.coordinates.detach().requires_grad_()
+        if self.neighborlist is not None:
+            neighbors = self.neighborlist(self.cell, coordinates, self.pbc)
+            energies = func(self.symbols, coordinates, self.cell, self.pbc, neighbors)
+        else:
+            energies = func(self.symbols, coordinates, self.cell, self.pbc)
+        forces = derivatives(energies, coordinates).forces
+        batch_shape = self.coordinates.shape[:-2]
+        return energies.detach().reshape(batch_shape + (-1,)).sum(-1), forces
+
+    def compute_forces(self):
+        """Compute energy and forces at the current coordinates."""
+        self.energy, self.forces = self._evaluate(self.func)
+
+    def kinetic_energy(self) -> Tensor:
+        return 0.5 * (self.masses.unsqueeze(-1) * self.velocities ** 2).sum((-1, -2))
+
+    def temperature(self) -> Tensor:
+        """Instantaneous temperature in Kelvin."""
+        return 2 * self.kinetic_energy() / (self.degrees_of_freedom * ase.units.kB)
+
+    def step(self):
+        raise NotImplementedError
+
+    def attach(self, function: Callable, interval: int = 1, *args, **kwargs):
+        """Call ``function(*args, **kwargs)`` every ``interval`` steps."""
+        self.observers.append((function, interval, args, kwargs))
+
+    def _call_observers(self):
+        for function, interval, args, kwargs in self.observers:
+            if self.nsteps % interval == 0:
+                function(*args, **kwargs)
+
+    def run(self, steps: int):
+        """Run the dynamics for the given number of steps."""
+        if self.nsteps == 0:
+            self._call_observers()
+        for _ in range(steps):
+            self.step()
+            self.nsteps += 1
+            self._call_observers()
+
+    _state_attributes: Tuple[str, ...] = ('coordinates', 'velocities', 'cell', 'energy', 'forces')
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the full state of the integrator, to be saved by :func:`torch.save`."""
+        state: Dict[str, Any] = {'nsteps': self.nsteps}
+        for name in self._state_attributes:
+            value = getattr(self, name)
+            state[name] = [v.clone() for v in value] if isinstance(value, list) else value.clone()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """Restore the state returned by :meth:`state_dict`."""
+        self.nsteps = state['nsteps']
+        for name in self._state_attributes:
+            value = state[name]
+            if isinstance(value, list):
+                setattr(self, name, [v.to(self.coordinates.device) for v in value])
+            else:
+                setattr(self, name, value.to(self.coordinates.device))
+        self._inv_cell = torch.inverse(self.cell)
+
+    def get_atoms(self, replica: Optional[int] = None) -> ase.Atoms:
+        """Create an :class:`ase.Atoms` of the current state, with energy and forces attached.
+
+        Arguments:
+            replica (int): which replica to get, required when running replicas.
+        """
+        index: Tuple[int, ...] = ()
+        if self.replicas:
+            if replica is None:
+                raise ValueError('Replica must be specified')
+            index = (replica,)
+        atoms = ase.Atoms(self.symbols, positions=self.coordinates[index].detach().cpu().numpy(),
+                          cell=self.cell[index].cpu().numpy(), pbc=self.pbc[index].cpu().numpy(),
+                          masses=self.masses.cpu().numpy(),
+                          velocities=self.velocities[index].cpu().numpy())
+        atoms.calc = SinglePointCalculator(atoms, energy=self.energy[index].item(),
+                                           forces=self.forces[index].detach().cpu().numpy())
+        return atoms
+
+    def _per_system(self, value: Union[float, Tensor]) -> Tensor:
+        # broadcast a scalar or a per-replica parameter to shape (replicas, 1, 1)
+        value = torch.as_tensor(value, dtype=self.coordinates.dtype, device=self.coordinates.device)
+        return value.expand(self.coordinates.shape[:-2]).unsqueeze(-1).unsqueeze(-1)
+
+
+class VelocityVerlet(Dynamics):
+    """Velocity Verlet integrator, for the microcanonical ensemble.
+
+    Arguments are the same as :class:`Dynamics`.
+    """
+
+    def step(self):
+        dt = self.timestep
+        inv_masses = 1 / self.masses.unsqueeze(-1)
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+        self.coordinates = self.coordinates + dt * self.velocities
+        self.compute_forces()
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+
+
+###############################################################################
+# The Langevin integrator uses the BAOAB splitting of `Leimkuhler and Matthews`_,
+# which samples configurations very accurately for a given time step.
+#
+# .. _Leimkuhler and Matthews:
+#   https://doi.org/10.1093/amrx/abs010
+class Langevin(Dynamics):
+    """Langevin integrator, for the canonical ensemble.
+
+    Arguments:
+        temperature_K (float or Tensor): the temperature in Kelvin, could be
+            a tensor of shape ``(replicas,)`` for replicas.
+        friction (float or Tensor): the friction coefficient in the inverse of
+            ASE time unit, could be a tensor of shape ``(replicas,)`` for replicas.
+        generator (torch.Generator): optional random number generator. Its
+            state is saved by :meth:`state_dict`, while the state of the global
+            random number generator is not.
+
+    Other arguments are the same as :class:`Dynamics`.
+    """
+
+    def __init__(self, atoms: Union[ase.Atoms, Sequence[ase.Atoms]], func: Callable[..., Tensor],
+                 timestep: float, temperature_K: Union[float, Tensor], friction: Union[float, Tensor],
+                 generator: Optional[torch.Generator] = None, **kwargs):
+        super().__init__(atoms, func, timestep, **kwargs)
+        self.temperature_K = temperature_K
+        self.friction = friction
+        self.generator = generator
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        if self.generator is not None:
+            state['generator'] = self.generator.get_state()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        super().load_state_dict(state)
+        if self.generator is not None:
+            self.generator.set_state(state['generator'])
+
+    def step(self):
+        dt = self.timestep
+        inv_masses = 1 / self.masses.unsqueeze(-1)
+        c1 = torch.exp(-self._per_system(self.friction) * dt)
+        c2 = torch.sqrt(1 - c1 * c1)
+        thermal_velocities = torch.sqrt(ase.units.kB * self._per_system(self.temperature_K) * inv_masses)
+        noise = torch.randn(self.velocities.shape, dtype=self.velocities.dtype,
+                            device=self.velocities.device, generator=self.generator)
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+        self.coordinates = self.coordinates + 0.5 * dt * self.velocities
+        self.velocities = c1 * self.velocities + c2 * thermal_velocities * noise
+        self.coordinates = self.coordinates + 0.5 * dt * self.velocities
+        self.compute_forces()
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+
+
+###############################################################################
+# The Nose-Hoover thermostat couples the system to a friction variable
+# :math:`\xi`, whose equation of motion is
+#
+# .. math::
+#   \dot{\xi} = \frac{2K - N_f k_B T}{Q}
+#
+# where :math:`K` is the kinetic energy, :math:`N_f` the number of degrees of
+# freedom and :math:`Q = N_f k_B T \tau^2` the mass of the thermostat. We
+# integrate it with a time reversible Trotter splitting around velocity Verlet.
+# The extended energy
+#
+# .. math::
+#   E + K + \frac{1}{2} Q \xi^2 + N_f k_B T \eta
+#
+# with :math:`\dot{\eta} = \xi` is conserved, which is useful for checking
+# the simulation.
+class NoseHoover(Dynamics):
+    """Nose-Hoover integrator, for the canonical ensemble.
+
+    Arguments:
+        temperature_K (float or Tensor): the temperature in Kelvin, could be
+            a tensor of shape ``(replicas,)`` for replicas.
+        tdamp (float or Tensor): the relaxation time of the thermostat in ASE
+            time unit, could be a tensor of shape ``(replicas,)`` for replicas.
+
+    Other arguments are the same as :class:`Dynamics`.
+    """
+
+    def __init__(self, atoms: Union[ase.Atoms, Sequence[ase.Atoms]], func: Callable[..., Tensor],
+                 timestep: float, temperature_K: Union[float, Tensor], tdamp: Union[float, Tensor],
+                 **kwargs):
+        super().__init__(atoms, func, timestep, **kwargs)
+        self.temperature_K = temperature_K
+        self.tdamp = tdamp
+        self.xi = self.coordinates.new_zeros(self.coordinates.shape[:-2])
+        self.eta = self.coordinates.new_zeros(self.coordinates.shape[:-2])
+
+    _state_attributes = Dynamics._state_attributes + ('xi', 'eta')
+
+    @property
+    def _target(self) -> Tensor:
+        return self.degrees_of_freedom * ase.units.kB * self._per_system(self.temperature_K)[..., 0, 0]
+
+    @property
+    def _thermostat_mass(self) -> Tensor:
+        return self._target * self._per_system(self.tdamp)[..., 0, 0] ** 2
 
-        if 'stress' in properties:
-            scaling = torch.eye(3, requires_grad=True)
-            coordinates = coordinates @ scaling
+    def _thermostat(self, dt: float):
+        Q = self._thermostat_mass
+        self.xi = self.xi + 0.5 * dt * (2 * self.kinetic_energy() - self._target) / Q
+        self.velocities = self.velocities * torch.exp(-self.xi * dt).unsqueeze(-1).unsqueeze(-1)
+        self.eta = self.eta + self.xi * dt
+        self.xi = self.xi + 0.5 * dt * (2 * self.kinetic_energy() - self._target) / Q
+
+    def step(self):
+        dt = self.timestep
+        inv_masses = 1 / self.masses.unsqueeze(-1)
+        self._thermostat(0.5 * dt)
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+        self.coordinates = self.coordinates + dt * self.velocities
+        self.compute_forces()
+        self.velocities = self.velocities + 0.5 * dt * self.forces * inv_masses
+        self._thermostat(0.5 * dt)
+
+    def conserved_energy(self) -> Tensor:
+        Q = self._thermostat_mass
+        return self.energy + self.kinetic_energy() + 0.5 * Q * self.xi ** 2 + self._target * self.eta
+
+
+###############################################################################
+# Many potentials are the sum of a cheap term that changes fast, for example
+# bonded or short range terms, and an expensive term that changes slowly, for
+# example a neural network or long range term. The reversible reference system
+# propagator algorithm (RESPA) of `Tuckerman et al.`_ integrates the slow
+# term with a larger time step, by nesting velocity Verlet steps: each level
+# gives half kicks of its own forces around several steps of the faster levels.
+# It is still time reversible and symplectic, so energy is conserved as long as
+# the slow term is really slow compared to the outer time step.
+#
+# .. _Tuckerman et al.:
+#   https://doi.org/10.1063/1.463137
+class RESPA(Dynamics):
+    """Multiple time step integrator, for the microcanonical ensemble.
+
+    Arguments:
+        terms: list of ``(func, interval)``, where ``func`` is a term of the
+            potential with the same signature as the ``func`` of
+            :class:`Calculator`, and ``interval`` is an integer saying that this
+            term is evaluated every ``interval`` time steps. Each interval must
+            divide the next larger one.
+        timestep (float): the smallest time step in ASE time unit. Each call
+            of :meth:`step` advances the time by the largest interval.
+
+    Other arguments are the same as :class:`Dynamics`. The energy and forces of
+    each term are kept in attributes ``term_energies`` and ``term_forces``, in
+    the order of increasing intervals.
+    """
+
+    def __init__(self, atoms: Union[ase.Atoms, Sequence[ase.Atoms]],
+                 terms: Sequence[Tuple[Callable[..., Tensor], int]], timestep: float, **kwargs):
+        self.terms = sorted(terms, key=lambda t: t[1])
+        intervals = [interval for _, interval in self.terms]
+        if intervals[0] < 1 or any(b % a != 0 for a, b in zip(intervals, intervals[1:])):
+            raise ValueError('Each interval must be positive and divide the next larger one')
+        super().__init__(atoms, self._sum_of_terms, timestep, **kwargs)
+
+    _state_attributes = Dynamics._state_attributes + ('term_energies', 'term_forces')
+
+    def _sum_of_terms(self, *args):
+        return sum(func(*args) for func, _ in self.terms)
+
+    def compute_forces(self):
+        results = [self._evaluate(func) for func, _ in self.terms]
+        self.term_energies = [energy for energy, _ in results]
+        self.term_forces = [forces for _, forces in results]
+        self._sum_terms()
+
+    def _sum_terms(self):
+        self.energy = sum(self.term_energies[1:], self.term_energies[0])
+        self.forces = sum(self.term_forces[1:], self.term_forces[0])
+
+    def _level(self, level: int, dt: float):
+        inv_masses = 1 / self.masses.unsqueeze(-1)
+        self.velocities = self.velocities + 0.5 * dt * self.term_forces[level] * inv_masses
+        if level == 0:
+            self.coordinates = self.coordinates + dt * self.velocities
+        else:
+            substeps = self.terms[level][1] // self.terms[level - 1][1]
+            for _ in range(substeps):
+                self._level(level - 1, dt / substeps)
+        self.term_energies[level], self.term_forces[level] = self._evaluate(self.terms[level][0])
+        self.velocities = self.velocities + 0.5 * dt * self.term_forces[level] * inv_masses
+
+    def step(self):
+        level = len(self.terms) - 1
+        self._level(level, self.timestep * self.terms[level][1])
+        self._sum_terms()
+
+
+###############################################################################
+# Trajectories
+# ------------
+#
+# Writing frames synchronously inside the loop of the integrator stalls the
+# integration, especially when the state lives on a GPU. :class:`TrajectoryWriter`
+# copies each frame into preallocated buffers of ``chunk_size`` frames, and when
+# a buffer is full, hands it to a background thread that saves it as ``.npy``
+# files, while the integration continues with another buffer. The directory
+# contains one file per property and chunk, named like ``forces.000003.npy``,
+# and a ``meta.json`` describing the chunks. Files are read back with memory
+# mapping by :class:`TrajectoryReader`, so random access to any frame is cheap.
+#
+# Together with each full chunk, the state of the integrator at its last frame
+# is saved to ``checkpoint.pt``, so that a crashed run could be restarted from
+# exactly the end of the saved trajectory with :meth:`Dynamics.load_state_dict`
+# and a writer created with ``append=True``. The last chunk saved on closing
+# comes with the state at closing instead. Frames are saved at steps that are
+# multiples of ``stride``, so a run restarted from either state continues the
+# trajectory without gaps or duplicated frames. The state is only copied once
+# per chunk, not for every frame.
+class TrajectoryWriter:
+    """Save frames of :class:`Dynamics` to a directory, from a background thread.
+
+    The writer attaches itself to the dynamics when created. Call :meth:`close`,
+    or use it as a context manager, to flush the remaining frames.
+
+    Arguments:
+        dynamics (:class:`Dynamics`): the dynamics to save.
+        directory (str): where to save the trajectory, created if not exist.
+        stride (int): save a frame every ``stride`` steps.
+        chunk_size (int): number of frames of each chunk.
+        dtype (torch.dtype): optional dtype to downcast floating point properties
+            to, for example ``torch.float32``.
+        properties (list of str): attributes of the dynamics to save. The step
+            number is always saved as ``'step'``.
+        checkpoint (bool): whether to save the state of the integrator with
+            each chunk.
+        append (bool): whether to continue an existing trajectory.
+        num_buffers (int): number of buffers. The integration only waits for
+            the background thread when all of them are waiting to be saved.
+    """
+
+    def __init__(self, dynamics: Dynamics, directory: str, stride: int = 1, chunk_size: int = 100,
+                 dtype: Optional[torch.dtype] = None,
+                 properties: Sequence[str] = ('coordinates', 'velocities', 'energy', 'forces', 'cell'),
+                 checkpoint: bool = True, append: bool = False, num_buffers: int = 2):
+        self.dynamics = dynamics
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.names = ['step'] + list(properties)
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {'names': self.names, 'stride': stride, 'timestep': dynamics.timestep,
+                     'symbols': dynamics.symbols, 'chunks': []}
+        meta_file = os.path.join(directory, 'meta.json')
+        if append and os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.meta['chunks'] = json.load(f)['chunks']
+
+        pin_memory = dynamics.coordinates.device.type == 'cuda'
+        self._free: 'queue.Queue[Dict[str, Tensor]]' = queue.Queue()
+        for _ in range(num_buffers):
+            buffer = {}
+            for name in self.names:
+                value = self._value(name)
+                if dtype is not None and value.is_floating_point():
+                    value = value.to(dtype)
+                buffer[name] = torch.empty((chunk_size,) + value.shape, dtype=value.dtype,
+                                           pin_memory=pin_memory)
+            self._free.put(buffer)
+        self._pending: 'queue.Queue[Optional[tuple]]' = queue.Queue()
+        self._buffer = self._free.get()
+        self._count = 0
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._save_chunks, daemon=True)
+        self._thread.start()
+        dynamics.attach(self, interval=stride)
+
+    def _value(self, name: str) -> Tensor:
+        if name == 'step':
+            return torch.tensor(self.dynamics.nsteps)
+        return getattr(self.dynamics, name).detach()
+
+    def __call__(self):
+        """Copy the current frame to the buffer."""
+        for name in self.names:
+            self._buffer[name][self._count].copy_(self._value(name), non_blocking=True)
+        self._count += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Hand the frames in the buffer to the background thread."""
+        if self._error is not None:
+            raise self._error
+        if self._count == 0:
+            return
+        event = None
+        if self.dynamics.coordinates.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record()
+        state = self.dynamics.state_dict() if self.checkpoint else None
+        self._pending.put((self._buffer, self._count, event, state))
+        self._buffer = self._free.get()
+        self._count = 0
+
+    def _save_chunks(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            buffer, count, event, state = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                index = len(self.meta['chunks'])
+                for name, value in buffer.items():
+                    np.save(os.path.join(self.directory, '{}.{:06d}.npy'.format(name, index)),
+                            value[:count].numpy())
+                if state is not None:
+                    torch.save(state, os.path.join(self.directory, 'checkpoint.pt'))
+                self.meta['chunks'].append(count)
+                with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+                    json.dump(self.meta, f)
+            except BaseException as e:
+                self._error = e
+            self._free.put(buffer)
+
+    def close(self):
+        """Save the remaining frames, wait for the background thread and detach from the dynamics."""
+        self.dynamics.observers = [o for o in self.dynamics.observers if o[0] is not self]
+        if self._thread.is_alive():
+            try:
+                if self._error is None:
+                    self.flush()
+            finally:
+                self._pending.put(None)
+                self._thread.join()
+        if self._error is not None:
+            if self._count > 0:
+                raise RuntimeError('Saving the trajectory failed, the last {} frames were not saved'
+                                   .format(self._count)) from self._error
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryReader:
+    """Read a trajectory saved by :class:`TrajectoryWriter`.
+
+    ``reader[i]`` returns a dict of NumPy arrays of the ``i``-th frame, and
+    ``reader.read(name)`` returns an array of a property for all frames. Files
+    are opened with memory mapping, so only the accessed frames are loaded.
+
+    Arguments:
+        directory (str): the directory of the trajectory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.names = self.meta['names']
+        self.symbols = self.meta['symbols']
+        self._offsets = np.cumsum([0] + self.meta['chunks'])
+        self._arrays: Dict[Tuple[str, int], np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+    def _array(self, name: str, chunk: int) -> np.ndarray:
+        key = (name, chunk)
+        if key not in self._arrays:
+            path = os.path.join(self.directory, '{}.{:06d}.npy'.format(name, chunk))
+            self._arrays[key] = np.load(path, mmap_mode='r')
+        return self._arrays[key]
+
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Frame index out of range')
+        chunk = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return {name: np.array(self._array(name, chunk)[index - self._offsets[chunk]])
+                for name in self.names}
+
+    def read(self, name: str) -> np.ndarray:
+        """Read a property of all frames."""
+        return np.concatenate([self._array(name, i) for i in range(len(self.meta['chunks']))])
+
+
+###############################################################################
+# Evaluation server
+# -----------------
+#
+# Many independent workflows, like geometry optimizations or NEB calculations,
+# often run in parallel processes, each calling the potential for a single
+# structure at a time. Small batches use the CPU or GPU poorly. Instead, a
+# :class:`Server` could own the only copy of the potential and evaluate the
+# structures of many clients together: it waits for the first request, then
+# collects more requests until either ``max_batch_size`` structures are
+# collected or ``max_wait`` seconds have passed, and evaluates the whole batch
+# with one forward and one backward pass. ``max_wait`` is the trade-off between
+# latency and throughput: zero only batches requests that are already waiting,
+# while larger values give larger batches at the cost of a longer delay of each
+# request.
+#
+# Clients are :class:`ServerCalculator`, thin ASE calculators that only send
+# positions and receive results. They are either created by :meth:`Server.client`,
+# and connected to the server by multiprocessing queues, so that they could be
+# passed to worker processes when they are started, or connected with
+# :meth:`ServerCalculator.connect` to a Unix socket the server listens on, from
+# any process.
+#
+# Structures of a batch could have different numbers of atoms, so they are
+# padded to the largest one. The batched potential is called as
+# ``func(symbols, coordinates, cell, pbc, mask)``, where ``symbols`` is a list
+# of chemical symbols of each structure, ``coordinates`` has shape
+# ``(molecules, atoms, 3)``, ``cell`` has shape ``(molecules, 3, 3)``, ``pbc``
+# has shape ``(molecules, 3)``, and ``mask`` is a boolean tensor of shape
+# ``(molecules, atoms)`` that is ``False`` for padding atoms. It should return
+# energies of shape ``(molecules,)``, or ``(molecules, atoms)`` with zeros for
+# padding atoms, and padding atoms must not change the energies of real atoms.
+class _QueueConnection:
+    # client side of a connection through multiprocessing queues
+
+    def __init__(self, requests, responses, key: int):
+        self.requests = requests
+        self.responses = responses
+        self.key = key
+
+    def send(self, payload):
+        self.requests.put((self.key, payload))
+
+    def recv(self):
+        return self.responses.get()
+
+
+class Server:
+    """Evaluate structures of many clients in dynamic batches.
+
+    Arguments:
+        func (callable): the batched potential, see above.
+        max_batch_size (int): the maximum number of structures of a batch.
+        max_wait (float): after the first request of a batch, how many seconds
+            to wait for more requests.
+        dtype (torch.dtype): dtype of the tensors passed to ``func``.
+        device (torch.device): device of the tensors passed to ``func``.
+        context: optional multiprocessing context used to create queues.
+    """
+
+    def __init__(self, func: Callable[..., Tensor], max_batch_size: int = 32, max_wait: float = 0.002,
+                 dtype: torch.dtype = torch.double, device: Optional[torch.device] = None, context=None):
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.dtype = dtype
+        self.device = device
+        self._context = context if context is not None else multiprocessing.get_context()
+        self._requests = self._context.Queue()
+        self._replies: Dict[Any, Callable[[Any], None]] = {}
+        self._keys = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._listener: Optional[multiprocessing.connection.Listener] = None
+        self.batch_sizes: List[int] = []
+
+    def client(self) -> 'ServerCalculator':
+        """Create a client connected by multiprocessing queues."""
+        responses = self._context.Queue()
+        key = next(self._keys)
+        self._replies[key] = responses.put
+        return ServerCalculator(_QueueConnection(self._requests, responses, key))
+
+    def listen(self, address: str):
+        """Accept clients on a Unix socket at ``address``, from a background thread."""
+        self._listener = multiprocessing.connection.Listener(address, family='AF_UNIX')
+        threading.Thread(target=self._accept, args=(self._listener,), daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                return
+            key = next(self._keys)
+            self._replies[key] = connection.send
+            threading.Thread(target=self._forward, args=(key, connection), daemon=True).start()
+
+    def _forward(self, key, connection):
+        while True:
+            try:
+                payload = connection.recv()
+            except (EOFError, OSError):
+                break
+            self._requests.put((key, payload))
+        self._replies.pop(key, None)
+        connection.close()
+
+    def serve_forever(self):
+        """Evaluate requests until :meth:`stop` is called."""
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._evaluate(batch)
+                    return
+                batch.append(item)
+            self._evaluate(batch)
+
+    def start(self):
+        """Run :meth:`serve_forever` in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving, and stop listening on the Unix socket."""
+        self._requests.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _evaluate(self, batch):
+        try:
+            results = self._compute([payload for _, payload in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (key, _), result in zip(batch, results):
+            reply = self._replies.get(key)
+            if reply is None:
+                continue
+            # the client could disconnect before its connection is closed here
+            try:
+                reply(result)
+            except (OSError, EOFError):
+                self._replies.pop(key, None)
+        self.batch_sizes.append(len(batch))
+
+    def _compute(self, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        sizes = [len(p['symbols']) for p in payloads]
+        padded = np.zeros((len(payloads), max(sizes), 3))
+        for i, p in enumerate(payloads):
+            padded[i, :sizes[i]] = p['positions']
+        coordinates = torch.tensor(padded, dtype=self.dtype, device=self.device)
+        cell = torch.tensor(np.stack([p['cell'] for p in payloads]), dtype=self.dtype, device=self.device)
+        pbc_ = torch.tensor(np.stack([p['pbc'] for p in payloads]), device=self.device)
+        mask = torch.arange(max(sizes), device=self.device) \
+            < torch.tensor(sizes, device=self.device).unsqueeze(-1)
+        coordinates = pbc.batched_map2central(cell, coordinates, pbc_, mask).requires_grad_()
+
+        scaling: Optional[Tensor] = None
+        scaled_coordinates = coordinates
+        if any('stress' in p['properties'] for p in payloads):
+            scaling = torch.eye(3, dtype=self.dtype, device=self.device).repeat(len(payloads), 1, 1)
+            scaling.requires_grad_()
+            scaled_coordinates = coordinates @ scaling
             cell = cell @ scaling
+        energies = self.func([p['symbols'] for p in payloads], scaled_coordinates, cell, pbc_, mask)
+        forces, virial, _ = derivatives(energies, coordinates, scaling)
+
+        energy = energies.detach().reshape(len(payloads), -1).sum(-1).cpu().numpy()
+        forces_ = forces.cpu().numpy()
+        virial_ = virial.cpu().numpy() if virial is not None else None
+        results = []
+        for i, p in enumerate(payloads):
+            result = {'energy': float(energy[i]), 'forces': forces_[i, :sizes[i]]}
+            if virial_ is not None and 'stress' in p['properties']:
+                result['stress'] = virial_[i] / abs(np.linalg.det(p['cell']))
+            results.append(result)
+        return results
+
+
+class ServerCalculator(ase.calculators.calculator.Calculator):
+    """ASE calculator that sends calculations to a :class:`Server`.
+
+    Created by :meth:`Server.client` or :meth:`connect`. Energy and forces are
+    always computed together.
+    """
+
+    implemented_properties = ['energy', 'forces', 'stress', 'free_energy']
+
+    def __init__(self, connection):
+        super(ServerCalculator, self).__init__()
+        self.connection = connection
+
+    @classmethod
+    def connect(cls, address: str) -> 'ServerCalculator':
+        """Connect to a server listening on the Unix socket at ``address``."""
+        return cls(multiprocessing.connection.Client(address, family='AF_UNIX'))
+
+    def calculate(self, atoms=None, properties=['energy'],
+                  system_changes=ase.calculators.calculator.all_changes):
+        super(ServerCalculator, self).calculate(atoms, properties, system_changes)
+        self.connection.send({
+            'symbols': self.atoms.get_chemical_symbols(),
+            'positions': self.atoms.get_positions(),
+            'cell': self.atoms.get_cell(complete=True).array,
+            'pbc': self.atoms.get_pbc(),
+            'properties': list(properties),
+        })
+        result = self.connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        self.results.update(result)
+        self.results['free_energy'] = result['energy']
+
+
+###############################################################################
+# Domain decomposition
+# --------------------
+#
+# For large periodic systems, the evaluation of the potential could be split
+# among the processes of a :mod:`torch.distributed` group, for example gloo
+# processes on the cores of one or several nodes. :class:`DomainDecomposition`
+# wraps a potential, and the wrapper has the same signature as the potential,
+# so it could be used with :class:`Calculator` or the integrators unchanged.
+# All processes run the same script on the same full coordinates, but each of
+# them only evaluates the potential on a subdomain of the cell.
+#
+# The cell is divided into a grid of subdomains along its periodic directions,
+# choosing the grid that keeps subdomains as thick as possible. Each process
+# owns the atoms whose fractional coordinates are in its subdomain, and builds
+# a local system of these atoms and the ghost atoms within ``cutoff`` of the
+# subdomain, including periodic images. The thickness of this halo along each
+# cell vector is computed the same way as :func:`nnp.pbc.num_repeats`. Divided
+# directions are not periodic in the local system, since the images that are
+# needed are explicitly included.
+#
+# The potential must return per-atom energies, and the energy of an atom must
+# only depend on atoms within ``cutoff``, so that the energies of owned atoms
+# are exact. These energies are summed across processes in the forward pass.
+# In the backward pass, each process only has the gradient of its own part of
+# the energy with respect to the shared coordinates and cell, so these gradients
+# are also summed across processes. Forces and virials computed by autograd are
+# therefore the full ones on every process.
+class _SumAcrossProcesses(torch.autograd.Function):
+    # sum across processes in forward, each process gets the full gradient
+
+    @staticmethod
+    def forward(ctx, tensor, group):
+        tensor = tensor.clone()
+        torch.distributed.all_reduce(tensor, group=group)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad, None
+
+
+class _SharedAcrossProcesses(torch.autograd.Function):
+    # identity in forward, gradients of all processes are summed in backward
+
+    @staticmethod
+    def forward(ctx, tensor, group):
+        ctx.group = group
+        return tensor.view_as(tensor)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        torch.distributed.all_reduce(grad, group=ctx.group)
+        return grad, None
+
+
+class DomainDecomposition:
+    """Evaluate a potential on spatial subdomains across processes.
+
+    Arguments:
+        func (callable): the potential, with the same signature as the ``func``
+            of :class:`Calculator`, that returns per-atom energies.
+        cutoff (float): the range of the potential, that is, the energy of an
+            atom only depends on atoms within this distance.
+        grid (tuple of int): optional numbers of subdomains along the three
+            cell vectors, whose product must be the number of processes.
+        group: optional process group, default to the whole world. If
+            :mod:`torch.distributed` is not initialized, the whole cell is a
+            single subdomain.
+
+    Neighbor lists of :class:`Calculator` and replicas are not supported.
+    """
+
+    def __init__(self, func: Callable[..., Tensor], cutoff: float, grid: Optional[Tuple[int, int, int]] = None,
+                 group=None):
+        self.func = func
+        self.cutoff = cutoff
+        self.group = group
+        self.distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = torch.distributed.get_rank(group) if self.distributed else 0
+        self.world_size = torch.distributed.get_world_size(group) if self.distributed else 1
+        if grid is not None and grid[0] * grid[1] * grid[2] != self.world_size:
+            raise ValueError('The product of grid must be the number of processes')
+        self.grid = grid
+
+    def choose_grid(self, cell: Tensor, pbc_: Tensor) -> Tuple[int, int, int]:
+        """Choose the grid of subdomains that maximizes the thinnest subdomain."""
+        heights = 1 / cell.detach().inverse().t().norm(2, -1)
+        best: Optional[Tuple[int, int, int]] = None
+        best_thickness = 0.0
+        n = self.world_size
+        for nx in range(1, n + 1):
+            for ny in range(1, n // nx + 1):
+                if n % (nx * ny) != 0:
+                    continue
+                grid = (nx, ny, n // (nx * ny))
+                if any(g > 1 and not bool(p) for g, p in zip(grid, pbc_)):
+                    continue
+                thickness = min(float(h) / g for h, g in zip(heights, grid))
+                if thickness > best_thickness:
+                    best, best_thickness = grid, thickness
+        if best is None:
+            raise ValueError('The cell could not be divided among the processes along periodic directions')
+        return best
 
-        energy = self.func(atoms.get_chemical_symbols(), coordinates, cell, pbc_)
+    def local_atoms(self, cell: Tensor, coordinates: Tensor, pbc_: Tensor,
+                    grid: Tuple[int, int, int]) -> Tuple[Tensor, Tensor, Tensor]:
+        """Find the atoms of the local system of this process for a grid.
 
-        self.results['energy'] = energy.item()
-        self.results['free_energy'] = energy.item()
+        Returns:
+            A tuple ``(index, shifts, owned)``, where ``index`` is the index of
+            each local atom in ``coordinates``, ``shifts`` are the integer shifts
+            of their images from ``coordinates``, and ``owned`` is a boolean tensor that is ``True``
+            for the atoms owned by this process.
+        """
+        grid_ = torch.tensor(grid, device=coordinates.device)
+        divided = grid_ > 1
+        position = torch.tensor(np.unravel_index(self.rank, grid), device=coordinates.device)
+        lower = position.to(cell.dtype) / grid_
+        upper = (position + 1).to(cell.dtype) / grid_
+        halo = self.cutoff * cell.detach().inverse().t().norm(2, -1)
+        repeats = pbc.num_repeats(cell.detach(), divided, self.cutoff).tolist()
 
-        if 'forces' in properties:
-            forces = -torch.autograd.grad(energy, coordinates)[0]
-            self.results['forces'] = forces.cpu().numpy()
+        fractional = coordinates.detach() @ cell.detach().inverse()
+        offsets = fractional.floor() * pbc_.to(fractional.dtype)
+        fractional = fractional - offsets
+        # rounding could give exactly 1 just below a face of the cell
+        face = pbc_ & (fractional >= 1)
+        fractional = torch.where(face, fractional - 1, fractional)
+        offsets = (offsets + face.to(offsets.dtype)).to(torch.long)
+        # each atom has exactly one owner, even if rounding puts it on a boundary
+        subdomain = (fractional * grid_).floor().clamp(min=0).minimum(grid_ - 1)
+        mine = ((subdomain == position) | ~divided).all(-1)
+        indices, all_shifts, owned = [], [], []
+        for shift in itertools.product(*[range(-r, r + 1) for r in repeats]):
+            shift_ = torch.tensor(shift, device=coordinates.device)
+            image = fractional + shift_.to(fractional.dtype)
+            inside = ((image >= lower - halo) & (image < upper + halo)) | ~divided
+            index = (inside.all(-1) | (mine & (shift_ == 0).all())).nonzero().flatten()
+            indices.append(index)
+            all_shifts.append(shift_ - offsets[index])
+            owned.append(mine[index] & (shift_ == 0).all())
+        return torch.cat(indices), torch.cat(all_shifts), torch.cat(owned)
 
-        if 'stress' in properties:
-            volume = self.atoms.get_volume()
-            stress = torch.autograd.grad(energy, scaling)[0] / volume
-            self.results['stress'] = stress.cpu().numpy()
+    def __call__(self, symbols: List[str], coordinates: Tensor, cell: Tensor, pbc_: Tensor) -> Tensor:
+        if coordinates.dim() != 2:
+            raise ValueError('Replicas are not supported by domain decomposition')
+        if self.distributed:
+            coordinates = _SharedAcrossProcesses.apply(coordinates, self.group)
+            cell = _SharedAcrossProcesses.apply(cell, self.group)
+        grid = self.grid if self.grid is not None else self.choose_grid(cell, pbc_)
+        index, shifts, owned = self.local_atoms(cell, coordinates, pbc_, grid)
+        local_pbc = pbc_ & (torch.tensor(grid, device=pbc_.device) == 1)
+        # images in the central cell and explicit images around it
+        local_coordinates = coordinates.index_select(0, index) + shifts.to(cell.dtype) @ cell
+        energies = self.func([symbols[i] for i in index.tolist()], local_coordinates, cell, local_pbc)
+        if energies.shape != index.shape:
+            raise ValueError('The potential must return per-atom energies for domain decomposition')
+        owned_index = index[owned]
+        result = energies.new_zeros(coordinates.shape[0]).index_add(0, owned_index, energies[owned])
+        if self.distributed:
+            result = _SumAcrossProcesses.apply(result, self.group)
+        return result
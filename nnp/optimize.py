@@ -0,0 +1,509 @@
+"""
+Geometry Optimization
+=====================
+
+The module ``nnp.optimize`` contains optimizers that relax a batch of
+structures together with a potential defined by PyTorch.
+"""
+
+import torch
+from torch import Tensor
+from nnp import pbc
+from nnp.md import derivatives
+from typing import Callable, List, Optional, Sequence, Tuple
+import numpy as np
+import ase
+from ase.calculators.singlepoint import SinglePointCalculator
+
+
+###############################################################################
+# Relaxing thousands of structures one by one with ASE optimizers calls the
+# potential with a single small structure at a time. The optimizers here relax
+# all of them together instead: structures are padded to the same number of
+# atoms, and the potential is called once per step for the whole batch, with
+# the same convention as :class:`nnp.md.Server`: ``func(symbols, coordinates,
+# cell, pbc, mask)``, where ``symbols`` is a list of the chemical symbols of
+# each structure, ``coordinates`` has shape ``(molecules, atoms, 3)``, ``cell``
+# has shape ``(molecules, 3, 3)``, ``pbc`` has shape ``(molecules, 3)`` and
+# ``mask`` of shape ``(molecules, atoms)`` is ``False`` for padding atoms. It
+# should return energies of shape ``(molecules,)``, or ``(molecules, atoms)``
+# with zeros for padding atoms.
+#
+# Each structure converges on its own. Once the largest force of a structure
+# is below ``fmax``, the result is written back to its :class:`ase.Atoms`, and
+# the structure is removed from the batch, so later steps only evaluate the
+# structures that are still relaxing.
+#
+# The cell could be relaxed together with the positions, the same way as
+# :class:`ase.filters.UnitCellFilter`, by the strain trick also used for
+# stress: both the positions and the cell are multiplied by a deformation
+# matrix, which is optimized together with the undeformed positions. The
+# derivative of energy with respect to the deformation is the virial. To make
+# its scale comparable to atomic forces, the deformation is multiplied by
+# ``cell_factor``, which defaults to the number of atoms. Each optimizer then
+# only sees a flat vector of generalized positions and forces per structure.
+class Optimizer:
+    """Base class of batched optimizers.
+
+    Arguments:
+        images (list of :class:`ase.Atoms`): the structures to relax. Their
+            positions, and cells if relaxed, are updated when they converge or
+            when :meth:`run` finishes, together with a calculator holding the
+            final energy and forces.
+        func (callable): the batched potential, see above.
+        relax_cell (bool): whether to also relax the cell.
+        pressure (float): external pressure, in eV/Angstrom^3, when relaxing
+            the cell.
+        cell_factor (float): scale of the deformation when relaxing the cell,
+            default to the number of atoms of each structure.
+        dtype (torch.dtype): dtype of the tensors passed to ``func``.
+        device (torch.device): device of the tensors passed to ``func``.
+    """
+
+    _batch_attributes: Tuple[str, ...] = ('positions', 'mask', 'cell', 'pbc', 'cell_factor', 'index')
+
+    def __init__(self, images: Sequence[ase.Atoms], func: Callable[..., Tensor], relax_cell: bool = False,
+                 pressure: float = 0.0, cell_factor: Optional[float] = None,
+                 dtype: torch.dtype = torch.double, device: Optional[torch.device] = None):
+        self.images = list(images)
+        self.func = func
+        self.relax_cell = relax_cell
+        self.pressure = pressure
+        sizes = [len(a) for a in self.images]
+        num_atoms = max(sizes)
+        self.num_atoms = num_atoms
+        self.symbols = [a.get_chemical_symbols() for a in self.images]
+
+        padded = np.zeros((len(self.images), num_atoms, 3))
+        for i, a in enumerate(self.images):
+            padded[i, :len(a)] = a.get_positions()
+        positions = torch.tensor(padded, dtype=dtype, device=device).flatten(1)
+        self.mask = torch.arange(num_atoms, device=device) < torch.tensor(sizes, device=device).unsqueeze(-1)
+        self.cell = torch.tensor(np.stack([a.get_cell(complete=True).array for a in self.images]),
+                                 dtype=dtype, device=device)
+        self.pbc = torch.tensor(np.stack([a.get_pbc() for a in self.images]), device=device)
+        if cell_factor is None:
+            self.cell_factor = torch.tensor(sizes, dtype=dtype, device=device)
+        else:
+            self.cell_factor = torch.full((len(self.images),), cell_factor, dtype=dtype, device=device)
+        if relax_cell:
+            deformation = torch.eye(3, dtype=dtype, device=device).flatten() * self.cell_factor.unsqueeze(-1)
+            positions = torch.cat([positions, deformation], dim=-1)
+        self.positions = positions
+        self.index = torch.arange(len(self.images), device=device)
+        self.converged = torch.zeros(len(self.images), dtype=torch.bool)
+        self.nsteps = 0
+        self.batch_sizes: List[int] = []
+
+    def evaluate(self) -> Tuple[Tensor, Tensor, Tensor, Optional[Tensor]]:
+        """Compute energies, generalized forces, atomic forces and stress
+        of the structures in the batch."""
+        batch_size = self.positions.shape[0]
+        split = 3 * self.num_atoms
+        positions = self.positions[:, :split].reshape(batch_size, self.num_atoms, 3).detach().requires_grad_()
+        coordinates = positions
+        cell = self.cell
+        deformation: Optional[Tensor] = None
+        if self.relax_cell:
+            deformation = self.positions[:, split:].reshape(batch_size, 3, 3) \
+                / self.cell_factor.reshape(-1, 1, 1)
+            deformation = deformation.detach().requires_grad_()
+            coordinates = coordinates @ deformation
+            cell = cell @ deformation
+        coordinates = pbc.batched_map2central(cell, coordinates, self.pbc, self.mask)
+        symbols = [self.symbols[i] for i in self.index.tolist()]
+        energies = self.func(symbols, coordinates, cell, self.pbc, self.mask)
+        energy = energies.reshape(batch_size, -1).sum(-1)
+        enthalpy = energy
+        if self.relax_cell and self.pressure != 0:
+            enthalpy = energy + self.pressure * torch.det(cell).abs()
+        forces, virial, _ = derivatives(enthalpy, positions, deformation)
+        forces = forces * self.mask.unsqueeze(-1)
+        generalized = forces.flatten(1)
+        atomic_forces = forces
+        stress: Optional[Tensor] = None
+        if deformation is not None:
+            assert virial is not None
+            generalized = torch.cat([generalized, -(virial / self.cell_factor.reshape(-1, 1, 1)).flatten(1)], -1)
+            atomic_forces = forces @ torch.inverse(deformation.detach()).transpose(-1, -2)
+            volume = torch.det(cell.detach()).abs().reshape(-1, 1, 1)
+            stress = deformation.detach().transpose(-1, -2) @ virial / volume \
+                - self.pressure * torch.eye(3, dtype=volume.dtype, device=volume.device)
+        return energy.detach(), generalized, atomic_forces, stress
+
+    def step(self, forces: Tensor):
+        """Update the generalized positions of the batch from generalized forces."""
+        raise NotImplementedError
+
+    def _compact(self, keep: Tensor):
+        for name in self._batch_attributes:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value[keep])
+
+    def _write(self, rows: Tensor, energy: Tensor, forces: Tensor, stress: Optional[Tensor]):
+        split = 3 * self.num_atoms
+        batch_size = self.positions.shape[0]
+        positions = self.positions[:, :split].reshape(batch_size, self.num_atoms, 3)
+        cell = self.cell
+        if self.relax_cell:
+            deformation = self.positions[:, split:].reshape(batch_size, 3, 3) / self.cell_factor.reshape(-1, 1, 1)
+            positions = positions @ deformation
+            cell = cell @ deformation
+        for row in rows.tolist():
+            atoms = self.images[int(self.index[row])]
+            n = len(atoms)
+            if self.relax_cell:
+                atoms.set_cell(cell[row].cpu().numpy())
+            atoms.set_positions(positions[row, :n].cpu().numpy())
+            results = {'energy': energy[row].item(), 'forces': forces[row, :n].detach().cpu().numpy()}
+            if stress is not None:
+                results['stress'] = stress[row].detach().cpu().numpy()
+            atoms.calc = SinglePointCalculator(atoms, **results)
+
+    def run(self, fmax: float = 0.05, steps: int = 1000) -> Tensor:
+        """Relax the structures until the largest force of each is below ``fmax``.
+
+        Returns:
+            boolean tensor of shape ``(molecules,)`` of whether each structure
+            has converged.
+        """
+        while self.positions.shape[0] > 0:
+            energy, generalized, forces, stress = self.evaluate()
+            largest = generalized.reshape(generalized.shape[0], -1, 3).norm(2, -1).max(-1).values
+            done = largest < fmax
+            if self.nsteps >= steps:
+                self._write(torch.arange(done.shape[0]), energy, forces, stress)
+                self.converged[self.index[done].cpu()] = True
+                break
+            if bool(done.any()):
+                self._write(done.nonzero().flatten(), energy, forces, stress)
+                self.converged[self.index[done].cpu()] = True
+                keep = ~done
+                self._compact(keep)
+                generalized = generalized[keep]
+                if self.positions.shape[0] == 0:
+                    break
+            self.batch_sizes.append(self.positions.shape[0])
+            self.step(generalized)
+            self.nsteps += 1
+        return self.converged
+
+
+###############################################################################
+# FIRE of `Bitzek et al.`_ runs damped dynamics with unit masses, mixing the
+# velocities towards the forces, and increasing the time step while the power
+# stays positive. Each structure has its own time step and mixing parameter.
+# The parameters are the same as :class:`ase.optimize.FIRE`.
+#
+# .. _Bitzek et al.:
+#   https://doi.org/10.1103/PhysRevLett.97.170201
+class FIRE(Optimizer):
+    """Batched FIRE optimizer.
+
+    Arguments:
+        maxstep (float): the largest displacement of a step of a structure.
+        dt (float): the initial time step.
+        dtmax (float): the largest time step.
+        Nmin (int), finc (float), fdec (float), astart (float), fa (float):
+            parameters of FIRE, see :class:`ase.optimize.FIRE`.
+
+    Other arguments are the same as :class:`Optimizer`.
+    """
+
+    _batch_attributes = Optimizer._batch_attributes + ('velocities', 'dt', 'a', 'n_positive')
+
+    def __init__(self, images: Sequence[ase.Atoms], func: Callable[..., Tensor], maxstep: float = 0.2,
+                 dt: float = 0.1, dtmax: float = 1.0, Nmin: int = 5, finc: float = 1.1, fdec: float = 0.5,
+                 astart: float = 0.1, fa: float = 0.99, **kwargs):
+        super().__init__(images, func, **kwargs)
+        self.maxstep = maxstep
+        self.dtmax = dtmax
+        self.Nmin = Nmin
+        self.finc = finc
+        self.fdec = fdec
+        self.astart = astart
+        self.fa = fa
+        batch_size = self.positions.shape[0]
+        self.velocities: Optional[Tensor] = None
+        self.dt = self.positions.new_full((batch_size,), dt)
+        self.a = self.positions.new_full((batch_size,), astart)
+        self.n_positive = torch.zeros(batch_size, dtype=torch.long, device=self.positions.device)
+
+    def step(self, forces: Tensor):
+        if self.velocities is None:
+            self.velocities = torch.zeros_like(forces)
+        else:
+            v = self.velocities
+            positive = (forces * v).sum(-1) > 0
+            a = self.a.unsqueeze(-1)
+            mixed = (1 - a) * v + a * forces / forces.norm(2, -1, keepdim=True).clamp(min=1e-30) \
+                * v.norm(2, -1, keepdim=True)
+            self.velocities = torch.where(positive.unsqueeze(-1), mixed, torch.zeros_like(v))
+            grow = positive & (self.n_positive > self.Nmin)
+            self.dt = torch.where(grow, (self.dt * self.finc).clamp(max=self.dtmax),
+                                  torch.where(positive, self.dt, self.dt * self.fdec))
+            self.a = torch.where(grow, self.a * self.fa,
+                                 torch.where(positive, self.a, torch.full_like(self.a, self.astart)))
+            self.n_positive = torch.where(positive, self.n_positive + 1, torch.zeros_like(self.n_positive))
+        dt = self.dt.unsqueeze(-1)
+        self.velocities = self.velocities + dt * forces
+        dr = dt * self.velocities
+        norm = dr.norm(2, -1, keepdim=True)
+        dr = dr * (self.maxstep / norm.clamp(min=1e-30)).clamp(max=1)
+        self.positions = self.positions + dr
+
+
+###############################################################################
+# L-BFGS builds an approximation of the inverse hessian of each structure from
+# its last ``memory`` steps, with the two-loop recursion done for all
+# structures together. Steps with non-positive curvature are not used to update
+# the approximation. The parameters are the same as :class:`ase.optimize.LBFGS`,
+# except that the default memory is smaller, since the history of the whole
+# batch is kept.
+class LBFGS(Optimizer):
+    """Batched L-BFGS optimizer.
+
+    Arguments:
+        maxstep (float): the largest displacement of an atom in a step.
+        memory (int): the number of steps kept to approximate the inverse hessian.
+        damping (float): the step is multiplied by this factor.
+        alpha (float): the initial hessian is ``alpha`` times identity.
+
+    Other arguments are the same as :class:`Optimizer`.
+    """
+
+    _batch_attributes = Optimizer._batch_attributes + ('s', 'y', 'rho', 'previous_positions',
+                                                       'previous_forces')
+
+    def __init__(self, images: Sequence[ase.Atoms], func: Callable[..., Tensor], maxstep: float = 0.2,
+                 memory: int = 20, damping: float = 1.0, alpha: float = 70.0, **kwargs):
+        super().__init__(images, func, **kwargs)
+        self.maxstep = maxstep
+        self.damping = damping
+        self.alpha = alpha
+        batch_size, n = self.positions.shape
+        self.s = self.positions.new_zeros(batch_size, memory, n)
+        self.y = self.positions.new_zeros(batch_size, memory, n)
+        self.rho = self.positions.new_zeros(batch_size, memory)
+        self.previous_positions: Optional[Tensor] = None
+        self.previous_forces: Optional[Tensor] = None
+
+    def step(self, forces: Tensor):
+        if self.previous_positions is not None:
+            assert self.previous_forces is not None
+            s = self.positions - self.previous_positions
+            y = self.previous_forces - forces
+            ys = (y * s).sum(-1)
+            rho = torch.where(ys > 1e-10, 1 / ys.clamp(min=1e-10), torch.zeros_like(ys))
+            self.s = torch.cat([self.s[:, 1:], s.unsqueeze(1)], 1)
+            self.y = torch.cat([self.y[:, 1:], y.unsqueeze(1)], 1)
+            self.rho = torch.cat([self.rho[:, 1:], rho.unsqueeze(1)], 1)
+
+        memory = self.rho.shape[1]
+        q = -forces
+        alphas = []
+        for i in reversed(range(memory)):
+            alpha = self.rho[:, i] * (self.s[:, i] * q).sum(-1)
+            q = q - alpha.unsqueeze(-1) * self.y[:, i]
+            alphas.append(alpha)
+        z = q / self.alpha
+        for i, alpha in zip(range(memory), reversed(alphas)):
+            beta = self.rho[:, i] * (self.y[:, i] * z).sum(-1)
+            z = z + self.s[:, i] * (alpha - beta).unsqueeze(-1)
+
+        dr = -z
+        longest = dr.reshape(dr.shape[0], -1, 3).norm(2, -1).max(-1, keepdim=True).values
+        dr = dr * (self.maxstep / longest.clamp(min=1e-30)).clamp(max=1) * self.damping
+        self.previous_positions = self.positions
+        self.previous_forces = forces
+        self.positions = self.positions + dr
+
+
+###############################################################################
+# Nudged Elastic Band
+# -------------------
+#
+# The nudged elastic band method of `Henkelman et al.`_ finds the minimum
+# energy path between two states by relaxing a chain of images between them,
+# connected by springs. Instead of one potential call per image, all the
+# interior images of a band are evaluated together in one call of the batched
+# potential, with one backward pass for their forces. The tangents, springs and
+# projections are then computed as tensor operations, with the improved tangents
+# of `Henkelman and Jónsson`_, the same as ``method='improvedtangent'`` of
+# :class:`ase.mep.NEB`. With ``climb``, the highest image climbs up to the
+# saddle point along the tangent and feels no spring force.
+#
+# A band is optimized as one structure made of all its interior images, so any
+# optimizer could be used: :class:`NEB` is combined with an optimizer by
+# inheritance, as in :class:`FIRENEB` and :class:`LBFGSNEB`. Several bands,
+# possibly of different numbers of atoms, could be optimized together, in which
+# case the images of all of them are evaluated in the same call, and each band
+# leaves the batch when it converges. Spring vectors between images follow the
+# minimum image convention in periodic directions. The cell must be the same
+# for all images of a band and is not relaxed.
+#
+# .. _Henkelman et al.:
+#   https://doi.org/10.1063/1.1329672
+#
+# .. _Henkelman and Jónsson:
+#   https://doi.org/10.1063/1.1323224
+class NEB(Optimizer):
+    """Batched nudged elastic band, to be combined with an optimizer.
+
+    Arguments:
+        bands (list of list of :class:`ase.Atoms`): the images of each band,
+            including the two fixed end points, or a single band. All bands
+            must have the same number of images. Interior images are updated
+            the same way as the structures of :class:`Optimizer`.
+        func (callable): the batched potential, see :class:`Optimizer`.
+        k (float): the spring constant, in eV/Angstrom^2.
+        climb (bool): whether the highest image climbs to the saddle point.
+
+    Other arguments are passed to the optimizer, except ``relax_cell``:
+    periodic images are supported, but variable-cell NEB, which would also need
+    springs and tangents for the cell degrees of freedom, is deliberately not
+    implemented, and ``relax_cell=True`` raises :class:`ValueError`.
+    """
+
+    _band_attributes: Tuple[str, ...] = ('slots', 'image_mask', 'end_points', 'end_energies')
+
+    def __init__(self, bands: Sequence[Sequence[ase.Atoms]], func: Callable[..., Tensor], k: float = 0.1,
+                 climb: bool = False, **kwargs):
+        if kwargs.get('relax_cell'):
+            raise ValueError('The cell could not be relaxed in a nudged elastic band')
+        if isinstance(bands[0], ase.Atoms):
+            bands = [bands]  # type: ignore
+        self.bands = [list(band) for band in bands]
+        num_images = len(self.bands[0])
+        if num_images < 3 or any(len(band) != num_images for band in self.bands):
+            raise ValueError('All bands must have the same number of images, at least 3')
+        for band in self.bands:
+            symbols = band[0].get_chemical_symbols()
+            if any(image.get_chemical_symbols() != symbols for image in band):
+                raise ValueError('All images of a band must have the same atoms')
+        self.k = k
+        self.climb = climb
+        combined = []
+        for band in self.bands:
+            structure = band[1].copy()
+            for image in band[2:-1]:
+                structure += image
+            combined.append(structure)
+        super().__init__(combined, func, **kwargs)
+        self.num_images = num_images - 2
+        self.image_atoms = max(len(band[0]) for band in self.bands)
+        device = self.positions.device
+
+        # index of each atom of each interior image in the band structure
+        sizes = torch.tensor([len(band[0]) for band in self.bands], device=device)
+        atom = torch.arange(self.image_atoms, device=device)
+        image_index = torch.arange(self.num_images, device=device).unsqueeze(-1)
+        self.image_mask = (atom < sizes.reshape(-1, 1, 1)).expand(-1, self.num_images, -1)
+        self.slots = torch.where(self.image_mask, image_index * sizes.reshape(-1, 1, 1) + atom, torch.zeros_like(atom))
+
+        end_points = np.zeros((len(self.bands), 2, self.image_atoms, 3))
+        for i, band in enumerate(self.bands):
+            end_points[i, 0, :len(band[0])] = band[0].get_positions()
+            end_points[i, 1, :len(band[0])] = band[-1].get_positions()
+        self.end_points = torch.tensor(end_points, dtype=self.positions.dtype, device=device)
+        end_mask = (atom < sizes.unsqueeze(-1)).unsqueeze(1).expand(-1, 2, -1)
+        end_energies, _ = self._evaluate_images(self.end_points, end_mask, self.index, False)
+        self.end_energies = end_energies.detach()
+
+    def _evaluate_images(self, coordinates: Tensor, mask: Tensor, index: Tensor,
+                         need_forces: bool = True) -> Tuple[Tensor, Optional[Tensor]]:
+        # evaluate images of shape (bands, images, atoms, 3) in one call
+        bands, images = coordinates.shape[:2]
+        coordinates = coordinates.flatten(0, 1).detach().requires_grad_(need_forces)
+        mask = mask.flatten(0, 1)
+        cell = self.cell.repeat_interleave(images, 0)
+        pbc_ = self.pbc.repeat_interleave(images, 0)
+        wrapped = pbc.batched_map2central(cell, coordinates, pbc_, mask)
+        symbols = [self.bands[i][0].get_chemical_symbols() for i in index.tolist() for _ in range(images)]
+        energies = self.func(symbols, wrapped, cell, pbc_, mask).reshape(bands * images, -1).sum(-1)
+        forces: Optional[Tensor] = None
+        if need_forces:
+            forces = derivatives(energies, coordinates).forces * mask.unsqueeze(-1)
+            forces = forces.reshape(bands, images, -1, 3)
+        return energies.detach().reshape(bands, images), forces
+
+    def _minimum_image(self, vectors: Tensor) -> Tensor:
+        cell = self.cell.unsqueeze(1)
+        fractional = vectors @ torch.inverse(cell)
+        fractional = fractional - fractional.round() * self.pbc.unsqueeze(1).unsqueeze(1)
+        return fractional @ cell
+
+    def evaluate(self) -> Tuple[Tensor, Tensor, Tensor, Optional[Tensor]]:
+        """Compute energies and forces of the interior images of the bands in
+        the batch, and the forces of the nudged elastic band."""
+        batch_size = self.positions.shape[0]
+        structure = self.positions[:, :3 * self.num_atoms].reshape(batch_size, self.num_atoms, 3)
+        slots = self.slots.flatten(1).unsqueeze(-1).expand(-1, -1, 3)
+        mask = self.image_mask.unsqueeze(-1)
+        coordinates = structure.gather(1, slots).reshape(mask.shape[:-1] + (3,))
+        coordinates = torch.where(mask, coordinates, torch.zeros_like(coordinates))
+        energy, forces = self._evaluate_images(coordinates, self.image_mask, self.index)
+        assert forces is not None
+
+        path = torch.cat([self.end_points[:, :1], coordinates, self.end_points[:, 1:]], 1)
+        energies = torch.cat([self.end_energies[:, :1], energy, self.end_energies[:, 1:]], 1)
+        springs = self._minimum_image(path[:, 1:] - path[:, :-1])
+        forward, backward = springs[:, 1:], springs[:, :-1]
+        e, e_forward, e_backward = energies[:, 1:-1], energies[:, 2:], energies[:, :-2]
+        up = (e_forward > e) & (e > e_backward)
+        down = (e_forward < e) & (e < e_backward)
+        delta_max = torch.max((e_forward - e).abs(), (e_backward - e).abs())
+        delta_min = torch.min((e_forward - e).abs(), (e_backward - e).abs())
+        higher_forward = (e_forward > e_backward).reshape(up.shape + (1, 1))
+        mixed = torch.where(
+            higher_forward,
+            forward * delta_max.reshape(up.shape + (1, 1)) + backward * delta_min.reshape(up.shape + (1, 1)),
+            forward * delta_min.reshape(up.shape + (1, 1)) + backward * delta_max.reshape(up.shape + (1, 1)))
+        tangents = torch.where(up.reshape(up.shape + (1, 1)), forward,
+                               torch.where(down.reshape(up.shape + (1, 1)), backward, mixed))
+        norm = tangents.flatten(2).norm(2, -1).reshape(up.shape + (1, 1))
+        tangents = tangents / torch.where(norm > 0, norm, torch.ones_like(norm))
+
+        parallel = (forces * tangents).sum((-1, -2), keepdim=True)
+        stretch = forward.flatten(2).norm(2, -1) - backward.flatten(2).norm(2, -1)
+        band_forces = forces - parallel * tangents + self.k * stretch.reshape(up.shape + (1, 1)) * tangents
+        if self.climb:
+            highest = e.argmax(-1, keepdim=True)
+            climbing = torch.arange(self.num_images, device=e.device) == highest
+            band_forces = torch.where(climbing.reshape(up.shape + (1, 1)), forces - 2 * parallel * tangents,
+                                      band_forces)
+
+        generalized = structure.new_zeros(batch_size, self.num_atoms, 3)
+        generalized = generalized.scatter_add(1, slots, (band_forces * mask).flatten(1, 2))
+        return energy, generalized.flatten(1), forces, None
+
+    def _write(self, rows: Tensor, energy: Tensor, forces: Tensor, stress: Optional[Tensor]):
+        batch_size = self.positions.shape[0]
+        structure = self.positions[:, :3 * self.num_atoms].reshape(batch_size, self.num_atoms, 3)
+        for row in rows.tolist():
+            band = self.bands[int(self.index[row])]
+            n = len(band[0])
+            positions = structure[row, :n * self.num_images].reshape(self.num_images, n, 3)
+            for i, image in enumerate(band[1:-1]):
+                image.set_positions(positions[i].cpu().numpy())
+                image.calc = SinglePointCalculator(image, energy=energy[row, i].item(),
+                                                   forces=forces[row, i, :n].detach().cpu().numpy())
+
+
+class FIRENEB(NEB, FIRE):
+    """Nudged elastic band optimized by :class:`FIRE`.
+
+    Arguments are those of :class:`NEB` and :class:`FIRE`.
+    """
+
+    _batch_attributes = FIRE._batch_attributes + NEB._band_attributes
+
+
+class LBFGSNEB(NEB, LBFGS):
+    """Nudged elastic band optimized by :class:`LBFGS`.
+
+    Arguments are those of :class:`NEB` and :class:`LBFGS`.
+    """
+
+    _batch_attributes = LBFGS._batch_attributes + NEB._band_attributes
@@ -6,8 +6,11 @@ The module ``nnp.pbc`` contains tools to deal with periodic boundary conditions.
 """
 ###############################################################################
 # Let's first import all the packages we will use:
+import math
+import time
 import torch
 from torch import Tensor
+from typing import List, Optional, Tuple
 
 
 ###############################################################################
@@ -41,7 +44,7 @@ def num_repeats(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
     return torch.where(pbc, result, torch.tensor(0))
 
 
-def map2central(cell: Tensor, coordinates: Tensor, pbc: Tensor) -> Tensor:
+def map2central(cell: Tensor, coordinates: Tensor, pbc: Tensor, inv_cell: Optional[Tensor] = None) -> Tensor:
     """Map atoms outside the unit cell into the cell using PBC.
 
     Arguments:
@@ -55,16 +58,655 @@ def map2central(cell: Tensor, coordinates: Tensor, pbc: Tensor) -> Tensor:
 
         coordinates: Tensor of shape ``(atoms, 3)`` or ``(molecules, atoms, 3)``.
         pbc: boolean vector of size 3 storing if pbc is enabled for that direction.
+        inv_cell: optional precomputed inverse of ``cell``.
 
     Returns:
         coordinates of atoms mapped back to unit cell.
     """
     # Step 1: convert coordinates from standard cartesian coordinate to unit
     # cell coordinates
-    inv_cell = torch.inverse(cell)
+    if inv_cell is None:
+        inv_cell = torch.inverse(cell)
     coordinates_cell = coordinates @ inv_cell
     # Step 2: wrap cell coordinates into [0, 1)
     coordinates_cell -= coordinates_cell.floor() * pbc.to(coordinates_cell.dtype)
     # Step 3: convert from cell coordinates back to standard cartesian
     # coordinate
     return coordinates_cell @ cell
+
+
+###############################################################################
+# When preprocessing a dataset, we often need to deal with a padded batch of
+# systems, each having its own cell and pbc flags. The following are the batched
+# versions of the above two functions. Cell vectors along directions without
+# PBC are usually not meaningful, for example ASE uses an all-zero cell for
+# molecules, so they are replaced by unit vectors to keep the inverse well
+# defined. Atoms are never shifted along these directions, so this does not
+# change any result.
+def _safe_cells(cell: Tensor, pbc: Tensor) -> Tensor:
+    eye = torch.eye(3, dtype=cell.dtype, device=cell.device)
+    return torch.where(pbc.unsqueeze(-1), cell, eye)
+
+
+def batched_num_repeats(cell: Tensor, pbc: Tensor, cutoff: float) -> Tensor:
+    """Batched version of :func:`num_repeats`.
+
+    Arguments:
+        cell: tensor of shape ``(molecules, 3, 3)`` of the unit cells.
+        pbc: boolean tensor of shape ``(molecules, 3)``.
+        cutoff: the cutoff inside which atoms are considered as pairs
+
+    Returns:
+        long tensor of shape ``(molecules, 3)`` of the numbers of repeats
+        of each system.
+    """
+    reciprocal_cell = _safe_cells(cell, pbc).inverse().transpose(-1, -2)
+    inv_distances = reciprocal_cell.norm(2, -1)
+    result = torch.ceil(cutoff * inv_distances).to(torch.long)
+    return torch.where(pbc, result, torch.zeros_like(result))
+
+
+def batched_map2central(cell: Tensor, coordinates: Tensor, pbc: Tensor,
+                        mask: Optional[Tensor] = None) -> Tensor:
+    """Batched version of :func:`map2central`.
+
+    Arguments:
+        cell: tensor of shape ``(molecules, 3, 3)`` of the unit cells.
+        coordinates: Tensor of shape ``(molecules, atoms, 3)``.
+        pbc: boolean tensor of shape ``(molecules, 3)``.
+        mask: optional boolean tensor of shape ``(molecules, atoms)`` that is
+            ``True`` for real atoms and ``False`` for padding. Coordinates of
+            padding atoms are returned unchanged.
+
+    Returns:
+        coordinates of atoms mapped back to their unit cells.
+    """
+    cell = _safe_cells(cell, pbc)
+    inv_cell = torch.inverse(cell)
+    coordinates_cell = coordinates @ inv_cell
+    wrap = pbc.unsqueeze(-2)
+    if mask is not None:
+        wrap = wrap & mask.unsqueeze(-1)
+    coordinates_cell = coordinates_cell - coordinates_cell.floor() * wrap.to(coordinates_cell.dtype)
+    result = coordinates_cell @ cell
+    if mask is not None:
+        result = torch.where(mask.unsqueeze(-1), result, coordinates)
+    return result
+
+
+###############################################################################
+# With the above two functions, we are ready to find all pairs of atoms within
+# the cutoff radius. Tiling the cell by ``num_repeats`` and computing all the
+# distances is :math:`O(N^2)`, which is too slow for large systems. Instead,
+# we use a cell list: the (wrapped) fractional coordinates are binned into a
+# grid of small bins, each of which is no thinner than the cutoff along any
+# cell vector, unless the cell itself is too thin. Neighbors of an atom can then
+# only live in the bins within a small stencil around its own bin, so the total
+# cost is :math:`O(N)` at constant density.
+#
+# The number of bins of the stencil along each direction is just the number of
+# repeats required for the cell of a single bin, so we can reuse ``num_repeats``
+# for it. For directions without PBC, atoms are not wrapped and the grid only
+# spans the range of the atoms.
+#
+# The search itself is done on detached tensors, and only integer indices and
+# shifts are returned. Displacement vectors computed from these indices are
+# therefore differentiable with respect to both coordinates and cell.
+#
+# For terms that are symmetric with respect to the two atoms of a pair, storing
+# both ``i -> j`` and ``j -> i`` doubles the work. A half list stores each pair
+# only once: the one with ``i < j``, or when an atom pairs with its own image,
+# the one whose shift has its first nonzero component positive.
+def _is_half(atom: Tensor, other: Tensor, shifts: Tensor) -> Tensor:
+    s0, s1, s2 = shifts.unbind(-1)
+    positive = (s0 > 0) | ((s0 == 0) & ((s1 > 0) | ((s1 == 0) & (s2 > 0))))
+    return (atom < other) | ((atom == other) & positive)
+
+
+def neighbor_pairs(cell: Tensor, coordinates: Tensor, pbc: Tensor, cutoff: float,
+                   half: bool = False) -> Tuple[Tensor, Tensor]:
+    """Compute pairs of atoms that are within the cutoff using a cell list.
+
+    Arguments:
+        cell: tensor of shape ``(3, 3)`` of the three vectors defining unit cell:
+
+            .. code-block:: python
+
+                tensor([[x1, y1, z1],
+                        [x2, y2, z2],
+                        [x3, y3, z3]])
+
+            Vectors along directions without PBC are not used, so they could
+            be zero, like the cell of a molecule in ASE.
+        coordinates: Tensor of shape ``(atoms, 3)``. Coordinates do not need to
+            be wrapped into the unit cell.
+        pbc: boolean vector of size 3 storing if pbc is enabled for that direction.
+        cutoff: the cutoff inside which atoms are considered as pairs
+        half: whether to return a half list, where each pair is stored once.
+
+    Returns:
+        A tuple ``(atom_index12, shifts)`` where ``atom_index12`` is a long tensor
+        of shape ``(2, pairs)`` and ``shifts`` is a long tensor of shape
+        ``(pairs, 3)``. Unless ``half`` is true, both directions ``i -> j`` and
+        ``j -> i`` of each pair are included. The displacement vector of each pair is
+        ``coordinates[j] - coordinates[i] + shifts @ cell``, see :func:`displacements`.
+    """
+    device = coordinates.device
+    cell = _safe_cells(cell.detach(), pbc)
+    coordinates = coordinates.detach()
+    num_atoms = coordinates.shape[0]
+
+    # Step 1: convert to fractional coordinates and wrap directions with PBC
+    # into [0, 1), remembering which image each atom comes from
+    fractional = coordinates @ torch.inverse(cell)
+    images = torch.where(pbc, fractional.floor(), torch.zeros_like(fractional))
+    fractional = fractional - images
+
+    # Step 2: decide the size of the grid. Directions with PBC are binned over
+    # [0, 1), directions without PBC are binned over the range of the atoms.
+    zeros = torch.zeros(3, dtype=fractional.dtype, device=device)
+    ones = torch.ones(3, dtype=fractional.dtype, device=device)
+    if num_atoms > 0:
+        lower = torch.where(pbc, zeros, fractional.min(0).values)
+        span = fractional.max(0).values - lower
+        span = torch.where(pbc | (span <= 0), ones, span)
+    else:
+        lower = zeros
+        span = ones
+    heights = 1 / torch.inverse(cell).t().norm(2, -1)
+    num_bins = torch.clamp(torch.floor(span * heights / cutoff), min=1).to(torch.long)
+    bin_cell = cell * (span / num_bins.to(span.dtype)).unsqueeze(-1)
+    stencil = num_repeats(bin_cell, torch.ones_like(pbc), cutoff)
+    stencil = torch.where(pbc, stencil, torch.min(stencil, num_bins - 1))
+
+    # Step 3: put atoms into bins, sort atoms by their bins and find where
+    # each bin starts in the sorted list
+    bin_index3 = torch.floor((fractional - lower) / span * num_bins.to(span.dtype)).to(torch.long)
+    bin_index3 = torch.min(bin_index3.clamp(min=0), num_bins - 1)
+    strides = torch.stack([num_bins[1] * num_bins[2], num_bins[2], torch.ones_like(num_bins[2])])
+    bin_index = (bin_index3 * strides).sum(-1)
+    total_bins = int(num_bins.prod().item())
+    counts = torch.bincount(bin_index, minlength=total_bins)
+    order = torch.argsort(bin_index)
+    starts = counts.cumsum(0) - counts
+
+    # Step 4: for each atom, look up all atoms in the bins of the stencil.
+    # This is done in chunks of atoms to bound the size of temporary tensors.
+    r0 = torch.arange(-int(stencil[0].item()), int(stencil[0].item()) + 1, device=device)
+    r1 = torch.arange(-int(stencil[1].item()), int(stencil[1].item()) + 1, device=device)
+    r2 = torch.arange(-int(stencil[2].item()), int(stencil[2].item()) + 1, device=device)
+    grid = torch.meshgrid([r0, r1, r2], indexing='ij')
+    offsets = torch.stack([grid[0].flatten(), grid[1].flatten(), grid[2].flatten()], dim=1)
+    num_offsets = offsets.shape[0]
+    wrapped = fractional @ cell
+    images_ = images.to(torch.long)
+    chunk_size = max(1, 262144 // num_offsets)
+    atoms_list: List[Tensor] = []
+    others_list: List[Tensor] = []
+    shifts_list: List[Tensor] = []
+    for start in range(0, num_atoms, chunk_size):
+        end = min(start + chunk_size, num_atoms)
+        neighbor_bin3 = bin_index3[start:end].unsqueeze(1) + offsets
+        bin_shifts = torch.div(neighbor_bin3, num_bins, rounding_mode='floor')
+        bin_shifts = torch.where(pbc, bin_shifts, torch.zeros_like(bin_shifts))
+        neighbor_bin3 = neighbor_bin3 - bin_shifts * num_bins
+        in_range = ((neighbor_bin3 >= 0) & (neighbor_bin3 < num_bins)).all(-1)
+        neighbor_bin = (torch.min(neighbor_bin3.clamp(min=0), num_bins - 1) * strides).sum(-1).flatten()
+        neighbor_counts = counts[neighbor_bin] * in_range.flatten().to(torch.long)
+        owner = torch.repeat_interleave(neighbor_counts)
+        first = neighbor_counts.cumsum(0) - neighbor_counts
+        position = torch.arange(owner.shape[0], device=device) - first[owner]
+        other = order[starts[neighbor_bin[owner]] + position]
+
+        # Step 5: remove pairs outside the cutoff and self interaction, and for
+        # half lists, pairs in the other direction. Shifts only matter for pairs
+        # of an atom with its own image, for which wrapping does not change them.
+        if half:
+            atom = torch.div(owner, num_offsets, rounding_mode='floor') + start
+            selected = _is_half(atom, other, bin_shifts.flatten(0, 1)[owner]).nonzero().squeeze(-1)
+            owner = owner[selected]
+            other = other[selected]
+        origins = (bin_shifts.to(cell.dtype) @ cell - wrapped[start:end].unsqueeze(1)).flatten(0, 1)
+        vectors = wrapped[other] + origins[owner]
+        inside = ((vectors * vectors).sum(-1) <= cutoff * cutoff).nonzero().squeeze(-1)
+        owner = owner[inside]
+        other = other[inside]
+        atom = torch.div(owner, num_offsets, rounding_mode='floor') + start
+        shifts = bin_shifts.flatten(0, 1)[owner]
+        keep = (atom != other) | (shifts != 0).any(-1)
+        atoms_list.append(atom[keep])
+        others_list.append(other[keep])
+        shifts_list.append(shifts[keep])
+    if num_atoms == 0:
+        atoms_list.append(torch.zeros(0, dtype=torch.long, device=device))
+        others_list.append(torch.zeros(0, dtype=torch.long, device=device))
+        shifts_list.append(torch.zeros(0, 3, dtype=torch.long, device=device))
+    atom = torch.cat(atoms_list)
+    other = torch.cat(others_list)
+    shifts = torch.cat(shifts_list)
+
+    # Step 6: convert shifts between wrapped coordinates into shifts between
+    # the input coordinates
+    shifts = shifts + images_[atom] - images_[other]
+    return torch.stack([atom, other]), shifts
+
+
+def displacements(cell: Tensor, coordinates: Tensor, atom_index12: Tensor, shifts: Tensor) -> Tensor:
+    """Compute the displacement vectors of pairs returned by :func:`neighbor_pairs`.
+
+    Arguments:
+        cell: tensor of shape ``(3, 3)`` of the three vectors defining unit cell.
+        coordinates: Tensor of shape ``(atoms, 3)``.
+        atom_index12: long tensor of shape ``(2, pairs)``.
+        shifts: long tensor of shape ``(pairs, 3)``.
+
+    Returns:
+        Tensor of shape ``(pairs, 3)`` of vectors pointing from the first atom
+        of each pair to the second atom.
+    """
+    return coordinates.index_select(0, atom_index12[1]) - coordinates.index_select(0, atom_index12[0]) \
+        + shifts.to(cell.dtype) @ cell
+
+
+###############################################################################
+# Pair lists of large periodic systems could take a lot of memory, so we store
+# them in a compact format: the indices of the two atoms of each pair in a
+# ``(2, pairs)`` int32 tensor, and the shifts as multiples of the cell vectors
+# in a ``(pairs, 3)`` int8 tensor. The displacement vectors and distances are
+# only computed when they are first needed, and then cached so that several
+# terms of a model could share them. Pair lists could be sliced, for example
+# to get pairs within a smaller cutoff, without recomputing the distances.
+#
+# Per-pair terms are reduced to per-atom or per-molecule terms using
+# ``index_add``, so no dense ``(atoms, atoms)`` tensor is ever built. For half
+# lists, the term of each pair is added to both atoms, with the sign flipped
+# for the second atom if the term is antisymmetric, like a pair force. The
+# result is then the same as reducing the full list, and since ``index_add`` is
+# differentiable, forces computed by autograd are exact.
+def segment_sum(values: Tensor, index: Tensor, num_segments: int) -> Tensor:
+    """Sum values that belong to the same segment.
+
+    Arguments:
+        values: Tensor of shape ``(items, ...)``.
+        index: integer tensor of shape ``(items,)`` storing which segment
+            each item belongs to.
+        num_segments: total number of segments.
+
+    Returns:
+        Tensor of shape ``(num_segments, ...)``.
+    """
+    result = values.new_zeros((num_segments,) + values.shape[1:])
+    return result.index_add(0, index, values)
+
+
+class PairList:
+    """Pairs of atoms stored in a compact format.
+
+    Arguments:
+        atom_index12: integer tensor of shape ``(2, pairs)``, stored as int32.
+        shifts: integer tensor of shape ``(pairs, 3)``, stored as int8.
+        coordinates: Tensor of shape ``(atoms, 3)``.
+        cell: tensor of shape ``(3, 3)`` of the three vectors defining unit cell.
+        half: whether this is a half list, where each pair is stored once.
+
+    Displacement vectors ``coordinates[j] - coordinates[i] + shifts @ cell``
+    are differentiable with respect to ``coordinates`` and ``cell``.
+    """
+
+    def __init__(self, atom_index12: Tensor, shifts: Tensor, coordinates: Tensor, cell: Tensor,
+                 half: bool = False):
+        if shifts.dtype != torch.int8 and shifts.numel() > 0 and shifts.abs().max().item() > 127:
+            raise ValueError('Shifts are too large to be stored as int8')
+        self.atom_index12 = atom_index12.to(torch.int32)
+        self.shifts = shifts.to(torch.int8)
+        self.coordinates = coordinates
+        self.cell = cell
+        self.half = half
+        self._vectors: Optional[Tensor] = None
+        self._distances: Optional[Tensor] = None
+
+    def __len__(self) -> int:
+        return self.atom_index12.shape[1]
+
+    @property
+    def num_atoms(self) -> int:
+        return self.coordinates.shape[0]
+
+    @property
+    def vectors(self) -> Tensor:
+        """Displacement vectors of shape ``(pairs, 3)``, computed on first access."""
+        if self._vectors is None:
+            self._vectors = displacements(self.cell, self.coordinates, self.atom_index12, self.shifts)
+        return self._vectors
+
+    @property
+    def distances(self) -> Tensor:
+        """Distances of shape ``(pairs,)``, computed on first access."""
+        if self._distances is None:
+            self._distances = self.vectors.norm(2, -1)
+        return self._distances
+
+    def __getitem__(self, index) -> 'PairList':
+        """Select a subset of pairs by a slice, a boolean mask or indices.
+
+        Slicing returns views of the underlying tensors. Cached displacement
+        vectors and distances are carried over.
+        """
+        result = PairList.__new__(PairList)
+        result.atom_index12 = self.atom_index12[:, index]
+        result.shifts = self.shifts[index]
+        result.coordinates = self.coordinates
+        result.cell = self.cell
+        result.half = self.half
+        result._vectors = None if self._vectors is None else self._vectors[index]
+        result._distances = None if self._distances is None else self._distances[index]
+        return result
+
+    def filter(self, cutoff: float) -> 'PairList':
+        """Get pairs within a cutoff smaller than the one used to build the list."""
+        return self[self.distances <= cutoff]
+
+    def to_atoms(self, values: Tensor, antisymmetric: bool = False) -> Tensor:
+        """Sum per-pair values to the first atom of each pair.
+
+        For half lists, values are also added to the second atom of each pair,
+        so that the result is the same as for the full list.
+
+        Arguments:
+            values: Tensor of shape ``(pairs, ...)``.
+            antisymmetric: whether the value of ``j -> i`` is the negative of
+                the value of ``i -> j``. Only used for half lists.
+
+        Returns:
+            Tensor of shape ``(atoms, ...)``.
+        """
+        result = segment_sum(values, self.atom_index12[0], self.num_atoms)
+        if self.half:
+            result = result.index_add(0, self.atom_index12[1], -values if antisymmetric else values)
+        return result
+
+
+def neighbor_list(cell: Tensor, coordinates: Tensor, pbc: Tensor, cutoff: float,
+                  half: bool = False) -> PairList:
+    """Same as :func:`neighbor_pairs`, but returns a :class:`PairList`.
+
+    Arguments and the meaning of pairs are the same as :func:`neighbor_pairs`.
+    The returned pair list holds references to ``coordinates`` and ``cell``.
+    """
+    atom_index12, shifts = neighbor_pairs(cell, coordinates, pbc, cutoff, half)
+    return PairList(atom_index12, shifts, coordinates, cell, half)
+
+
+###############################################################################
+# In molecular dynamics, atoms barely move between steps, so rebuilding the pair
+# list at every step is a waste. A Verlet list finds pairs within a slightly
+# larger radius ``cutoff + skin``, and reuses this list until some atom has
+# moved more than half of the skin since the last build, at which point a pair
+# that was outside ``cutoff + skin`` could have come inside ``cutoff``.
+#
+# Atoms could be wrapped back into the central cell between steps, for example
+# by ``map2central``. Such jumps are not real displacements: we detect them as
+# integer changes of the fractional coordinates and fold them into the shifts
+# of the stored pairs.
+class VerletList:
+    """Neighbor list that is only rebuilt when atoms have moved far enough.
+
+    Arguments:
+        cutoff: the cutoff inside which atoms are considered as pairs
+        skin: the extra distance beyond the cutoff that pairs are searched
+            within. The list is rebuilt when the largest displacement of
+            atoms since the last build exceeds ``skin / 2``, or when the cell,
+            pbc or the number of atoms changes.
+        half: whether to store a half list, where each pair is stored once.
+
+    The number of calls, the number of rebuilds and the total wall time spent
+    in rebuilding are counted in attributes ``num_calls``, ``num_rebuilds``
+    and ``rebuild_time``.
+    """
+
+    def __init__(self, cutoff: float, skin: float = 1.0, half: bool = False):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.half = half
+        self.reset()
+
+    def reset(self):
+        """Drop the stored list and reset counters."""
+        self.num_calls = 0
+        self.num_rebuilds = 0
+        self.rebuild_time = 0.0
+        self.last_rebuild_time = 0.0
+        self._cell: Optional[Tensor] = None
+        self._pbc: Optional[Tensor] = None
+        self._coordinates: Optional[Tensor] = None
+        self._inv_cell: Optional[Tensor] = None
+        self._atom_index12: Optional[Tensor] = None
+        self._shifts: Optional[Tensor] = None
+
+    def _rebuild(self, cell: Tensor, coordinates: Tensor, pbc: Tensor):
+        start = time.perf_counter()
+        atom_index12, shifts = neighbor_pairs(cell, coordinates, pbc, self.cutoff + self.skin, self.half)
+        self._cell = cell.clone()
+        self._pbc = pbc.clone()
+        self._coordinates = coordinates.clone()
+        self._inv_cell = torch.inverse(_safe_cells(self._cell, pbc))
+        pairs = PairList(atom_index12, shifts, coordinates, cell)
+        self._atom_index12 = pairs.atom_index12
+        self._shifts = pairs.shifts
+        self.num_rebuilds += 1
+        self.last_rebuild_time = time.perf_counter() - start
+        self.rebuild_time += self.last_rebuild_time
+
+    def _update(self, cell: Tensor, coordinates: Tensor, pbc: Tensor):
+        if self._coordinates is None or self._cell is None or self._pbc is None \
+                or self._coordinates.shape != coordinates.shape \
+                or not torch.equal(self._cell, cell) or not torch.equal(self._pbc, pbc):
+            self._rebuild(cell, coordinates, pbc)
+            return
+        assert self._inv_cell is not None and self._atom_index12 is not None and self._shifts is not None
+        fractional_displacements = (coordinates - self._coordinates) @ self._inv_cell
+        jumps = torch.where(pbc, fractional_displacements.round(), torch.zeros_like(fractional_displacements))
+        real_displacements = (fractional_displacements - jumps) @ cell
+        if real_displacements.shape[0] > 0 and real_displacements.norm(2, -1).max().item() > self.skin / 2:
+            self._rebuild(cell, coordinates, pbc)
+            return
+        if jumps.any().item():
+            atom_index12 = self._atom_index12.to(torch.long)
+            long_jumps = jumps.to(torch.long)
+            shifts = self._shifts.to(torch.long) + long_jumps[atom_index12[0]] - long_jumps[atom_index12[1]]
+            self._shifts = PairList(self._atom_index12, shifts, coordinates, cell).shifts
+            self._coordinates = self._coordinates + jumps @ cell
+
+    def __call__(self, cell: Tensor, coordinates: Tensor, pbc: Tensor) -> PairList:
+        """Get pairs within ``cutoff + skin``, rebuilding the list if needed.
+
+        Arguments are the same as :func:`neighbor_pairs`. The returned
+        :class:`PairList` holds references to ``coordinates`` and ``cell``,
+        so use :meth:`PairList.filter` to get pairs within the cutoff.
+        """
+        self.num_calls += 1
+        self._update(cell.detach(), coordinates.detach(), pbc)
+        assert self._atom_index12 is not None and self._shifts is not None
+        return PairList(self._atom_index12, self._shifts, coordinates, cell, self.half)
+
+
+###############################################################################
+# Long Range Electrostatics
+# -------------------------
+#
+# The Coulomb interaction decays so slowly that summing it over images is
+# not practical. The Ewald method splits it into a short range part, which is
+# summed in real space using the pair list, and a smooth long range part, which
+# is summed in reciprocal space:
+#
+# .. math::
+#   E = \sum_{i<j} q_i q_j \frac{\mathrm{erfc}(\alpha r_{ij})}{r_{ij}}
+#     + \frac{1}{2\pi V} \sum_{\vec{m}\neq 0}
+#       \frac{\exp\left(-\pi^2 m^2 / \alpha^2\right)}{m^2}
+#       \left|S(\vec{m})\right|^2
+#     - \frac{\alpha}{\sqrt{\pi}} \sum_i q_i^2
+#     - \frac{\pi}{2 V \alpha^2} \left(\sum_i q_i\right)^2
+#
+# where the last term is the energy of a neutralizing background, which only
+# matters for charged systems. Smooth particle mesh Ewald (PME) approximates
+# the structure factor :math:`S(\vec{m})` by spreading charges onto a grid with
+# cardinal B-splines and doing a fast Fourier transform, so the total cost is
+# :math:`O(N\log N)`. See `Essmann et al., J. Chem. Phys. 103, 8577 (1995)`_.
+#
+# .. _Essmann et al., J. Chem. Phys. 103, 8577 (1995):
+#   https://doi.org/10.1063/1.470117
+#
+# Everything is written in terms of ``coordinates`` and ``cell``, so autograd
+# gives both forces and stress.
+#
+# The splitting parameter and grid size are chosen from the real space cutoff
+# and the requested relative accuracy, following the heuristics of OpenMM. Grid
+# sizes are rounded up to products of 2, 3 and 5, which FFT is fast with.
+def _fft_friendly(n: int) -> int:
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def pme_parameters(cell: Tensor, cutoff: float, accuracy: float = 5e-4) -> Tuple[float, List[int]]:
+    """Choose the splitting parameter and grid size of particle mesh Ewald.
+
+    Arguments:
+        cell: tensor of shape ``(3, 3)`` of the three vectors defining unit cell.
+        cutoff: the cutoff of the real space sum.
+        accuracy: the requested relative accuracy of forces.
+
+    Returns:
+        A tuple ``(alpha, grid)`` of the splitting parameter and the number of
+        grid points along each cell vector.
+    """
+    alpha = math.sqrt(-math.log(2 * accuracy)) / cutoff
+    lengths = cell.detach().norm(2, -1).tolist()
+    grid = [_fft_friendly(max(8, math.ceil(2 * alpha * length / (3 * accuracy ** 0.2)))) for length in lengths]
+    return alpha, grid
+
+
+###############################################################################
+# The weights of the B-splines of order :math:`n` are computed by the recursion
+#
+# .. math::
+#   M_n(x) = \frac{x M_{n-1}(x) + (n - x) M_{n-1}(x - 1)}{n - 1}
+#
+# starting from :math:`M_2(x) = 1 - |x - 1|`. For a charge at grid coordinate
+# :math:`u`, the weight on grid point :math:`\lfloor u \rfloor - j` is
+# :math:`M_n(u - \lfloor u \rfloor + j)` for :math:`j = 0, \ldots, n - 1`.
+def _bspline_weights(w: Tensor, order: int) -> Tensor:
+    zero = torch.zeros_like(w)
+    weights = [w, 1 - w] + [zero] * (order - 2)
+    for m in range(3, order + 1):
+        weights = [((w + j) * weights[j] + (m - w - j) * (weights[j - 1] if j > 0 else zero)) / (m - 1)
+                   for j in range(order)]
+    return torch.stack(weights, dim=-1)
+
+
+def _bspline_moduli(grid_size: int, order: int, dtype: torch.dtype, device: torch.device) -> Tensor:
+    knots = _bspline_weights(torch.zeros((), dtype=dtype, device=device), order)
+    m = torch.arange(grid_size, dtype=dtype, device=device)
+    k = torch.arange(order - 1, dtype=dtype, device=device)
+    phase = 2 * math.pi * m.unsqueeze(-1) * k / grid_size
+    # knots[j] = M_n(j), so M_n(k + 1) for k = 0, ..., n - 2 is knots[1:]
+    values = knots[1:]
+    real = (values * torch.cos(phase)).sum(-1)
+    imag = (values * torch.sin(phase)).sum(-1)
+    return 1 / (real * real + imag * imag)
+
+
+def _pme_reciprocal(charges: Tensor, coordinates: Tensor, cell: Tensor, alpha: float,
+                    grid: List[int], order: int) -> Tensor:
+    inv_cell = torch.inverse(cell)
+    fractional = coordinates @ inv_cell
+    fractional = fractional - fractional.detach().floor()
+    grid_sizes = torch.tensor(grid, dtype=fractional.dtype, device=fractional.device)
+    u = fractional * grid_sizes
+    base = u.detach().floor()
+    weights = _bspline_weights(u - base, order)  # (atoms, 3, order)
+    j = torch.arange(order, device=u.device)
+    points = (base.to(torch.long).unsqueeze(-1) - j) % grid_sizes.to(torch.long).unsqueeze(-1)
+
+    # spread charges onto the grid
+    K0, K1, K2 = grid
+    flat = (points[:, 0, :, None, None] * K1 + points[:, 1, None, :, None]) * K2 + points[:, 2, None, None, :]
+    values = charges[:, None, None, None] * weights[:, 0, :, None, None] \
+        * weights[:, 1, None, :, None] * weights[:, 2, None, None, :]
+    Q = coordinates.new_zeros(K0 * K1 * K2).index_add(0, flat.flatten(), values.flatten())
+    S = torch.fft.rfftn(Q.view(K0, K1, K2))
+    S2 = S.real * S.real + S.imag * S.imag
+
+    # the influence function
+    dtype = coordinates.dtype
+    device = coordinates.device
+    m0 = torch.fft.fftfreq(K0, 1.0 / K0, dtype=dtype, device=device)
+    m1 = torch.fft.fftfreq(K1, 1.0 / K1, dtype=dtype, device=device)
+    m2 = torch.fft.rfftfreq(K2, 1.0 / K2, dtype=dtype, device=device)
+    m = torch.stack(torch.meshgrid([m0, m1, m2], indexing='ij'), dim=-1)
+    m = m @ inv_cell.t()
+    m_squared = (m * m).sum(-1)
+    m_squared[0, 0, 0] = 1
+    moduli = _bspline_moduli(K0, order, dtype, device)[:, None, None] \
+        * _bspline_moduli(K1, order, dtype, device)[None, :, None] \
+        * _bspline_moduli(K2, order, dtype, device)[None, None, :m2.shape[0]]
+    influence = torch.exp(-(math.pi / alpha) ** 2 * m_squared) / m_squared * moduli
+    influence[0, 0, 0] = 0
+    # rfft only stores half of the last dimension, count the other half
+    multiplicity = torch.full((m2.shape[0],), 2, dtype=dtype, device=device)
+    multiplicity[0] = 1
+    if K2 % 2 == 0:
+        multiplicity[-1] = 1
+    volume = torch.det(cell).abs()
+    return (influence * multiplicity * S2).sum() / (2 * math.pi * volume)
+
+
+def pme_energy(charges: Tensor, coordinates: Tensor, cell: Tensor, pbc: Tensor, cutoff: float,
+               accuracy: float = 5e-4, order: int = 4, neighbors: Optional[PairList] = None,
+               coulomb_constant: float = 14.399645351950548) -> Tensor:
+    r"""Compute the electrostatic energy using smooth particle mesh Ewald.
+
+    Arguments:
+        charges: Tensor of shape ``(atoms,)`` of the charges of atoms.
+        coordinates: Tensor of shape ``(atoms, 3)``.
+        cell: tensor of shape ``(3, 3)`` of the three vectors defining unit cell.
+        pbc: boolean vector of size 3, must be all true.
+        cutoff: the cutoff of the real space sum.
+        accuracy: the requested relative accuracy, used to choose the splitting
+            parameter and grid size, see :func:`pme_parameters`.
+        order: the order of B-splines, must be even.
+        neighbors: optional :class:`PairList` with cutoff at least ``cutoff``,
+            for example the one given by :class:`nnp.md.Calculator`. If not
+            specified, pairs are searched with :func:`neighbor_list`.
+        coulomb_constant: :math:`\frac{1}{4\pi\epsilon_0}`, the default value
+            is in eV and Angstrom.
+
+    Returns:
+        The electrostatic energy as a scalar tensor, differentiable with respect
+        to ``charges``, ``coordinates`` and ``cell``.
+    """
+    if not pbc.all().item():
+        raise ValueError('Particle mesh Ewald requires PBC in all directions')
+    if order < 4 or order % 2 != 0:
+        raise ValueError('Order of B-splines must be an even number no less than 4')
+    alpha, grid = pme_parameters(cell, cutoff, accuracy)
+
+    if neighbors is None:
+        neighbors = neighbor_list(cell, coordinates, pbc, cutoff, half=True)
+    neighbors = neighbors.filter(cutoff)
+    index12 = neighbors.atom_index12
+    distances = neighbors.distances
+    real = (charges[index12[0]] * charges[index12[1]] * torch.erfc(alpha * distances) / distances).sum()
+    if not neighbors.half:
+        real = real / 2
+
+    reciprocal = _pme_reciprocal(charges, coordinates, cell, alpha, grid, order)
+    self_energy = -alpha / math.sqrt(math.pi) * (charges * charges).sum()
+    volume = torch.det(cell).abs()
+    background = -math.pi / (2 * volume * alpha ** 2) * charges.sum() ** 2
+    return coulomb_constant * (real + reciprocal + self_energy + background)
@@ -0,0 +1,162 @@
+"""
+Profiling
+=========
+
+The module ``nnp.profiling`` contains tools to find out where the time of a
+calculation goes.
+"""
+
+import time
+import contextlib
+import functools
+import torch
+from torch import Tensor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+
+###############################################################################
+# A :class:`Profiler` records, for each named phase of a calculation, the number
+# of calls, the total wall time, the number of bytes of the tensors it outputs,
+# and the number of nodes in the autograd graph. It could also count arbitrary
+# events, like cache hits. The output bytes are not the memory allocated by a
+# phase, since intermediate tensors are not counted; use :mod:`torch.profiler`
+# with ``profile_memory=True`` for that. :class:`nnp.md.Calculator` takes a profiler and
+# records its phases: converting positions to tensors, wrapping atoms into the
+# central box, the potential itself, the backward pass for forces and stress,
+# and converting the results back to NumPy. Other functions, for example
+# ``nnp.vib.hessian``, could be profiled as a whole with :meth:`Profiler.wrap`.
+# This keeps them scriptable, since TorchScript could not call a profiler.
+#
+# Profiling is opt-in: a disabled profiler does nothing, so calculators always
+# have one and the cost is negligible. When ``record_functions`` is set, phases
+# also show up as ranges named ``nnp::<phase>`` in :mod:`torch.profiler`.
+# Operations on GPUs are asynchronous, so ``synchronize`` should be set to get
+# meaningful times on GPUs.
+_disabled = contextlib.nullcontext()
+
+
+def graph_size(tensor: Tensor) -> int:
+    """Count the nodes of the autograd graph that computes ``tensor``."""
+    if tensor.grad_fn is None:
+        return 0
+    seen: Set[Any] = set()
+    stack: List[Any] = [tensor.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        stack.extend(next_node for next_node, _ in node.next_functions)
+    return len(seen)
+
+
+def _tensors(value):
+    if isinstance(value, Tensor):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            yield from _tensors(v)
+
+
+class Profiler:
+    """Record wall time, calls, output sizes and graph sizes of phases.
+
+    Arguments:
+        enabled (bool): whether to record anything.
+        record_functions (bool): whether to also create
+            :func:`torch.profiler.record_function` ranges for phases.
+        synchronize (bool): whether to synchronize CUDA before and after
+            each phase.
+    """
+
+    def __init__(self, enabled: bool = True, record_functions: bool = False, synchronize: bool = False):
+        self.enabled = enabled
+        self.record_functions = record_functions
+        self.synchronize = synchronize
+        self.reset()
+
+    def reset(self):
+        """Clear all the records."""
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def _record(self, name: str) -> Dict[str, float]:
+        if name not in self.phases:
+            self.phases[name] = {'calls': 0, 'time': 0.0, 'output_bytes': 0, 'graph_size': 0}
+        return self.phases[name]
+
+    def phase(self, name: str):
+        """Context manager that times a phase."""
+        if not self.enabled:
+            return _disabled
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name: str):
+        record_function = torch.profiler.record_function('nnp::' + name) \
+            if self.record_functions else _disabled
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with record_function:
+            yield
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        record = self._record(name)
+        record['calls'] += 1
+        record['time'] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        """Increase the counter ``name`` by ``n``."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def outputs(self, name: str, *tensors: Tensor):
+        """Record the bytes of tensors output by a phase."""
+        if self.enabled:
+            self._record(name)['output_bytes'] += sum(t.element_size() * t.nelement() for t in tensors)
+
+    def graph(self, name: str, tensor: Tensor):
+        """Record the size of the autograd graph of a tensor created by a phase."""
+        if self.enabled:
+            self._record(name)['graph_size'] += graph_size(tensor)
+
+    def wrap(self, function: Callable, name: Optional[str] = None) -> Callable:
+        """Profile each call of a function as a phase, default to its name.
+
+        Tensors in the returned value are recorded as outputs of the phase.
+        """
+        phase = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.phase(phase):
+                result = function(*args, **kwargs)
+            self.outputs(phase, *_tensors(result))
+            return result
+        return wrapper
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return the records of phases, with the time per call and the
+        fraction of the total time, together with the counters."""
+        total = sum(r['time'] for r in self.phases.values()) or 1.0
+        summary: Dict[str, Dict[str, float]] = {}
+        for name, record in self.phases.items():
+            summary[name] = dict(record, time_per_call=record['time'] / max(record['calls'], 1),
+                                 fraction=record['time'] / total)
+        for name, value in self.counters.items():
+            summary[name] = {'count': value}
+        return summary
+
+    def __str__(self) -> str:
+        lines = ['{:<16}{:>8}{:>12}{:>12}{:>8}{:>14}{:>12}'.format(
+            'phase', 'calls', 'time (s)', 'per call', '%', 'output bytes', 'graph size')]
+        for name, r in self.summary().items():
+            if 'count' in r:
+                continue
+            lines.append('{:<16}{:>8}{:>12.4g}{:>12.4g}{:>8.1f}{:>14}{:>12}'.format(
+                name, int(r['calls']), r['time'], r['time_per_call'], 100 * r['fraction'],
+                int(r['output_bytes']), int(r['graph_size'])))
+        for name, value in self.counters.items():
+            lines.append('{:<16}{:>8}'.format(name, value))
+        return '\n'.join(lines)
@@ -7,9 +7,11 @@ and do vibrational analysis.
 """
 ###############################################################################
 # Let's first import all the packages we will use:
+import functools
+import concurrent.futures
 import torch
 from torch import Tensor
-from typing import NamedTuple, Optional
+from typing import Callable, List, NamedTuple, Optional
 
 
 ###############################################################################
@@ -32,8 +34,53 @@ def _get_derivatives_not_none(x: Tensor, y: Tensor, retain_graph: Optional[bool]
     return ret
 
 
+###############################################################################
+# Computing the hessian row by row takes one backward pass of the graph of the
+# forces per coordinate, each launched from Python. For molecules of hundreds
+# of atoms, this overhead dominates. Autograd could instead compute many rows
+# in one call, by batching the vectors of vector-Jacobian products with
+# ``is_grads_batched``, which uses ``vmap`` underneath. All rows at once could
+# use a lot of memory for large molecules, so ``chunk_size`` rows are computed
+# at a time. This is opt-in with ``vectorize``: operations without batching
+# rules, like custom autograd functions leaving PyTorch, could not be batched.
+# When batching fails, rows are computed one by one instead. TorchScript does
+# not support batched gradients, so scripted functions always compute rows one
+# by one.
+@torch.jit.unused
+def _batched_vjps(outputs: Tensor, inputs: Tensor, vectors: Tensor, chunk_size: Optional[int]) -> Tensor:
+    # vector-Jacobian products of outputs with each of vectors, chunk by chunk
+    chunk_size = chunk_size or vectors.shape[0]
+    products = []
+    for start in range(0, vectors.shape[0], chunk_size):
+        grad_outputs = vectors[start:start + chunk_size]
+        products.append(torch.autograd.grad([outputs], [inputs], [grad_outputs], retain_graph=True,
+                                            is_grads_batched=True)[0])
+    return torch.cat(products)
+
+
+@torch.jit.unused
+def _batched_rows(coordinates: Tensor, forces: Tensor, chunk_size: Optional[int]) -> Tensor:
+    flattened_force = forces.flatten(start_dim=-2)
+    n = flattened_force.shape[-1]
+    basis = torch.eye(n, dtype=flattened_force.dtype, device=flattened_force.device)
+    basis = basis.reshape((n,) + (1,) * (flattened_force.dim() - 1) + (n,))
+    basis = basis.expand((n,) + flattened_force.shape)
+    rows = _batched_vjps(flattened_force, coordinates, basis, chunk_size)
+    return rows.flatten(start_dim=-2).movedim(0, -1)
+
+
+@torch.jit.unused
+def _try_batched_rows(coordinates: Tensor, forces: Tensor, chunk_size: Optional[int]) -> Optional[Tensor]:
+    # None if the graph could not be batched by vmap
+    try:
+        return _batched_rows(coordinates, forces, chunk_size)
+    except RuntimeError:
+        return None
+
+
 def hessian(coordinates: Tensor, energies: Optional[Tensor] = None,
-            forces: Optional[Tensor] = None) -> Tensor:
+            forces: Optional[Tensor] = None, vectorize: bool = False,
+            chunk_size: Optional[int] = 64, mask: Optional[Tensor] = None) -> Tensor:
     """Compute analytical hessian from the energy graph or force graph.
 
     Arguments:
@@ -44,6 +91,14 @@ def hessian(coordinates: Tensor, energies: Optional[Tensor] = None,
         forces: Tensor of shape `(molecules, atoms, 3)` or `(atoms, 3)`,
             if specified, then `energies` must be `None`. This forces must
             be computed from `coordinates` in a graph.
+        vectorize: whether to compute many rows of the hessian in one
+            backward pass, falling back to one row per backward pass if the
+            graph could not be batched. Ignored in TorchScript.
+        chunk_size: the number of rows computed in one backward pass when
+            vectorized, or `None` for all rows at once.
+        mask: optional boolean Tensor of shape `(molecules, atoms)` or
+            `(atoms,)` that is `False` for padding atoms, whose rows and
+            columns of the hessian are zero.
 
     Returns:
         Tensor of shape `(molecules, 3 * atoms, 3 * atoms)` or `(3 * atoms, 3 * atoms)`
@@ -55,12 +110,183 @@ def hessian(coordinates: Tensor, energies: Optional[Tensor] = None,
     if forces is None:
         assert energies is not None
         forces = -_get_derivatives_not_none(coordinates, energies, create_graph=True)
-    flattened_force = forces.flatten(start_dim=-2)
-    force_components = flattened_force.unbind(dim=-1)
-    return -torch.stack([
-        _get_derivatives_not_none(coordinates, f, retain_graph=True).flatten(start_dim=-2)
-        for f in force_components
-    ], dim=-1)
+    if mask is not None:
+        forces = forces * mask.unsqueeze(-1).to(forces.dtype)
+    rows: Optional[Tensor] = None
+    if vectorize and not torch.jit.is_scripting():
+        rows = _try_batched_rows(coordinates, forces, chunk_size)
+    if rows is not None:
+        result = -rows
+    else:
+        flattened_force = forces.flatten(start_dim=-2)
+        force_components = flattened_force.unbind(dim=-1)
+        result = -torch.stack([
+            _get_derivatives_not_none(coordinates, f, retain_graph=True).flatten(start_dim=-2)
+            for f in force_components
+        ], dim=-1)
+    if mask is not None:
+        coordinate_mask = mask.repeat_interleave(3, dim=-1).to(result.dtype)
+        result = result * coordinate_mask.unsqueeze(-1) * coordinate_mask.unsqueeze(-2)
+    return result
+
+
+###############################################################################
+# For potentials with a cutoff, most blocks of the hessian of a large system
+# are zero: the block of atoms :math:`i` and :math:`j` could only be nonzero if
+# they interact. If atoms are colored so that any two atoms of the same color
+# do not interact with each other nor with a common atom, then one
+# hessian-vector product with the vector that displaces all atoms of a color
+# along the same direction recovers a column of each nonzero block of these
+# atoms: any atom interacts with at most one of them. The number of colors
+# only depends on the number of neighbors of each atom, not on the size of the
+# system, so :math:`3` times the number of colors hessian-vector products give
+# the whole hessian. Atoms are colored greedily, using the pattern of atoms
+# within two interactions, and the hessian is returned as a block sparse row
+# tensor of :math:`3\times3` blocks.
+#
+# Which atoms interact is given by pairs of atoms, for example from
+# :func:`nnp.pbc.neighbor_pairs`. For a pair potential, these are the pairs
+# within the cutoff. For a many-body potential, where the energy of an atom
+# depends on all its neighbors, these must be the pairs within twice the cutoff.
+def color_atoms(atom_index12: Tensor, num_atoms: int) -> Tensor:
+    """Color atoms so that atoms of the same color are not paired, and are not
+    paired with a common atom.
+
+    Arguments:
+        atom_index12: Tensor of shape `(2, pairs)`, each pair could be given in
+            one or both orders.
+        num_atoms: the number of atoms.
+
+    Returns:
+        Tensor of shape `(atoms,)` of the color of each atom, from 0.
+    """
+    atom_index12 = atom_index12.detach().long().cpu()
+    diagonal = torch.arange(num_atoms).expand(2, -1)
+    pairs = torch.cat([atom_index12, atom_index12.flip(0), diagonal], dim=1)
+    pairs = torch.unique(pairs[0] * num_atoms + pairs[1])
+    atom1, atom2 = pairs // num_atoms, pairs % num_atoms
+    pointers = torch.searchsorted(atom1, torch.arange(num_atoms + 1))
+    # pairs within two interactions, through each atom paired with the first
+    counts = (pointers[1:] - pointers[:-1])[atom2]
+    offsets = torch.arange(int(counts.sum())) - (counts.cumsum(0) - counts).repeat_interleave(counts)
+    atom3 = atom2[pointers[:-1][atom2].repeat_interleave(counts) + offsets]
+    within_two = torch.unique(atom1.repeat_interleave(counts) * num_atoms + atom3)
+    bounds = torch.searchsorted(within_two // num_atoms, torch.arange(num_atoms + 1)).tolist()
+    others = (within_two % num_atoms).tolist()
+    colors = [-1] * num_atoms
+    for atom in range(num_atoms):
+        used = {colors[other] for other in others[bounds[atom]:bounds[atom + 1]]}
+        color = 0
+        while color in used:
+            color += 1
+        colors[atom] = color
+    return torch.tensor(colors)
+
+
+def sparse_hessian(coordinates: Tensor, atom_index12: Tensor, energies: Optional[Tensor] = None,
+                   forces: Optional[Tensor] = None, chunk_size: Optional[int] = 64) -> Tensor:
+    """Compute analytical hessian as a sparse tensor from hessian-vector products.
+
+    Arguments:
+        coordinates: Tensor of shape `(atoms, 3)`
+        atom_index12: Tensor of shape `(2, pairs)` of the pairs of atoms that
+            interact, see above.
+        energies: scalar, or Tensor of shape `(atoms,)`, if specified, then
+            `forces` must be `None`. This energies must be computed from
+            `coordinates` in a graph.
+        forces: Tensor of shape `(atoms, 3)`, if specified, then `energies`
+            must be `None`. This forces must be computed from `coordinates`
+            in a graph.
+        chunk_size: the number of hessian-vector products computed in one
+            backward pass, or `None` for all of them at once.
+
+    Returns:
+        Block sparse row tensor of shape `(3 * atoms, 3 * atoms)` with blocks
+        of shape `(3, 3)`.
+    """
+    if energies is None and forces is None:
+        raise ValueError('Energies or forces must be specified')
+    if energies is not None and forces is not None:
+        raise ValueError('Energies or forces can not be specified at the same time')
+    if forces is None:
+        assert energies is not None
+        forces = -_get_derivatives_not_none(coordinates, energies, create_graph=True)
+    num_atoms = coordinates.shape[0]
+    device = coordinates.device
+    colors = color_atoms(atom_index12, num_atoms).to(device)
+    num_colors = int(colors.max()) + 1 if num_atoms > 0 else 0
+
+    # vectors[3 * color + direction] displaces atoms of color along direction
+    vectors = forces.new_zeros(num_colors, 3, num_atoms, 3)
+    atoms = torch.arange(num_atoms, device=device)
+    for direction in range(3):
+        vectors[colors, direction, atoms, direction] = 1
+    products = -_batched_vjps(forces, coordinates, vectors.flatten(0, 1), chunk_size)
+    products = products.reshape(num_colors, 3, num_atoms, 3)
+
+    # nonzero blocks, sorted by rows then columns
+    atom_index12 = atom_index12.to(device).long()
+    diagonal = atoms.expand(2, -1)
+    blocks = torch.cat([atom_index12, atom_index12.flip(0), diagonal], dim=1)
+    blocks = torch.unique(blocks[0] * num_atoms + blocks[1])
+    rows, columns = blocks // num_atoms, blocks % num_atoms
+    values = products[colors[columns], :, rows, :].transpose(-1, -2)
+    crow_indices = torch.searchsorted(rows, torch.arange(num_atoms + 1, device=device))
+    return torch.sparse_bsr_tensor(crow_indices, columns, values, (3 * num_atoms, 3 * num_atoms),
+                                   check_invariants=False)
+
+
+###############################################################################
+# Some potentials are not twice differentiable, or their double backward is
+# slow or not supported, for example by TorchScript. The hessian could then be
+# computed by central differences of forces, displacing each coordinate by
+# :math:`\pm\delta`. Instead of one call of the potential per displacement, all
+# the displaced structures are stacked along a new leading dimension, and their
+# forces are computed by one call of the potential and one backward pass, or a
+# few of them of ``chunk_size`` structures each. Chunks could also be computed
+# in parallel by an executor from :mod:`concurrent.futures`, in which case the
+# potential must be picklable for process pools. Forward differences need
+# almost half of the displacements, but are less accurate.
+def _displaced_forces(func: Callable[[Tensor], Tensor], coordinates: Tensor) -> Tensor:
+    coordinates = coordinates.detach().requires_grad_()
+    return -_get_derivatives_not_none(coordinates, func(coordinates))
+
+
+def finite_difference_hessian(func: Callable[[Tensor], Tensor], coordinates: Tensor, delta: float = 0.01,
+                              central: bool = True, chunk_size: Optional[int] = None,
+                              executor: Optional[concurrent.futures.Executor] = None) -> Tensor:
+    """Compute hessian by finite differences of forces.
+
+    Arguments:
+        func: the potential, that takes coordinates with an additional leading
+            dimension of displaced structures, for example of shape
+            `(displacements, atoms, 3)`, and returns their energies.
+        coordinates: Tensor of shape `(molecules, atoms, 3)` or `(atoms, 3)`
+        delta: the displacement of each coordinate.
+        central: whether to use central differences, or forward differences.
+        chunk_size: the number of displaced structures in one call of `func`,
+            default to all of them.
+        executor: optional executor to compute chunks in parallel.
+
+    Returns:
+        Tensor of shape `(molecules, 3 * atoms, 3 * atoms)` or `(3 * atoms, 3 * atoms)`
+    """
+    coordinates = coordinates.detach()
+    n = 3 * coordinates.shape[-2]
+    steps = torch.eye(n, dtype=coordinates.dtype, device=coordinates.device) * delta
+    steps = steps.reshape((n,) + (1,) * (coordinates.dim() - 2) + coordinates.shape[-2:])
+    backward = coordinates - steps if central else coordinates.unsqueeze(0)
+    displaced = torch.cat([coordinates + steps, backward])
+    chunks = displaced.split(chunk_size or displaced.shape[0])
+    if executor is None:
+        forces = [_displaced_forces(func, chunk) for chunk in chunks]
+    else:
+        forces = list(executor.map(functools.partial(_displaced_forces, func), chunks))
+    flattened_forces = torch.cat(forces).flatten(start_dim=-2)
+    difference = flattened_forces[:n] - flattened_forces[n:]
+    rows = -difference / (2 * delta if central else delta)
+    result = rows.movedim(0, -2)
+    return (result + result.transpose(-1, -2)) / 2
 
 
 ###############################################################################
@@ -98,19 +324,74 @@ def hessian(coordinates: Tensor, energies: Optional[Tensor] = None,
 # .. math::
 #   T^{\frac{1}{2}} H T^{\frac{1}{2}} q' = \omega^2 q'
 #
-# this is a regular eigen problem
+# this is a regular eigen problem.
+#
+# The hessian could be computed in single precision, for example from a
+# potential running in single precision, but the eigen problem is solved in
+# double precision anyway: it is cheap compared to the hessian, and small
+# frequencies are sensitive to rounding errors of the eigen solver. The results
+# are converted back to the dtype of the hessian.
+#
+# Molecules of different sizes could be analyzed together by padding them to
+# the same number of atoms, with a mask that is ``False`` for padding atoms.
+# Padding atoms get unit masses, and are decoupled from real atoms in the eigen
+# problem, with eigenvalues larger than those of real atoms. So the modes of
+# each molecule come first, and the last modes, which belong to padding atoms,
+# have ``nan`` frequencies and zero modes. Which modes are valid is given by
+# :func:`mode_mask`. Padding could be kept small by grouping molecules of
+# similar sizes with :func:`size_buckets`.
 class FreqsModes(NamedTuple):
     angular_frequencies: Tensor
     modes: Tensor
 
 
-def vibrational_analysis(masses: Tensor, hessian: Tensor) -> FreqsModes:
+def mode_mask(mask: Tensor) -> Tensor:
+    """Which modes are valid for molecules padded with a mask.
+
+    Arguments:
+        mask: boolean Tensor of shape `(molecules, atoms)` or `(atoms,)`
+            that is `False` for padding atoms.
+
+    Returns:
+        boolean Tensor of shape `(molecules, 3 * atoms)` or `(3 * atoms,)`.
+    """
+    num_modes = 3 * mask.sum(-1, keepdim=True)
+    return torch.arange(3 * mask.shape[-1], device=mask.device) < num_modes
+
+
+def size_buckets(sizes: List[int], max_padding: float = 0.2, max_batch_size: Optional[int] = None) -> List[List[int]]:
+    """Group molecules of similar sizes to be padded together.
+
+    Arguments:
+        sizes: the number of atoms of each molecule.
+        max_padding: the largest fraction of padding atoms of a molecule,
+            relative to the largest molecule of its group.
+        max_batch_size: the largest number of molecules of a group.
+
+    Returns:
+        list of the indices of molecules of each group.
+    """
+    buckets: List[List[int]] = []
+    largest = 0
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        full = bool(buckets) and max_batch_size is not None and len(buckets[-1]) >= max_batch_size
+        if not buckets or full or sizes[index] < (1 - max_padding) * largest:
+            buckets.append([])
+            largest = sizes[index]
+        buckets[-1].append(index)
+    return buckets
+
+
+def vibrational_analysis(masses: Tensor, hessian: Tensor, mask: Optional[Tensor] = None) -> FreqsModes:
     """Computing the vibrational wavenumbers from hessian.
 
     Arguments:
         masses: Tensor of shape `(molecules, atoms)` or `(atoms,)`.
         hessian: Tensor of shape `(molecules, 3 * atoms, 3 * atoms)` or
             `(3 * atoms, 3 * atoms)`.
+        mask: optional boolean Tensor of shape `(molecules, atoms)` or
+            `(atoms,)` that is `False` for padding atoms, see
+            :func:`mode_mask`.
 
     Returns:
         A namedtuple `(angular_frequencies, modes)` where
@@ -121,11 +402,136 @@ def vibrational_analysis(masses: Tensor, hessian: Tensor) -> FreqsModes:
             Tensor of shape `(molecules, modes, atoms, 3)` or `(modes, atoms, 3)`
             where `modes = 3 * atoms` is the number of normal modes.
     """
+    dtype = hessian.dtype
+    masses = masses.double()
+    if mask is not None:
+        masses = torch.where(mask, masses, torch.ones_like(masses))
     inv_sqrt_mass = masses.rsqrt().repeat_interleave(3, dim=-1)
-    mass_scaled_hessian = hessian * inv_sqrt_mass.unsqueeze(-2) * inv_sqrt_mass.unsqueeze(-1)
-    eigenvalues, eigenvectors = torch.symeig(mass_scaled_hessian, eigenvectors=True)
+    mass_scaled_hessian = hessian.double() * inv_sqrt_mass.unsqueeze(-2) * inv_sqrt_mass.unsqueeze(-1)
+    if mask is not None:
+        coordinate_mask = mask.repeat_interleave(3, dim=-1)
+        pairs = coordinate_mask.unsqueeze(-1) & coordinate_mask.unsqueeze(-2)
+        mass_scaled_hessian = torch.where(pairs, mass_scaled_hessian, torch.zeros_like(mass_scaled_hessian))
+        # larger than any eigenvalue of real atoms, so padding modes come last
+        bound = mass_scaled_hessian.abs().sum(-1).max(-1, keepdim=True).values + 1
+        diagonal = torch.where(coordinate_mask, torch.zeros_like(inv_sqrt_mass), bound)
+        mass_scaled_hessian = mass_scaled_hessian + torch.diag_embed(diagonal)
+    eigenvalues, eigenvectors = torch.linalg.eigh(mass_scaled_hessian)
     angular_frequencies = eigenvalues.sqrt()
     modes = (eigenvectors.transpose(-1, -2) * inv_sqrt_mass.unsqueeze(-2))
+    if mask is not None:
+        valid = mode_mask(mask)
+        angular_frequencies = torch.where(valid, angular_frequencies, torch.full_like(angular_frequencies, float('nan')))
+        modes = modes * valid.unsqueeze(-1).to(modes.dtype)
     new_shape = modes.shape[:-1] + (-1, 3)
     modes = modes.reshape(new_shape)
-    return FreqsModes(angular_frequencies, modes)
+    return FreqsModes(angular_frequencies.to(dtype), modes.to(dtype))
+
+
+###############################################################################
+# When only the lowest few modes are needed, for example to check that a
+# transition state has exactly one imaginary frequency, the hessian does not
+# have to be formed at all. The lowest eigenpairs of the mass scaled hessian
+# :math:`T^{-\frac{1}{2}} H T^{-\frac{1}{2}}` could be found by the locally
+# optimal block preconditioned conjugate gradient method (LOBPCG) of
+# `Knyazev`_, which only needs products of the mass scaled hessian with a block
+# of vectors. Each of them is one batched hessian-vector product through the
+# graph of the forces. The block is larger than the number of requested modes,
+# so that the last requested modes also converge fast, and degenerate modes,
+# like translations and rotations, are found together. As above, the small
+# eigen problems are solved in double precision.
+#
+# .. _Knyazev:
+#   https://doi.org/10.1137/S1064827500366124
+def lowest_modes(masses: Tensor, coordinates: Tensor, energies: Optional[Tensor] = None,
+                 forces: Optional[Tensor] = None, k: int = 6, tol: float = 1e-6,
+                 max_iterations: int = 1000, initial: Optional[Tensor] = None) -> FreqsModes:
+    """Compute the lowest vibrational modes without forming the hessian.
+
+    Arguments:
+        masses: Tensor of shape `(atoms,)`.
+        coordinates: Tensor of shape `(atoms, 3)`.
+        energies: scalar, or Tensor of shape `(atoms,)`, if specified, then
+            `forces` must be `None`. This energies must be computed from
+            `coordinates` in a graph.
+        forces: Tensor of shape `(atoms, 3)`, if specified, then `energies`
+            must be `None`. This forces must be computed from `coordinates`
+            in a graph.
+        k: the number of modes.
+        tol: the tolerance of the residual of each mode, relative to the
+            largest eigenvalue found of the mass scaled hessian.
+        max_iterations: the largest number of iterations.
+        initial: optional initial guess of modes, of shape `(modes, atoms, 3)`.
+
+    Returns:
+        A namedtuple `(angular_frequencies, modes)` of the `k` lowest modes,
+        with the same layout as :func:`vibrational_analysis`.
+    """
+    if energies is None and forces is None:
+        raise ValueError('Energies or forces must be specified')
+    if energies is not None and forces is not None:
+        raise ValueError('Energies or forces can not be specified at the same time')
+    if forces is None:
+        assert energies is not None
+        forces = -_get_derivatives_not_none(coordinates, energies, create_graph=True)
+    dtype = forces.dtype
+    n = forces.numel()
+    if not 0 < k <= n:
+        raise ValueError('The number of modes must be between 1 and 3 * atoms')
+    inv_sqrt_mass = masses.detach().double().rsqrt().repeat_interleave(3)
+
+    def product(vectors: Tensor) -> Tensor:
+        # mass scaled hessian times columns of vectors
+        displacements = (vectors * inv_sqrt_mass.unsqueeze(-1)).t().reshape((-1,) + forces.shape)
+        result = -_batched_vjps(forces, coordinates, displacements.to(dtype), None)
+        return result.reshape(-1, n).t().double() * inv_sqrt_mass.unsqueeze(-1)
+
+    def orthonormal(basis: Tensor) -> Tensor:
+        # coefficients that make the columns of basis orthonormal, dropping
+        # linearly dependent directions
+        gram = basis.t() @ basis
+        values, vectors = torch.linalg.eigh((gram + gram.t()) / 2)
+        keep = values > values.max() * 1e-12
+        return vectors[:, keep] * values[keep].rsqrt()
+
+    size = min(n, max(2 * k, k + 6))
+    if initial is not None:
+        x = initial.detach().double().reshape(initial.shape[0], n).t() / inv_sqrt_mass.unsqueeze(-1)
+        extra = size - x.shape[1]
+    else:
+        x = coordinates.new_empty(n, 0, dtype=torch.double)
+        extra = size
+    generator = torch.Generator(device=coordinates.device).manual_seed(0)
+    if extra > 0:
+        x = torch.cat([x, torch.randn(n, extra, dtype=torch.double, device=coordinates.device,
+                                      generator=generator)], 1)
+    x = x @ orthonormal(x)
+    ax = product(x)
+    p: Optional[Tensor] = None
+    ap: Optional[Tensor] = None
+    scale = 0.0
+    for _ in range(max_iterations):
+        values, vectors = torch.linalg.eigh(x.t() @ ax)
+        x, ax = x @ vectors, ax @ vectors
+        scale = max(scale, float(values.abs().max()))
+        residuals = ax - x * values
+        if bool((residuals[:, :k].norm(2, 0) <= tol * scale).all()):
+            break
+        w = residuals - x @ (x.t() @ residuals)
+        w = w @ orthonormal(w)
+        aw = product(w)
+        if p is None or ap is None:
+            basis, image = torch.cat([x, w], 1), torch.cat([ax, aw], 1)
+        else:
+            basis, image = torch.cat([x, w, p], 1), torch.cat([ax, aw, ap], 1)
+        coefficients = orthonormal(basis)
+        projected = coefficients.t() @ basis.t() @ image @ coefficients
+        _, ritz = torch.linalg.eigh((projected + projected.t()) / 2)
+        y = coefficients @ ritz[:, :x.shape[1]]
+        m = x.shape[1]
+        p, ap = basis[:, m:] @ y[m:], image[:, m:] @ y[m:]
+        x, ax = basis @ y, image @ y
+    values, vectors = torch.linalg.eigh(x.t() @ ax)
+    angular_frequencies = values[:k].sqrt()
+    modes = ((x @ vectors)[:, :k] * inv_sqrt_mass.unsqueeze(-1)).t().reshape((k,) + forces.shape)
+    return FreqsModes(angular_frequencies.to(dtype), modes.to(dtype))
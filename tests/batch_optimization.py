@@ -0,0 +1,108 @@
+"""
+Relaxing Many Structures Together
+=================================
+
+This tutorial demonstrates how to relax a batch of structures, and optionally
+their cells, with the batched optimizers of ``nnp.optimize``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import math
+import torch
+import pytest
+from pytest import approx
+import sys
+from ase.cluster import Icosahedron
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.filters import UnitCellFilter
+import ase.optimize
+import nnp.pbc as pbc
+import nnp.md as md
+import nnp.optimize as optimize
+
+
+###############################################################################
+# The potential is called for a padded batch of structures, with a mask that
+# is ``False`` for padding atoms. Let's use a Lennard-Jones potential for
+# argon, smoothly truncated at the cutoff, with pairs of each structure found
+# by ``nnp.pbc``:
+cutoff = 8.0
+
+
+def pair_energies(distances):
+    x6 = (3.4 / distances) ** 6
+    return 4 * 0.0104 * (x6 * x6 - x6) * (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+
+
+def lennard_jones(_symbols, coordinates, cell, pbc_, mask):
+    energies = []
+    for c, cell_, p, m in zip(coordinates, cell, pbc_, mask):
+        distances = pbc.neighbor_list(cell_, c[m], p, cutoff, half=True).distances
+        energies.append(pair_energies(distances).sum())
+    return torch.stack(energies)
+
+
+def single(symbols, coordinates, cell, pbc_):
+    mask = torch.ones(1, len(symbols), dtype=torch.bool)
+    return lennard_jones([symbols], coordinates.unsqueeze(0), cell.unsqueeze(0), pbc_.unsqueeze(0), mask)[0]
+
+
+###############################################################################
+# Let's relax 6 rattled clusters of 13 and 55 atoms together with FIRE and
+# L-BFGS. Converged structures leave the batch, so the batch shrinks as the
+# optimization goes:
+def clusters():
+    result = []
+    for i in range(6):
+        atoms = Icosahedron('Ar', 2 + i % 2, latticeconstant=5.3)
+        atoms.rattle(0.1, seed=i)
+        result.append(atoms)
+    return result
+
+
+fire_images = clusters()
+fire = optimize.FIRE(fire_images, lennard_jones)
+fire_converged = fire.run(fmax=0.001, steps=500)
+lbfgs_images = clusters()
+lbfgs = optimize.LBFGS(lbfgs_images, lennard_jones)
+lbfgs_converged = lbfgs.run(fmax=0.001, steps=500)
+print('FIRE:', fire.nsteps, 'steps, batch sizes', fire.batch_sizes[::20])
+print('L-BFGS:', lbfgs.nsteps, 'steps, batch sizes', lbfgs.batch_sizes[::5])
+
+
+###############################################################################
+# The results should be the same as relaxing each structure with the same
+# optimizer of ASE:
+def test_same_as_ase():
+    assert fire_converged.all() and lbfgs_converged.all()
+    assert fire.batch_sizes[-1] < fire.batch_sizes[0]
+    for optimizer, images in [(ase.optimize.FIRE, fire_images), (ase.optimize.LBFGS, lbfgs_images)]:
+        for atoms, relaxed in zip(clusters(), images):
+            atoms.calc = md.Calculator(single)
+            optimizer(atoms, logfile=None).run(fmax=0.001)
+            assert relaxed.get_potential_energy() == approx(atoms.get_potential_energy(), abs=1e-4)
+            assert abs(relaxed.get_forces()).max() < 0.001
+
+
+###############################################################################
+# With ``relax_cell=True``, the cells are also relaxed through the strain path.
+# Let's relax crystals of argon starting from different lattice constants:
+crystals = [FaceCenteredCubic('Ar', size=(2, 2, 2), latticeconstant=a) for a in (5.0, 5.3, 5.6)]
+for i, crystal in enumerate(crystals):
+    crystal.rattle(0.05, seed=i)
+relaxed = optimize.FIRE(crystals, lennard_jones, relax_cell=True).run(fmax=1e-4, steps=1000)
+
+
+def test_relax_cell():
+    assert relaxed.all()
+    reference = FaceCenteredCubic('Ar', size=(2, 2, 2), latticeconstant=5.3)
+    reference.calc = md.Calculator(single)
+    ase.optimize.BFGS(UnitCellFilter(reference), logfile=None).run(fmax=1e-4)
+    for crystal in crystals:
+        assert crystal.get_volume() == approx(reference.get_volume(), rel=1e-3)
+        assert crystal.get_potential_energy() == approx(reference.get_potential_energy(), abs=1e-4)
+        assert abs(crystal.get_stress()).max() < 1e-4
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
@@ -0,0 +1,56 @@
+"""
+Periodic Boundary Conditions in Batch
+=====================================
+
+This tutorial demonstrates how to deal with a padded batch of periodic systems
+that have different cells and pbc flags using ``nnp.pbc``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import torch
+import pytest
+import sys
+import nnp.pbc as pbc
+
+
+###############################################################################
+# Let's create a batch of three systems: a triclinic crystal, a slab that is
+# only periodic in the x and y directions, and a molecule without any PBC whose
+# cell is just zeros. The three systems have 5, 3 and 4 atoms, so padding is
+# needed.
+torch.manual_seed(0)
+cell = torch.stack([
+    torch.tensor([[5.0, 0.0, 0.0], [1.0, 4.0, 0.0], [0.5, 0.5, 6.0]]),
+    torch.tensor([[3.0, 0.0, 0.0], [0.0, 3.0, 0.0], [0.0, 0.0, 20.0]]),
+    torch.zeros(3, 3),
+]).double()
+pbc_ = torch.tensor([[True, True, True], [True, True, False], [False, False, False]])
+num_atoms = torch.tensor([5, 3, 4])
+mask = torch.arange(5).unsqueeze(0) < num_atoms.unsqueeze(1)
+coordinates = torch.where(mask.unsqueeze(-1), torch.rand(3, 5, 3, dtype=torch.double) * 20 - 10,
+                          torch.zeros(3, 5, 3, dtype=torch.double))
+
+###############################################################################
+# The whole batch is processed in one call:
+repeats = pbc.batched_num_repeats(cell, pbc_, 5.2)
+wrapped = pbc.batched_map2central(cell, coordinates, pbc_, mask)
+print(repeats)
+print(wrapped)
+
+
+###############################################################################
+# The result should be the same as processing the systems one by one, and the
+# padding atoms should stay untouched:
+def test_same_as_one_by_one():
+    for c, x, p, m, r, w in zip(cell, coordinates, pbc_, mask, repeats, wrapped):
+        if p.any():
+            assert torch.equal(r, pbc.num_repeats(c, p, 5.2))
+            assert torch.allclose(w[m], pbc.map2central(c, x[m], p))
+        else:
+            assert torch.equal(r, torch.zeros(3, dtype=torch.long))
+            assert torch.equal(w[m], x[m])
+        assert torch.equal(w[~m], x[~m])
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
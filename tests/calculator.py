@@ -0,0 +1,259 @@
+"""
+ASE Calculator
+==============
+
+This tutorial demonstrates how to use ``nnp.md.Calculator`` to compute energy,
+forces and stress of periodic systems with a potential defined by PyTorch.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import math
+import torch
+import pytest
+from pytest import approx
+import sys
+from typing import List
+import numpy as np
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+from ase.md.verlet import VelocityVerlet
+from ase.units import fs
+import nnp.pbc as pbc
+import nnp.md as md
+import nnp.vib as vib
+from nnp.profiling import Profiler
+
+
+###############################################################################
+# We use a Morse potential for copper, smoothly truncated at the cutoff, with
+# pairs found by ``nnp.pbc``. We also count how many times the potential is
+# called, and whether gradients are enabled.
+cutoff = 6.0
+calls: List[bool] = []
+
+
+def pair_energies(distances):
+    x = torch.exp(-1.359 * (distances - 2.866))
+    return 0.3429 * (x * x - 2 * x) * (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+
+
+def morse(_symbols, coordinates, cell, pbc_):
+    calls.append(torch.is_grad_enabled())
+    distances = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True).distances
+    return pair_energies(distances).sum()
+
+
+atoms = FaceCenteredCubic('Cu', size=(2, 2, 2), latticeconstant=3.7)
+atoms.rattle(0.05, seed=0)
+atoms.calc = md.Calculator(morse)
+
+###############################################################################
+# When only the energy is requested, the potential is evaluated without
+# building the autograd graph. Requesting the same property again for
+# unchanged atoms does not call the potential again.
+energy = atoms.get_potential_energy()
+atoms.get_potential_energy()
+forces = atoms.get_forces()
+print(energy, calls)
+
+
+def test_energy_only():
+    assert calls == [False, True]
+    assert atoms.get_potential_energy() == approx(energy)
+    assert len(calls) == 2
+
+
+###############################################################################
+# Tensors of chemical symbols, cell and pbc are cached by the calculator, and
+# only updated when they change:
+def test_cache_invalidation():
+    scaled = atoms.copy()
+    scaled.set_cell(atoms.cell * 1.01, scale_atoms=True)
+    scaled.calc = atoms.calc
+    fresh = scaled.copy()
+    fresh.calc = md.Calculator(morse)
+    assert scaled.get_potential_energy() == approx(fresh.get_potential_energy())
+    assert abs(scaled.get_forces() - fresh.get_forces()).max() < 1e-10
+
+
+###############################################################################
+# Forces and stress are computed together from a single backward pass. Let's
+# check them against finite differences:
+def test_forces_and_stress():
+    atoms.get_stress()
+    assert abs(atoms.get_forces() - atoms.calc.calculate_numerical_forces(atoms)).max() < 1e-5
+    assert abs(atoms.get_stress() - atoms.calc.calculate_numerical_stress(atoms)).max() < 1e-5
+
+
+###############################################################################
+# The potential could also return per-atom energies. Per-atom energies and
+# per-atom stresses are then also available, and they sum to the total:
+def morse_atomic(_symbols, coordinates, cell, pbc_):
+    pairs = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True)
+    return pairs.to_atoms(pair_energies(pairs.distances)) / 2
+
+
+def test_per_atom_properties():
+    other = atoms.copy()
+    other.calc = md.Calculator(morse_atomic)
+    assert other.get_potential_energy() == approx(atoms.get_potential_energy())
+    assert other.get_potential_energies().sum() == approx(atoms.get_potential_energy())
+    assert abs(other.get_forces() - atoms.get_forces()).max() < 1e-10
+    assert abs(other.get_stresses().sum(0) - atoms.get_stress()).max() < 1e-10
+
+
+###############################################################################
+# Mixed precision
+# ---------------
+#
+# The potential could run in single precision by specifying ``dtype``. The
+# coordinates are still wrapped in double precision, and converted to single
+# precision just before calling the potential. The energy is summed and the
+# stress is accumulated in double precision.
+def morse_single(_symbols, coordinates, cell, pbc_):
+    assert coordinates.dtype == torch.float32 and cell.dtype == torch.float32
+    return morse_atomic(_symbols, coordinates, cell, pbc_)
+
+
+single = atoms.copy()
+single.calc = md.Calculator(morse_single, dtype=torch.float32)
+
+
+def test_single_precision():
+    assert single.get_potential_energy() == approx(atoms.get_potential_energy(), rel=1e-6)
+    assert abs(single.get_forces() - atoms.get_forces()).max() < 1e-5
+    assert abs(single.get_stress() - atoms.get_stress()).max() < 1e-6
+
+
+###############################################################################
+# Let's also check that single precision does not break energy conservation,
+# by comparing the drift of total energy in a short run with the double
+# precision calculator:
+def total_energy_drift(dtype):
+    system = atoms.copy()
+    MaxwellBoltzmannDistribution(system, temperature_K=300, rng=np.random.RandomState(0))
+    system.calc = md.Calculator(morse_atomic, dtype=dtype)
+    total_energies = []
+    dyn = VelocityVerlet(system, timestep=2 * fs)
+    dyn.attach(lambda: total_energies.append(system.get_total_energy()))
+    dyn.run(200)
+    return abs(total_energies[-1] - total_energies[0]), np.std(total_energies)
+
+
+def test_single_precision_energy_drift():
+    drift, fluctuation = total_energy_drift(torch.float32)
+    drift_double, fluctuation_double = total_energy_drift(torch.double)
+    assert drift == approx(drift_double, abs=1e-5)
+    assert fluctuation == approx(fluctuation_double, abs=1e-5)
+
+
+###############################################################################
+# Profiling
+# ---------
+#
+# To find out where the time goes, give the calculator a
+# :class:`nnp.profiling.Profiler`. It records the time, the number of calls,
+# the bytes of output tensors and the size of the autograd graph of each phase
+# of the calculation, together with counters like cache hits:
+profiler = Profiler()
+profiled = atoms.copy()
+profiled.calc = md.Calculator(morse_atomic, profiler=profiler)
+for _ in range(3):
+    profiled.rattle(0.01, seed=1)
+    profiled.get_forces()
+    profiled.get_forces()
+profiled.get_stress()
+print(profiler)
+
+
+def test_profiler():
+    summary = profiler.summary()
+    assert summary['forward']['calls'] == 4
+    assert summary['backward']['calls'] == 4
+    assert summary['wrap']['calls'] == 4
+    assert summary['forward']['graph_size'] > 0
+    assert summary['backward']['output_bytes'] == 4 * len(atoms) * 3 * 8
+    assert summary['requests']['count'] == 7
+    assert summary['calculations']['count'] == 4
+    assert summary['cache_hits']['count'] == 3
+    assert summary['cell_updates']['count'] == 1
+    assert sum(r.get('fraction', 0) for r in summary.values()) == approx(1)
+
+
+def test_cache_hits():
+    calculator = md.Calculator(morse_atomic, profiler=Profiler())
+    calculator.calculate(atoms, ['forces'])
+    calculator.calculate(atoms, ['energy', 'forces'], [])
+    copied = atoms.copy()
+    copied.calc = calculator
+    copied.get_forces()
+    assert calculator.profiler.counters['calculations'] == 1
+    assert calculator.profiler.counters['cache_hits'] == 2
+
+
+###############################################################################
+# Functions like ``nnp.vib.hessian`` are profiled as a whole by wrapping them.
+# The profiler could also add ranges to :mod:`torch.profiler`:
+vib_profiler = Profiler(record_functions=True)
+hessian = vib_profiler.wrap(vib.hessian)
+coordinates = torch.tensor(atoms.get_positions(), requires_grad=True)
+cell = torch.tensor(atoms.get_cell().array)
+with torch.profiler.profile() as trace:
+    hessian(coordinates, energies=morse_atomic(None, coordinates, cell, torch.tensor(atoms.get_pbc())))
+
+
+def test_profile_hessian():
+    record = vib_profiler.summary()['hessian']
+    assert record['calls'] == 1
+    assert record['output_bytes'] == (len(atoms) * 3) ** 2 * 8
+    assert any(e.name == 'nnp::hessian' for e in trace.events())
+
+
+###############################################################################
+# Committees
+# ----------
+#
+# For a committee of models, :class:`nnp.md.EnsembleCalculator` shares the
+# conversion, wrapping and neighbor search between members, and computes the
+# forces of all members from one backward pass. The potential returns the
+# energies of all members. Let's make a committee of Morse potentials with
+# slightly different parameters, sharing the same pairs:
+depths = torch.tensor([0.33, 0.34, 0.35], dtype=torch.double).unsqueeze(-1)
+widths = torch.tensor([1.35, 1.36, 1.37], dtype=torch.double).unsqueeze(-1)
+
+
+def member_pair_energies(distances, depth, width):
+    x = torch.exp(-width * (distances - 2.866))
+    return depth * (x * x - 2 * x) * (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+
+
+def committee(_symbols, coordinates, cell, pbc_):
+    distances = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True).distances
+    return member_pair_energies(distances, depths, widths).sum(-1)
+
+
+member_atoms = atoms.copy()
+member_atoms.calc = md.EnsembleCalculator(committee)
+variances = member_atoms.calc.get_property('force_variances', member_atoms)
+print(member_atoms.calc.get_property('member_energies', member_atoms), variances)
+
+
+def test_committee():
+    members = []
+    for depth, width in zip(depths, widths):
+        single = atoms.copy()
+        single.calc = md.Calculator(lambda _s, c, cell, p: member_pair_energies(
+            pbc.neighbor_list(cell, c, p, cutoff, half=True).distances, depth, width).sum())
+        members.append((single.get_potential_energy(), single.get_forces(), single.get_stress()))
+    energies = np.array([e for e, _, _ in members])
+    forces = np.stack([f for _, f, _ in members])
+    stress = np.mean([s for _, _, s in members], 0)
+    assert member_atoms.calc.get_property('member_energies', member_atoms) == approx(energies)
+    assert member_atoms.get_potential_energy() == approx(energies.mean())
+    assert abs(member_atoms.get_forces() - forces.mean(0)).max() < 1e-10
+    assert abs(variances - forces.var(0).sum(-1)).max() < 1e-10
+    assert abs(member_atoms.get_stress() - stress).max() < 1e-10
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
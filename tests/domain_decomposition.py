@@ -0,0 +1,149 @@
+"""
+Running Large Systems on Many Processes
+=======================================
+
+This tutorial demonstrates how to split the evaluation of a potential on a
+large periodic system among several processes with
+``nnp.md.DomainDecomposition``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+import torch
+import torch.distributed
+import pytest
+from pytest import approx
+import sys
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+from ase.units import fs
+import nnp.pbc as pbc
+import nnp.md as md
+
+
+###############################################################################
+# The potential must return per-atom energies, and the energy of each atom must
+# only depend on atoms within the cutoff. Let's write a Lennard-Jones potential
+# for argon, smoothly truncated at the cutoff, that splits the energy of each
+# pair equally between its two atoms:
+cutoff = 8.5
+
+
+def lennard_jones(_symbols, coordinates, cell, pbc_):
+    pairs = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True)
+    x6 = (3.4 / pairs.distances) ** 6
+    smooth = (1 - (pairs.distances / cutoff) ** 2) ** 2
+    return pairs.to_atoms(2 * 0.0104 * (x6 * x6 - x6) * smooth)
+
+
+atoms = FaceCenteredCubic('Ar', size=(4, 4, 4), latticeconstant=5.26)
+atoms.rattle(0.1, seed=0)
+MaxwellBoltzmannDistribution(atoms, temperature_K=60, rng=np.random.RandomState(0))
+
+
+###############################################################################
+# Each process runs the same code on the same atoms, after joining a process
+# group, here with the gloo backend for CPUs. The wrapper has the same signature
+# as the potential, so it could be used by :class:`nnp.md.Calculator` and the
+# integrators as usual. Here each process computes energy, forces and stress,
+# and then runs a few steps of molecular dynamics:
+def run(rank, world_size, init_file, grid, results, atoms):
+    torch.set_num_threads(1)
+    torch.distributed.init_process_group('gloo', init_method='file://' + init_file,
+                                         rank=rank, world_size=world_size)
+    decomposition = md.DomainDecomposition(lennard_jones, cutoff, grid=grid)
+    local = atoms.copy()
+    local.calc = md.Calculator(decomposition)
+    result = {
+        'energy': local.get_potential_energy(),
+        'forces': local.get_forces(),
+        'stress': local.get_stress(),
+        'unwrapped_energy': decomposition(local.get_chemical_symbols(), torch.tensor(local.get_positions()),
+                                          torch.tensor(local.cell.array), torch.tensor(local.pbc)).sum().item(),
+    }
+    dynamics = md.VelocityVerlet(local, decomposition, timestep=2 * fs)
+    dynamics.run(5)
+    result['positions'] = dynamics.get_atoms().get_positions()
+    results.put((rank, result))
+    torch.distributed.destroy_process_group()
+
+
+def decomposed(world_size, grid=None, atoms=atoms):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    init_file = os.path.join(tempfile.mkdtemp(), 'init')
+    processes = [context.Process(target=run, args=(rank, world_size, init_file, grid, results, atoms))
+                 for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    collected = dict(results.get() for _ in processes)
+    for p in processes:
+        p.join()
+    return [collected[rank] for rank in range(world_size)]
+
+
+###############################################################################
+# Let's compute the reference with a single process:
+reference = atoms.copy()
+reference.calc = md.Calculator(lennard_jones)
+expected = {
+    'energy': reference.get_potential_energy(),
+    'forces': reference.get_forces(),
+    'stress': reference.get_stress(),
+}
+dynamics = md.VelocityVerlet(reference, lennard_jones, timestep=2 * fs)
+dynamics.run(5)
+expected['positions'] = dynamics.get_atoms().get_positions()
+
+
+###############################################################################
+# The results of all processes should be the same as the reference, with the
+# grid chosen automatically, and also when the cutoff is larger than the
+# thickness of subdomains, so that ghost atoms come from several subdomains:
+@pytest.mark.parametrize('world_size,grid', [(2, None), (4, None), (4, (4, 1, 1))])
+def test_same_as_single_process(world_size, grid):
+    for result in decomposed(world_size, grid):
+        assert result['energy'] == approx(expected['energy'])
+        assert abs(result['forces'] - expected['forces']).max() < 1e-10
+        assert abs(result['stress'] - expected['stress']).max() < 1e-10
+        assert abs(result['positions'] - expected['positions']).max() < 1e-8
+
+
+###############################################################################
+# Each atom is owned by exactly one process, even when rounding puts it on the
+# boundary of subdomains, like an atom just below a face of the cell that is
+# not wrapped into the cell before calling the potential:
+def test_atom_on_boundary():
+    on_boundary = atoms.copy()
+    on_boundary.positions[0] = [-1e-17, -1e-17, -1e-17]
+    on_boundary.calc = md.Calculator(lennard_jones)
+    energy = on_boundary.get_potential_energy()
+    forces = on_boundary.get_forces()
+    for result in decomposed(4, (4, 1, 1), on_boundary):
+        assert result['energy'] == approx(energy)
+        assert result['unwrapped_energy'] == approx(energy)
+        assert abs(result['forces'] - forces).max() < 1e-10
+
+
+###############################################################################
+# Without an initialized process group, the whole cell is a single subdomain:
+def test_single_process():
+    single = atoms.copy()
+    single.calc = md.Calculator(md.DomainDecomposition(lennard_jones, cutoff))
+    assert single.get_potential_energy() == approx(expected['energy'])
+    assert abs(single.get_forces() - expected['forces']).max() < 1e-10
+
+
+def test_grid():
+    decomposition = md.DomainDecomposition(lennard_jones, cutoff)
+    decomposition.world_size = 4
+    cell = torch.diag(torch.tensor([10.0, 20.0, 40.0], dtype=torch.double))
+    assert decomposition.choose_grid(cell, torch.tensor([True, True, True])) == (1, 1, 4)
+    assert decomposition.choose_grid(cell, torch.tensor([True, True, False])) == (1, 4, 1)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
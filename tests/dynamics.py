@@ -0,0 +1,341 @@
+"""
+Molecular Dynamics on Tensors
+=============================
+
+This tutorial demonstrates how to run molecular dynamics with the integrators
+of ``nnp.md``, which keep the whole state as tensors.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import math
+import numpy as np
+import torch
+import pytest
+import sys
+import os
+import tempfile
+import shutil
+import time
+from typing import List
+from ase.cluster import Icosahedron
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+import ase.md.verlet
+from ase.units import fs
+import nnp.pbc as pbc
+import nnp.md as md
+
+
+###############################################################################
+# We simulate liquid argon with a Lennard-Jones potential, smoothly truncated
+# at the cutoff so that energy is conserved.
+cutoff = 8.0
+
+
+def lennard_jones(_symbols, coordinates, cell, pbc_):
+    distances = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True).distances
+    x6 = (3.4 / distances) ** 6
+    smooth = (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+    return (4 * 0.0104 * (x6 * x6 - x6) * smooth).sum()
+
+
+atoms = FaceCenteredCubic('Ar', size=(3, 3, 3), latticeconstant=5.6)
+MaxwellBoltzmannDistribution(atoms, temperature_K=100, rng=np.random.RandomState(0))
+
+###############################################################################
+# Let's run velocity Verlet, and record the total energy. Observers are called
+# the same way as in ASE, and ``get_atoms`` creates an :class:`ase.Atoms` of
+# the current state when needed.
+dyn = md.VelocityVerlet(atoms, lennard_jones, timestep=5 * fs)
+total_energies: List[float] = []
+potential_energies: List[float] = []
+
+
+def record():
+    total_energies.append((dyn.energy + dyn.kinetic_energy()).item())
+    potential_energies.append(dyn.get_atoms().get_potential_energy())
+
+
+dyn.attach(record)
+dyn.run(50)
+
+
+###############################################################################
+# The result should be the same as running ASE's velocity Verlet with
+# :class:`nnp.md.Calculator`:
+ase_atoms = atoms.copy()
+ase_atoms.calc = md.Calculator(lennard_jones)
+ase_dyn = ase.md.verlet.VelocityVerlet(ase_atoms, timestep=5 * fs)
+ase_potential_energies: List[float] = []
+ase_dyn.attach(lambda: ase_potential_energies.append(ase_atoms.get_potential_energy()))
+ase_dyn.run(50)
+
+
+def test_same_as_ase():
+    assert np.allclose(potential_energies, ase_potential_energies)
+
+
+def test_energy_conservation():
+    assert max(total_energies) - min(total_energies) < 1e-3
+
+
+###############################################################################
+# Since the state never leaves PyTorch, each step saves the round trips between
+# ASE and tensors that the ASE integrator makes through the calculator. Let's
+# compare the number of steps per second of the two. The gain is larger when the
+# potential is cheap compared with this overhead, like for small systems or on
+# GPUs, where each round trip also copies between devices:
+def steps_per_second(dynamics, steps=100):
+    start = time.time()
+    dynamics.run(steps)
+    return steps / (time.time() - start)
+
+
+timing_atoms = atoms.copy()
+timing_atoms.calc = md.Calculator(lennard_jones)
+speeds = {
+    'nnp.md.VelocityVerlet': steps_per_second(md.VelocityVerlet(atoms, lennard_jones, timestep=5 * fs)),
+    'ase.md.verlet.VelocityVerlet': steps_per_second(ase.md.verlet.VelocityVerlet(timing_atoms, timestep=5 * fs)),
+}
+print('steps per second:', speeds)
+
+
+###############################################################################
+# Now let's heat the system up to 300K with the Langevin and Nose-Hoover
+# thermostats. For Nose-Hoover, the extended energy is conserved.
+langevin = md.Langevin(atoms, lennard_jones, timestep=5 * fs, temperature_K=300,
+                       friction=0.05 / fs, generator=torch.Generator().manual_seed(0))
+langevin_temperatures: List[float] = []
+langevin.attach(lambda: langevin_temperatures.append(langevin.temperature().item()))
+langevin.run(300)
+
+nose_hoover = md.NoseHoover(atoms, lennard_jones, timestep=5 * fs, temperature_K=300, tdamp=50 * fs)
+conserved_energies: List[float] = []
+nose_hoover_temperatures: List[float] = []
+
+
+def record_nose_hoover():
+    conserved_energies.append(nose_hoover.conserved_energy().item())
+    nose_hoover_temperatures.append(nose_hoover.temperature().item())
+
+
+nose_hoover.attach(record_nose_hoover)
+nose_hoover.run(300)
+
+
+def test_thermostats():
+    assert abs(np.mean(langevin_temperatures[100:]) - 300) < 30
+    assert abs(np.mean(nose_hoover_temperatures[100:]) - 300) < 30
+    assert max(conserved_energies) - min(conserved_energies) < 1e-2
+
+
+###############################################################################
+# Replicas
+# --------
+#
+# Many independent trajectories of the same molecule could be run together as
+# replicas. The potential is then called with coordinates of shape
+# ``(replicas, atoms, 3)`` and should return energies of shape ``(replicas,)``.
+# Let's use an argon cluster without PBC, where all pairs of atoms interact:
+def cluster_lennard_jones(_symbols, coordinates, _cell, _pbc):
+    index1, index2 = torch.triu_indices(coordinates.shape[-2], coordinates.shape[-2], 1)
+    distances = (coordinates[..., index1, :] - coordinates[..., index2, :]).norm(dim=-1)
+    x6 = (3.4 / distances) ** 6
+    return (4 * 0.0104 * (x6 * x6 - x6)).sum(-1)
+
+
+cluster = Icosahedron('Ar', 3, latticeconstant=5.26)
+replicas = []
+for seed in range(4):
+    replica = cluster.copy()
+    MaxwellBoltzmannDistribution(replica, temperature_K=30, rng=np.random.RandomState(seed))
+    replicas.append(replica)
+
+###############################################################################
+# Running the replicas together should give the same trajectories as running
+# them one by one:
+batched = md.VelocityVerlet(replicas, cluster_lennard_jones, timestep=5 * fs)
+batched.run(20)
+one_by_one = [md.VelocityVerlet(r, cluster_lennard_jones, timestep=5 * fs) for r in replicas]
+for dyn_ in one_by_one:
+    dyn_.run(20)
+
+
+def test_replicas_same_as_one_by_one():
+    for i, dyn_ in enumerate(one_by_one):
+        assert torch.allclose(batched.coordinates[i], dyn_.coordinates)
+        assert torch.allclose(batched.velocities[i], dyn_.velocities)
+        assert batched.get_atoms(i).get_potential_energy() == pytest.approx(dyn_.energy.item())
+
+
+###############################################################################
+# Each replica could have its own temperature:
+temperatures = torch.tensor([10.0, 20.0, 30.0, 40.0], dtype=torch.double)
+thermostatted = md.Langevin(replicas, cluster_lennard_jones, timestep=5 * fs, temperature_K=temperatures,
+                            friction=0.05 / fs, generator=torch.Generator().manual_seed(0))
+replica_temperatures: List[torch.Tensor] = []
+thermostatted.attach(lambda: replica_temperatures.append(thermostatted.temperature()))
+thermostatted.run(1000)
+
+
+def test_replica_temperatures():
+    mean = torch.stack(replica_temperatures[200:]).mean(0)
+    assert torch.allclose(mean, temperatures, rtol=0.15)
+
+
+###############################################################################
+# Multiple time steps
+# -------------------
+#
+# :class:`nnp.md.RESPA` integrates a potential split into terms that are
+# evaluated at different intervals. Let's split the Lennard-Jones potential
+# smoothly at 5 angstrom into a short range part that changes fast, and a long
+# range part that changes slowly and is only evaluated every 4 steps:
+inner = 5.0
+
+
+def switch(distances):
+    x = ((distances - inner + 1) / 2).clamp(0, 1)
+    return (torch.cos(x * math.pi) + 1) / 2
+
+
+def short_range(_symbols, coordinates, cell, pbc_):
+    distances = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True).distances
+    x6 = (3.4 / distances) ** 6
+    smooth = (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+    return (4 * 0.0104 * (x6 * x6 - x6) * smooth * switch(distances)).sum()
+
+
+long_range_calls: List[None] = []
+
+
+def long_range(_symbols, coordinates, cell, pbc_):
+    long_range_calls.append(None)
+    distances = pbc.neighbor_list(cell, coordinates, pbc_, cutoff, half=True).distances
+    x6 = (3.4 / distances) ** 6
+    smooth = (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+    return (4 * 0.0104 * (x6 * x6 - x6) * smooth * (1 - switch(distances))).sum()
+
+
+###############################################################################
+# The time step is the one of the fast term, so each call of ``step`` here
+# advances 20 fs, with 5 evaluations of the short range term and one of the
+# long range term.
+respa = md.RESPA(atoms, [(short_range, 1), (long_range, 4)], timestep=5 * fs)
+respa_energies: List[float] = []
+respa.attach(lambda: respa_energies.append((respa.energy + respa.kinetic_energy()).item()))
+long_range_calls.clear()
+respa.run(25)
+num_long_range_calls = len(long_range_calls)
+
+
+def test_respa():
+    # the same 500 fs as velocity Verlet above, with a quarter of the long range calls
+    assert num_long_range_calls == 25
+    assert np.std(respa_energies) < 2 * np.std(total_energies)
+    assert abs(respa_energies[-1] - respa_energies[0]) < 1e-3
+    assert respa.energy.item() == pytest.approx(lennard_jones(None, respa.coordinates, respa.cell, respa.pbc).item())
+
+
+###############################################################################
+# When all intervals are 1, it is just velocity Verlet on the sum of the terms:
+split = md.RESPA(atoms, [(short_range, 1), (long_range, 1)], timestep=5 * fs)
+split.run(50)
+
+
+def test_respa_same_as_velocity_verlet():
+    assert torch.allclose(split.coordinates, dyn.coordinates)
+    assert torch.allclose(split.velocities, dyn.velocities)
+
+
+###############################################################################
+# Saving trajectories
+# -------------------
+#
+# Instead of appending to lists in observers, long runs should save frames with
+# :class:`nnp.md.TrajectoryWriter`, which saves them from a background thread.
+# Let's save every 5 steps of a Langevin run in single precision, in chunks of
+# 4 frames:
+trajectory_directory = tempfile.TemporaryDirectory()
+directory = trajectory_directory.name
+generator = torch.Generator().manual_seed(0)
+langevin = md.Langevin(atoms, lennard_jones, timestep=5 * fs, temperature_K=300,
+                       friction=0.01, generator=generator)
+saved_coordinates: List[torch.Tensor] = []
+langevin.attach(lambda: saved_coordinates.append(langevin.coordinates.clone()), interval=5)
+with md.TrajectoryWriter(langevin, directory, stride=5, chunk_size=4, dtype=torch.float32):
+    langevin.run(50)
+print(os.listdir(directory))
+
+###############################################################################
+# Frames are read back with :class:`nnp.md.TrajectoryReader`:
+reader = md.TrajectoryReader(directory)
+print(len(reader), reader[3]['coordinates'].shape, reader.read('energy').shape)
+
+
+def test_trajectory():
+    assert len(reader) == 11
+    assert reader.read('step').tolist() == list(range(0, 51, 5))
+    assert reader[7]['coordinates'].dtype == np.float32
+    for i in range(len(reader)):
+        assert np.allclose(reader[i]['coordinates'], saved_coordinates[i].numpy(), atol=1e-4)
+
+
+###############################################################################
+# The writer also saves the state of the integrator with each chunk. Let's
+# pretend that the run above crashed, and restart it from the checkpoint,
+# continuing the same trajectory for another 50 steps:
+restarted = md.Langevin(atoms, lennard_jones, timestep=5 * fs, temperature_K=300,
+                        friction=0.01, generator=torch.Generator())
+restarted.load_state_dict(torch.load(os.path.join(directory, 'checkpoint.pt')))
+with md.TrajectoryWriter(restarted, directory, stride=5, chunk_size=4, dtype=torch.float32, append=True):
+    restarted.run(50)
+langevin.run(50)
+
+
+def test_restart():
+    assert torch.equal(restarted.coordinates, langevin.coordinates)
+    assert torch.equal(restarted.velocities, langevin.velocities)
+    steps = md.TrajectoryReader(directory).read('step')
+    assert steps.tolist() == list(range(0, 101, 5))
+
+
+###############################################################################
+# The state is only copied when a chunk is full, and when the writer is closed,
+# even if the run stops between two frames. Since frames are saved at multiples
+# of the stride, restarting from the state at closing continues the trajectory:
+def test_restart_after_close(tmp_path):
+    dynamics = md.VelocityVerlet(atoms, lennard_jones, timestep=5 * fs)
+    snapshots: List[int] = []
+    state_dict = dynamics.state_dict
+    dynamics.state_dict = lambda: snapshots.append(dynamics.nsteps) or state_dict()
+    with md.TrajectoryWriter(dynamics, str(tmp_path), stride=5, chunk_size=4):
+        dynamics.run(23)
+    assert snapshots == [15, 23]
+
+    restarted = md.VelocityVerlet(atoms, lennard_jones, timestep=5 * fs)
+    restarted.load_state_dict(torch.load(str(tmp_path / 'checkpoint.pt')))
+    with md.TrajectoryWriter(restarted, str(tmp_path), stride=5, chunk_size=4, append=True):
+        restarted.run(27)
+    dynamics.run(27)
+    assert torch.equal(restarted.coordinates, dynamics.coordinates)
+    assert md.TrajectoryReader(str(tmp_path)).read('step').tolist() == list(range(0, 51, 5))
+
+
+###############################################################################
+# If saving fails in the background thread, closing the writer still stops the
+# thread, and tells how many frames were lost:
+def test_failed_save(tmp_path):
+    dynamics = md.VelocityVerlet(atoms, lennard_jones, timestep=5 * fs)
+    writer = md.TrajectoryWriter(dynamics, str(tmp_path / 'trajectory'), chunk_size=2)
+    shutil.rmtree(str(tmp_path / 'trajectory'))
+    dynamics.run(2)
+    while writer._error is None:
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError, match='the last 1 frames were not saved'):
+        writer.close()
+    assert not writer._thread.is_alive()
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
@@ -0,0 +1,84 @@
+"""
+Long Range Electrostatics
+=========================
+
+This tutorial demonstrates how to compute the electrostatic energy of periodic
+systems using particle mesh Ewald in ``nnp.pbc``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import itertools
+import math
+import torch
+import pytest
+from pytest import approx
+import sys
+import nnp.pbc as pbc
+
+all_pbc = torch.tensor([True, True, True])
+
+###############################################################################
+# Let's start with the rock salt crystal. The conventional cell contains four
+# cations and four anions. With the nearest neighbor distance being 1 and
+# :math:`\frac{1}{4\pi\epsilon_0}=1`, the energy of each ion pair is the
+# negative of the Madelung constant.
+cell = torch.eye(3, dtype=torch.double) * 2
+coordinates = torch.tensor([
+    [0.0, 0.0, 0.0], [0.0, 0.5, 0.5], [0.5, 0.0, 0.5], [0.5, 0.5, 0.0],
+    [0.5, 0.0, 0.0], [0.0, 0.5, 0.0], [0.0, 0.0, 0.5], [0.5, 0.5, 0.5],
+], dtype=torch.double) @ cell
+charges = torch.tensor([1.0, 1.0, 1.0, 1.0, -1.0, -1.0, -1.0, -1.0], dtype=torch.double)
+energy = pbc.pme_energy(charges, coordinates, cell, all_pbc, cutoff=0.9, accuracy=1e-5, coulomb_constant=1.0)
+print(energy / 4)
+
+
+def test_madelung_constant():
+    assert energy.item() / 4 == approx(-1.747564594633, rel=1e-5)
+
+
+###############################################################################
+# To check forces and stress, let's compare with the plain Ewald sum, which
+# sums the reciprocal space term directly over wave vectors. The splitting
+# parameter does not change the result, so we just use the same as PME.
+def ewald_energy(charges, coordinates, cell, cutoff, alpha, max_m):
+    pairs = pbc.neighbor_list(cell, coordinates, all_pbc, cutoff)
+    index1, index2 = pairs.atom_index12.long()
+    real = (charges[index1] * charges[index2] * torch.erfc(alpha * pairs.distances) / pairs.distances).sum() / 2
+    m = torch.tensor(list(itertools.product(range(-max_m, max_m + 1), repeat=3)), dtype=torch.double)
+    m = m[(m != 0).any(-1)] @ torch.inverse(cell).t()
+    m_squared = (m * m).sum(-1)
+    phase = 2 * math.pi * coordinates @ m.t()
+    structure_factor = (charges @ torch.cos(phase)) ** 2 + (charges @ torch.sin(phase)) ** 2
+    volume = torch.det(cell)
+    reciprocal = (torch.exp(-(math.pi / alpha) ** 2 * m_squared) / m_squared * structure_factor).sum() / (2 * math.pi * volume)
+    self_energy = -alpha / math.sqrt(math.pi) * (charges * charges).sum()
+    background = -math.pi / (2 * volume * alpha ** 2) * charges.sum() ** 2
+    return real + reciprocal + self_energy + background
+
+
+###############################################################################
+# We use a triclinic cell with random, not neutral, charges:
+torch.manual_seed(0)
+triclinic = torch.tensor([[6.0, 0.0, 0.0], [1.5, 5.5, 0.0], [-1.0, 0.8, 7.0]], dtype=torch.double)
+random_coordinates = torch.rand(20, 3, dtype=torch.double) @ triclinic
+random_charges = torch.randn(20, dtype=torch.double)
+
+
+def energy_and_gradients(func, *args):
+    c = triclinic.clone().requires_grad_()
+    x = random_coordinates.clone().requires_grad_()
+    q = random_charges.clone().requires_grad_()
+    energy = func(q, x, c, *args)
+    return (energy,) + torch.autograd.grad(energy, [x, c, q])
+
+
+def test_same_as_ewald():
+    alpha, _ = pbc.pme_parameters(triclinic, 4.0, 1e-6)
+    pme = energy_and_gradients(pbc.pme_energy, all_pbc, 4.0, 1e-6, 4, None, 1.0)
+    ewald = energy_and_gradients(ewald_energy, 4.0, alpha, 12)
+    for a, b in zip(pme, ewald):
+        assert torch.allclose(a, b, atol=1e-4)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
@@ -0,0 +1,148 @@
+"""
+Finding Reaction Paths with Batched Nudged Elastic Bands
+========================================================
+
+This tutorial demonstrates how to find minimum energy paths with the nudged
+elastic bands of ``nnp.optimize``, which evaluate all images of the bands
+together.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import math
+import numpy as np
+import torch
+import pytest
+from pytest import approx
+import sys
+from ase import Atom
+from ase.cluster import Icosahedron
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.mep import NEB
+import ase.optimize
+import nnp.pbc as pbc
+import nnp.md as md
+import nnp.optimize as optimize
+
+
+###############################################################################
+# The potential is called for a padded batch of images, with the same
+# convention as the batched optimizers. Let's use a Lennard-Jones potential for
+# argon, smoothly truncated at the cutoff:
+cutoff = 8.0
+
+
+def pair_energies(distances):
+    x6 = (3.4 / distances) ** 6
+    return 4 * 0.0104 * (x6 * x6 - x6) * (torch.cos(distances * (math.pi / cutoff)) + 1) / 2
+
+
+def lennard_jones(_symbols, coordinates, cell, pbc_, mask):
+    energies = []
+    for c, cell_, p, m in zip(coordinates, cell, pbc_, mask):
+        distances = pbc.neighbor_list(cell_, c[m], p, cutoff, half=True).distances
+        energies.append(pair_energies(distances).sum())
+    return torch.stack(energies)
+
+
+def single(symbols, coordinates, cell, pbc_):
+    mask = torch.ones(1, len(symbols), dtype=torch.bool)
+    return lennard_jones([symbols], coordinates.unsqueeze(0), cell.unsqueeze(0), pbc_.unsqueeze(0), mask)[0]
+
+
+def relax(atoms):
+    atoms.calc = md.Calculator(single)
+    ase.optimize.BFGS(atoms, logfile=None).run(fmax=1e-4)
+    return atoms
+
+
+###############################################################################
+# Our first reaction is an adatom hopping between two neighboring faces of an
+# icosahedral cluster of 13 atoms:
+cluster = Icosahedron('Ar', 2, latticeconstant=5.3)
+center = cluster.get_positions()
+
+
+def adatom(face):
+    atoms = cluster.copy()
+    site = center[face].mean(0)
+    atoms.append(Atom('Ar', site * (1 + 3 / np.linalg.norm(site))))
+    return relax(atoms)
+
+
+hop = (adatom([1, 2, 6]), adatom([1, 2, 8]))
+
+###############################################################################
+# The second one is a vacancy hopping to a neighboring site in periodic solid
+# argon, which has a different number of atoms:
+solid = FaceCenteredCubic('Ar', size=(2, 2, 2), latticeconstant=5.26)
+initial = solid.copy()
+del initial[0]
+final = initial.copy()
+final.positions[0] = solid.positions[0]
+vacancy = (relax(initial), relax(final))
+
+
+###############################################################################
+# The interior images of bands are linearly interpolated between the end points:
+def band(end_points, num_images=7):
+    initial, final = end_points
+    images = [initial.copy() for _ in range(num_images - 1)] + [final.copy()]
+    NEB(images, method='improvedtangent').interpolate()
+    return images
+
+
+def ase_neb(end_points, optimizer, climb=False, num_images=7, **kwargs):
+    images = band(end_points, num_images)
+    for image in images:
+        image.calc = md.Calculator(single)
+    optimizer(NEB(images, method='improvedtangent', climb=climb), logfile=None, **kwargs).run(fmax=0.01, steps=500)
+    return images
+
+
+###############################################################################
+# Both bands could be relaxed together, with a climbing image to find the saddle
+# points. Each step calls the potential once for the 10 interior images:
+bands = [band(hop), band(vacancy)]
+neb = optimize.FIRENEB(bands, lennard_jones, climb=True)
+converged = neb.run(fmax=0.01, steps=500)
+barriers = [max(image.get_potential_energy() for image in b[1:-1]) - end_points[0].get_potential_energy()
+            for b, end_points in zip(bands, [hop, vacancy])]
+print('barriers:', barriers)
+
+
+###############################################################################
+# The results are the same as :class:`ase.mep.NEB` with the same optimizer, for
+# each band on its own:
+def test_same_as_ase():
+    assert converged.all()
+    for end_points, b in zip([hop, vacancy], bands):
+        reference = ase_neb(end_points, ase.optimize.FIRE, climb=True)
+        for image, expected in zip(b, reference):
+            assert abs(image.get_positions() - expected.get_positions()).max() < 1e-8
+        for image, expected in zip(b[1:-1], reference[1:-1]):
+            assert image.get_potential_energy() == approx(expected.get_potential_energy())
+            assert abs(image.get_forces() - expected.get_forces()).max() < 1e-8
+
+
+###############################################################################
+# Bands could also be relaxed by L-BFGS:
+def test_lbfgs():
+    images = band(hop)
+    assert optimize.LBFGSNEB(images, lennard_jones, memory=100).run(fmax=0.01, steps=500).all()
+    reference = ase_neb(hop, ase.optimize.LBFGS)
+    for image, expected in zip(images, reference):
+        assert abs(image.get_positions() - expected.get_positions()).max() < 1e-6
+
+
+###############################################################################
+# The shortest bands have a single interior image:
+def test_one_interior_image():
+    bands = [band(hop, 3), band(vacancy, 3)]
+    assert optimize.FIRENEB(bands, lennard_jones).run(fmax=0.01, steps=500).all()
+    for end_points, b in zip([hop, vacancy], bands):
+        reference = ase_neb(end_points, ase.optimize.FIRE, num_images=3)
+        assert abs(b[1].get_positions() - reference[1].get_positions()).max() < 1e-8
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
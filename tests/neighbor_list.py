@@ -0,0 +1,190 @@
+"""
+Neighbor Lists
+==============
+
+This tutorial demonstrates how to find pairs of atoms within a cutoff under
+periodic boundary conditions using ``nnp.pbc``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import itertools
+import torch
+import pytest
+import sys
+import nnp.pbc as pbc
+
+
+###############################################################################
+# Let's create a triclinic cell with periodic boundary condition enabled only
+# along the first and the third cell vectors, and put some atoms randomly around
+# the cell. The coordinates do not need to be inside the cell.
+torch.manual_seed(0)
+cell = torch.tensor([
+    [5.0, 0.0, 0.0],
+    [1.2, 4.5, 0.0],
+    [0.7, -0.9, 6.0],
+], dtype=torch.double)
+pbc_ = torch.tensor([True, False, True])
+coordinates = torch.rand(40, 3, dtype=torch.double) * 8 - 2
+cutoff = 5.2
+
+###############################################################################
+# Now let's find all the pairs. The displacement vector of each pair is
+# ``coordinates[j] - coordinates[i] + shifts @ cell``
+atom_index12, shifts = pbc.neighbor_pairs(cell, coordinates, pbc_, cutoff)
+print(atom_index12.shape, shifts.shape)
+
+
+###############################################################################
+# To check the result, let's find the pairs in a brute force way: map atoms
+# into the central cell, tile the cell enough times given by ``num_repeats``,
+# and compute all the distances.
+def brute_force_pairs(cell, coordinates, pbc_, cutoff):
+    wrapped = pbc.map2central(cell, coordinates, pbc_)
+    images = torch.round((coordinates - wrapped) @ torch.inverse(cell)).long()
+    repeats = pbc.num_repeats(cell, pbc_, cutoff).tolist()
+    result = set()
+    for shift in itertools.product(*[range(-r, r + 1) for r in repeats]):
+        shift = torch.tensor(shift)
+        vectors = wrapped.unsqueeze(0) - wrapped.unsqueeze(1) + shift.double() @ cell
+        for i, j in (vectors.norm(dim=-1) <= cutoff).nonzero().tolist():
+            if i == j and (shift == 0).all():
+                continue
+            s = shift + images[i] - images[j]
+            result.add((i, j) + tuple(s.tolist()))
+    return result
+
+
+def test_same_as_brute_force():
+    pairs = set((i, j) + tuple(s) for (i, j), s in zip(atom_index12.t().tolist(), shifts.tolist()))
+    assert len(pairs) == atom_index12.shape[1]
+    assert pairs == brute_force_pairs(cell, coordinates, pbc_, cutoff)
+
+
+###############################################################################
+# The cutoff could also be larger than the cell, in which case an atom could be
+# a neighbor of its own images:
+def test_cutoff_larger_than_cell():
+    small_cell = cell * 0.5
+    all_pbc = torch.tensor([True, True, True])
+    atom_index12, shifts = pbc.neighbor_pairs(small_cell, coordinates[:5], all_pbc, cutoff)
+    pairs = set((i, j) + tuple(s) for (i, j), s in zip(atom_index12.t().tolist(), shifts.tolist()))
+    assert pairs == brute_force_pairs(small_cell, coordinates[:5], all_pbc, cutoff)
+
+
+###############################################################################
+# Cell vectors along directions without PBC are not used, so they could be
+# zero, like the cell of a molecule in ASE:
+def test_zero_cell():
+    no_pbc = torch.tensor([False, False, False])
+    atom_index12, shifts = pbc.neighbor_pairs(torch.zeros(3, 3, dtype=torch.double), coordinates, no_pbc, cutoff)
+    pairs = set((i, j) + tuple(s) for (i, j), s in zip(atom_index12.t().tolist(), shifts.tolist()))
+    distances = (coordinates.unsqueeze(0) - coordinates.unsqueeze(1)).norm(dim=-1)
+    expected = set((i, j, 0, 0, 0) for i, j in (distances <= cutoff).nonzero().tolist() if i != j)
+    assert pairs == expected
+
+    flat_cell = cell.clone()
+    flat_cell[1] = 0
+    atom_index12, shifts = pbc.neighbor_pairs(flat_cell, coordinates, pbc_, cutoff)
+    pairs = set((i, j) + tuple(s) for (i, j), s in zip(atom_index12.t().tolist(), shifts.tolist()))
+    assert pairs == brute_force_pairs(cell, coordinates, pbc_, cutoff)
+
+
+###############################################################################
+# Since only integer indices and shifts are returned, the displacement vectors
+# computed from them are differentiable with respect to both coordinates and
+# cell. Let's define a simple pair potential and compare its gradients with
+# the brute force result:
+def pair_energy(cell, coordinates, atom_index12, shifts):
+    distances = pbc.displacements(cell, coordinates, atom_index12, shifts).norm(dim=-1)
+    return (torch.cos(distances * (3.1416 / cutoff)) + 1).sum() / 2
+
+
+def test_gradients():
+    c = cell.clone().requires_grad_()
+    x = coordinates.clone().requires_grad_()
+    energy = pair_energy(c, x, atom_index12, shifts)
+    grad_x, grad_c = torch.autograd.grad(energy, [x, c])
+
+    brute = torch.tensor(sorted(brute_force_pairs(cell, coordinates, pbc_, cutoff)))
+    energy_ = pair_energy(c, x, brute[:, :2].t(), brute[:, 2:])
+    grad_x_, grad_c_ = torch.autograd.grad(energy_, [x, c])
+    assert torch.allclose(energy, energy_)
+    assert torch.allclose(grad_x, grad_x_)
+    assert torch.allclose(grad_c, grad_c_)
+
+
+###############################################################################
+# Pair lists could also be stored in a compact :class:`nnp.pbc.PairList`.
+# Indices are stored as int32 and shifts as int8. Distances are computed on
+# first access and cached, and pairs within a smaller cutoff could be selected
+# without recomputing them:
+x = coordinates.clone().requires_grad_()
+pairs = pbc.neighbor_list(cell, x, pbc_, cutoff)
+short_pairs = pairs.filter(3.0)
+print(pairs.atom_index12.dtype, pairs.shifts.dtype, len(pairs), len(short_pairs))
+
+
+def test_pair_list():
+    assert pairs.atom_index12.dtype == torch.int32
+    assert pairs.shifts.dtype == torch.int8
+    assert torch.equal(pairs.atom_index12.long(), atom_index12)
+    assert torch.equal(pairs.shifts.long(), shifts)
+    assert (short_pairs.distances <= 3.0).all()
+    assert len(short_pairs) == (pairs.distances <= 3.0).sum().item()
+    assert torch.equal(pairs[:10].distances, pairs.distances[:10])
+
+
+###############################################################################
+# Per-pair terms could be reduced to per-atom terms with ``to_atoms``, and
+# per-atom terms could be further reduced to per-molecule terms with
+# ``segment_sum``. Let's check them against dense tensors:
+def test_reductions():
+    pair_terms = torch.exp(-pairs.distances)
+    atom_terms = pairs.to_atoms(pair_terms)
+    dense = torch.zeros(x.shape[0], x.shape[0], dtype=torch.double)
+    dense.index_put_((atom_index12[0], atom_index12[1]), pair_terms.detach(), accumulate=True)
+    assert torch.allclose(atom_terms, dense.sum(1))
+
+    molecule_index = torch.arange(x.shape[0]) // 4
+    molecule_terms = pbc.segment_sum(atom_terms, molecule_index, 10)
+    assert torch.allclose(molecule_terms, dense.sum(1).view(10, 4).sum(1))
+
+    grad = torch.autograd.grad(molecule_terms.sum(), x, retain_graph=True)[0]
+    grad_ = torch.autograd.grad(pair_terms.sum(), x)[0]
+    assert torch.allclose(grad, grad_)
+
+
+###############################################################################
+# For terms symmetric with respect to the two atoms of a pair, we could use a
+# half list instead, where each pair is stored only once. Reducing a half list
+# to atoms adds the term of each pair to both atoms, flipping the sign for
+# antisymmetric terms like pair vectors, so the result is the same as reducing
+# the full list:
+half_pairs = pbc.neighbor_list(cell, x, pbc_, cutoff, half=True)
+print(len(half_pairs), len(pairs))
+
+
+def test_half_list():
+    full = set((i, j) + tuple(s) for (i, j), s in zip(atom_index12.t().tolist(), shifts.tolist()))
+    half = set((i, j) + tuple(s) for (i, j), s in zip(half_pairs.atom_index12.t().tolist(), half_pairs.shifts.tolist()))
+    reverse = set((j, i) + tuple(-t for t in s) for i, j, *s in half)
+    assert len(half) == len(half_pairs) == len(pairs) // 2
+    assert half.isdisjoint(reverse)
+    assert half | reverse == full
+
+
+def test_half_list_reductions():
+    full = pbc.neighbor_list(cell, x, pbc_, cutoff)
+    half = pbc.neighbor_list(cell, x, pbc_, cutoff, half=True)
+    terms = torch.exp(-full.distances)
+    half_terms = torch.exp(-half.distances)
+    assert torch.allclose(full.to_atoms(terms), half.to_atoms(half_terms))
+    assert torch.allclose(full.to_atoms(full.vectors), half.to_atoms(half.vectors, antisymmetric=True))
+    grad = torch.autograd.grad(terms.sum() / 2, x)[0]
+    grad_half = torch.autograd.grad(half_terms.sum(), x)[0]
+    assert torch.allclose(grad, grad_half)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
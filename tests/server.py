@@ -0,0 +1,195 @@
+"""
+Serving Many Calculators with Dynamic Batching
+==============================================
+
+This tutorial demonstrates how to evaluate structures of many concurrent ASE
+calculations together with ``nnp.md.Server``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import os
+import tempfile
+import threading
+import time
+import multiprocessing
+import torch
+import pytest
+from pytest import approx
+import sys
+from ase.cluster import Icosahedron
+from ase.optimize import BFGS
+import nnp.md as md
+
+
+###############################################################################
+# The server calls the potential for a batch of structures padded to the same
+# number of atoms, with a mask that is ``False`` for padding atoms. Let's write
+# a Lennard-Jones potential for clusters that only counts pairs of real atoms:
+def lennard_jones(_symbols, coordinates, _cell, _pbc, mask):
+    vectors = coordinates.unsqueeze(-2) - coordinates.unsqueeze(-3)
+    pairs = (mask.unsqueeze(-1) & mask.unsqueeze(-2)).triu(1)
+    distances = torch.where(pairs, vectors.norm(2, -1), torch.ones_like(vectors[..., 0]))
+    x6 = (3.4 / distances) ** 6
+    return (4 * 0.0104 * (x6 * x6 - x6) * pairs).sum((-1, -2))
+
+
+###############################################################################
+# The same potential for a single structure, to compare with :class:`nnp.md.Calculator`:
+def single(symbols, coordinates, cell, pbc_):
+    mask = torch.ones(len(symbols), dtype=torch.bool)
+    return lennard_jones([symbols], coordinates.unsqueeze(0), cell, pbc_, mask.unsqueeze(0))[0]
+
+
+###############################################################################
+# Let's start a server in a background thread. It waits up to 20 milliseconds
+# to collect up to 8 structures in a batch:
+server = md.Server(lennard_jones, max_batch_size=8, max_wait=0.02)
+server.start()
+
+
+###############################################################################
+# Clients created by :meth:`nnp.md.Server.client` are connected to the server
+# by multiprocessing queues. Let's optimize 8 clusters of two different sizes
+# in parallel threads, each with its own client:
+def optimize(atoms):
+    BFGS(atoms, logfile=None).run(fmax=0.05, steps=20)
+
+
+clusters = [Icosahedron('Ar', 2 + i % 2, latticeconstant=5.26) for i in range(8)]
+for i, cluster in enumerate(clusters):
+    cluster.rattle(0.1, seed=i)
+    cluster.calc = server.client()
+threads = [threading.Thread(target=optimize, args=(c,)) for c in clusters]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+print('batch sizes:', server.batch_sizes)
+
+
+def test_batching():
+    assert max(server.batch_sizes) > 1
+    for cluster in clusters:
+        reference = cluster.copy()
+        reference.calc = md.Calculator(single)
+        assert cluster.get_potential_energy() == approx(reference.get_potential_energy())
+        assert abs(cluster.get_forces() - reference.get_forces()).max() < 1e-10
+
+
+###############################################################################
+# Clients could also run in worker processes. Clients created before the
+# workers start could be passed to them as arguments:
+def worker(calculator, results):
+    atoms = Icosahedron('Ar', 2, latticeconstant=5.3)
+    atoms.calc = calculator
+    results.put(atoms.get_potential_energy())
+
+
+context = multiprocessing.get_context('fork')
+server_in_process = md.Server(lennard_jones, max_batch_size=8, max_wait=0.02, context=context)
+worker_results = context.Queue()
+workers = [context.Process(target=worker, args=(server_in_process.client(), worker_results))
+           for _ in range(4)]
+for w in workers:
+    w.start()
+server_in_process.start()
+energies = [worker_results.get() for _ in workers]
+for w in workers:
+    w.join()
+server_in_process.stop()
+
+
+def test_worker_processes():
+    atoms = Icosahedron('Ar', 2, latticeconstant=5.3)
+    atoms.calc = md.Calculator(single)
+    assert energies == approx([atoms.get_potential_energy()] * 4)
+
+
+###############################################################################
+# Any process could connect to a server listening on a Unix socket:
+socket_directory = tempfile.TemporaryDirectory()
+address = os.path.join(socket_directory.name, 'nnp.sock')
+server.listen(address)
+atoms = Icosahedron('Ar', 3, latticeconstant=5.26)
+atoms.set_cell([30, 30, 30])
+atoms.center()
+atoms.calc = md.ServerCalculator.connect(address)
+stress = atoms.get_stress()
+server.stop()
+
+
+def test_socket():
+    reference = atoms.copy()
+    reference.calc = md.Calculator(single)
+    assert atoms.get_potential_energy() == approx(reference.get_potential_energy())
+    assert abs(stress - reference.get_stress()).max() < 1e-10
+
+
+###############################################################################
+# Clients could come and go in any order. Each client, from queues or sockets,
+# gets its own key on the server, so a client connected after another one has
+# disconnected never takes the replies of a client that is still connected:
+def test_clients_after_disconnect(tmp_path):
+    server = md.Server(lennard_jones, max_batch_size=8, max_wait=0.02)
+    server.start()
+    address = str(tmp_path / 'nnp.sock')
+    server.listen(address)
+    first = server.client()
+    socket_client = md.ServerCalculator.connect(address)
+    while len(server._replies) < 2:
+        time.sleep(0.01)
+    second = server.client()
+    socket_client.connection.close()
+    while len(server._replies) > 2:
+        time.sleep(0.01)
+    third = server.client()
+
+    energies = {}
+
+    def compute(name, calculator):
+        atoms = Icosahedron('Ar', 2, latticeconstant=5.3)
+        atoms.calc = calculator
+        energies[name] = atoms.get_potential_energy()
+
+    threads = [threading.Thread(target=compute, args=item, daemon=True)
+               for item in [('first', first), ('second', second), ('third', third)]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+    server.stop()
+    atoms = Icosahedron('Ar', 2, latticeconstant=5.3)
+    atoms.calc = md.Calculator(single)
+    assert energies == approx({name: atoms.get_potential_energy() for name in ['first', 'second', 'third']})
+
+
+###############################################################################
+# A client could also disconnect after sending a request, before the server
+# notices it. The reply to such a client is dropped, and the server keeps
+# serving the others. Let's queue a request of a client whose connection is
+# already closed:
+def test_client_gone_before_reply():
+    server = md.Server(lennard_jones, max_batch_size=8, max_wait=0.02)
+    atoms = Icosahedron('Ar', 2, latticeconstant=5.3)
+    connection, closed = multiprocessing.Pipe()
+    closed.close()
+    server._replies['gone'] = connection.send
+    server._requests.put(('gone', {'symbols': atoms.get_chemical_symbols(), 'positions': atoms.get_positions(),
+                                   'cell': atoms.get_cell(complete=True).array, 'pbc': atoms.get_pbc(),
+                                   'properties': ['energy']}))
+    server.start()
+
+    energies = []
+    atoms.calc = server.client()
+    thread = threading.Thread(target=lambda: energies.append(atoms.get_potential_energy()), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    server.stop()
+    reference = atoms.copy()
+    reference.calc = md.Calculator(single)
+    assert energies == approx([reference.get_potential_energy()])
+    assert 'gone' not in server._replies
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
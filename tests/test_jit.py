@@ -4,6 +4,7 @@ import sys
 # import nnp.so3 as so3
 import nnp.pbc as pbc
 import nnp.vib as vib
+import nnp.md as md
 
 TORCH_TOO_OLD = torch.__version__ < "1.4.0.dev20191123"
 
@@ -13,6 +14,12 @@ def test_script():
     # torch.jit.script(so3.rotate_along)
     torch.jit.script(pbc.num_repeats)
     torch.jit.script(pbc.map2central)
+    torch.jit.script(pbc.neighbor_pairs)
+    torch.jit.script(pbc.displacements)
+    torch.jit.script(pbc.batched_num_repeats)
+    torch.jit.script(pbc.batched_map2central)
+    torch.jit.script(pbc.segment_sum)
+    torch.jit.script(md.derivatives)
     torch.jit.script(vib.hessian)
     torch.jit.script(vib.vibrational_analysis)
 
@@ -0,0 +1,96 @@
+"""
+Exporting Potentials with TorchScript
+=====================================
+
+This tutorial demonstrates how to compile the whole calculation of energy,
+forces and stress with ``torch.jit``, and save it to a single file, using
+``nnp.md.ForceField``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import math
+import os
+import tempfile
+import time
+import torch
+import pytest
+from pytest import approx
+import sys
+from ase.lattice.cubic import FaceCenteredCubic
+import nnp.pbc as pbc
+import nnp.md as md
+
+
+###############################################################################
+# The potential must be a scriptable :class:`torch.nn.Module`. Instead of
+# chemical symbols, it gets a tensor of species, here atomic numbers. Let's
+# write a Morse potential whose depth depends on the species, smoothly truncated
+# at the cutoff:
+class Morse(torch.nn.Module):
+
+    def __init__(self, cutoff: float):
+        super().__init__()
+        self.cutoff = cutoff
+        self.depth = torch.nn.Parameter(torch.full((119,), 0.3429, dtype=torch.double))
+
+    def forward(self, species, coordinates, cell, pbc_):
+        atom_index12, shifts = pbc.neighbor_pairs(cell, coordinates, pbc_, self.cutoff, half=True)
+        distances = pbc.displacements(cell, coordinates, atom_index12, shifts).norm(2, -1)
+        depth = (self.depth[species[atom_index12[0]]] * self.depth[species[atom_index12[1]]]).sqrt()
+        x = torch.exp(-1.359 * (distances - 2.866))
+        return (depth * (x * x - 2 * x) * (torch.cos(distances * (math.pi / self.cutoff)) + 1) / 2).sum()
+
+
+###############################################################################
+# :class:`nnp.md.ForceField` wraps the potential with the wrapping of atoms into
+# the central box and the computation of forces and stress. It could be
+# compiled, frozen and saved as a whole:
+force_field = md.ForceField(Morse(6.0), stress=True).eval()
+scripted = torch.jit.freeze(torch.jit.script(force_field))
+path = os.path.join(tempfile.mkdtemp(), 'morse.pt')
+torch.jit.save(scripted, path)
+
+###############################################################################
+# The saved file could be loaded without the Python code of the potential, for
+# example from C++. Before running a simulation, call :func:`nnp.md.warmup` to
+# let TorchScript optimize the graph:
+loaded = torch.jit.load(path)
+atoms = FaceCenteredCubic('Cu', size=(2, 2, 2), latticeconstant=3.7)
+atoms.rattle(0.05, seed=0)
+species = torch.tensor(atoms.get_atomic_numbers())
+coordinates = torch.tensor(atoms.get_positions())
+cell = torch.tensor(atoms.get_cell().array)
+pbc_ = torch.tensor(atoms.get_pbc())
+md.warmup(loaded, species, coordinates, cell, pbc_)
+
+start = time.time()
+energy, forces, stress = loaded(species, coordinates, cell, pbc_)
+print('scripted:', time.time() - start)
+start = time.time()
+force_field(species, coordinates, cell, pbc_)
+print('eager:', time.time() - start)
+
+
+###############################################################################
+# The results should be the same as :class:`nnp.md.Calculator` with the same
+# potential:
+def test_same_as_calculator():
+    morse = Morse(6.0)
+    atoms.calc = md.Calculator(lambda symbols, *args: morse(species, *args))
+    assert energy.item() == approx(atoms.get_potential_energy())
+    assert abs(forces.numpy() - atoms.get_forces()).max() < 1e-10
+    assert stress is not None
+    assert abs(stress.numpy() - atoms.get_stress(voigt=False)).max() < 1e-10
+
+
+###############################################################################
+# Atoms outside the central box are wrapped by the module itself:
+def test_wrapping():
+    shifted = coordinates + cell[0] * 2 - cell[2]
+    result = loaded(species, shifted, cell, pbc_)
+    assert result.energy.item() == approx(energy.item())
+    assert torch.allclose(result.forces, forces)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
@@ -0,0 +1,104 @@
+"""
+Molecular Dynamics with Verlet Lists
+====================================
+
+This tutorial demonstrates how to reuse neighbor lists across the steps of a
+molecular dynamics simulation with ``nnp.pbc.VerletList``.
+"""
+###############################################################################
+# Let's first import all the packages we will use:
+import numpy as np
+import pytest
+import sys
+from typing import List
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+from ase.md.verlet import VelocityVerlet
+from ase.units import fs
+import nnp.pbc as pbc
+import nnp.md as md
+
+
+###############################################################################
+# We simulate liquid argon with a Lennard-Jones potential truncated at the
+# cutoff. When a neighbor list is given to the calculator, the potential gets
+# an extra argument ``neighbors``, which is a :class:`nnp.pbc.PairList`. The
+# list contains all the pairs within ``cutoff + skin``, so the potential must
+# apply the cutoff by itself.
+cutoff = 8.0
+epsilon = 0.0104
+sigma = 3.4
+
+
+def lennard_jones(distances):
+    x6 = (sigma / distances) ** 6
+    return 2 * epsilon * (x6 * x6 - x6).sum()
+
+
+def potential_with_neighborlist(_symbols, coordinates, cell, pbc_, neighbors):
+    return lennard_jones(neighbors.filter(cutoff).distances)
+
+
+###############################################################################
+# As a reference, we also define the same potential that searches pairs from
+# scratch in every step:
+def potential_from_scratch(_symbols, coordinates, cell, pbc_):
+    return lennard_jones(pbc.neighbor_list(cell, coordinates, pbc_, cutoff).distances)
+
+
+###############################################################################
+# Now let's run the dynamics with the Verlet list, and check the energy and
+# forces against the reference along the trajectory.
+atoms = FaceCenteredCubic('Ar', size=(3, 3, 3), latticeconstant=5.6)
+MaxwellBoltzmannDistribution(atoms, temperature_K=300, rng=np.random.RandomState(0))
+verlet_list = pbc.VerletList(cutoff, skin=1.0)
+atoms.calc = md.Calculator(potential_with_neighborlist, neighborlist=verlet_list)
+reference = md.Calculator(potential_from_scratch)
+energy_errors: List[float] = []
+force_errors: List[float] = []
+
+
+def compare_with_reference():
+    energy = atoms.get_potential_energy()
+    forces = atoms.get_forces()
+    energy_errors.append(abs(energy - reference.get_potential_energy(atoms)))
+    force_errors.append(abs(forces - reference.get_forces(atoms)).max())
+
+
+dyn = VelocityVerlet(atoms, timestep=2 * fs)
+dyn.attach(compare_with_reference)
+dyn.run(100)
+print('rebuilds:', verlet_list.num_rebuilds, 'calls:', verlet_list.num_calls,
+      'rebuild time:', verlet_list.rebuild_time)
+
+
+def test_same_as_reference():
+    assert max(energy_errors) < 1e-8
+    assert max(force_errors) < 1e-8
+
+
+###############################################################################
+# The list should only be rebuilt occasionally:
+def test_rebuild_count():
+    assert verlet_list.num_rebuilds >= 1
+    assert verlet_list.num_rebuilds < verlet_list.num_calls / 5
+
+
+###############################################################################
+# A pair potential is symmetric with respect to the two atoms of a pair, so we
+# could also use a half list, where each pair is stored only once. Energies and
+# forces should be the same, given that each pair is now only counted once:
+def half_potential(_symbols, coordinates, cell, pbc_, neighbors):
+    return 2 * lennard_jones(neighbors.filter(cutoff).distances)
+
+
+def test_half_list():
+    half_calculator = md.Calculator(half_potential, neighborlist=pbc.VerletList(cutoff, skin=1.0, half=True))
+    energy = half_calculator.get_potential_energy(atoms)
+    forces = half_calculator.get_forces(atoms)
+    assert abs(energy - reference.get_potential_energy(atoms)) < 1e-8
+    assert abs(forces - reference.get_forces(atoms)).max() < 1e-8
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0], '-v'])
@@ -7,11 +7,19 @@ vibrational analysis using ``nnp.vib``.
 """
 ###############################################################################
 # Let's first import all the packages we will use:
+import time
+import concurrent.futures
 import torch
 import math
 import pytest
 from pytest import approx
 import sys
+from typing import List
+from ase.cluster import Icosahedron
+from ase.lattice.cubic import FaceCenteredCubic
+from ase.optimize import BFGS
+import nnp.md as md
+import nnp.pbc as pbc
 import nnp.so3 as so3
 import nnp.vib as vib
 
@@ -40,7 +48,7 @@ rot_neg_45 = so3.rotate_along(torch.tensor([0, 0, -math.pi / 4]))
 
 
 def potential(coordinates):
-    rotated_coordinates = (rot_neg_45 @ coordinates.transpose(-1, -2)).transpose(-1, -2)
+    rotated_coordinates = (rot_neg_45.to(coordinates.dtype) @ coordinates.transpose(-1, -2)).transpose(-1, -2)
     x, y, z = rotated_coordinates.unbind(-1)
     return naive_potential(x, y, z).sum(dim=-1)
 
@@ -252,6 +260,277 @@ def test_vibrational_analysis_batch_broadcast():
     assert torch.allclose(freq_modes2.modes, freq_modes3.modes)
 
 
+###############################################################################
+# Mixed Precision
+# ---------------
+#
+# The potential could be evaluated in single precision while coordinates and
+# the hessian stay in double precision: autograd converts the gradients back
+# to the dtype of the coordinates. The eigen problem is always solved in double
+# precision. Let's displace the atoms a little bit, so that the computation is
+# not trivially exact:
+coordinates_double = torch.tensor([[0.1, -0.2, 0.3], [0.7, 0.2, -0.4]], dtype=torch.double,
+                                  requires_grad=True)
+hessian_double = vib.hessian(coordinates_double, energies=potential(coordinates_double))
+hessian_mixed = vib.hessian(coordinates_double, energies=potential(coordinates_double.float()))
+freq_modes_double = vib.vibrational_analysis(mass.double(), hessian_double)
+freq_modes_mixed = vib.vibrational_analysis(mass.double(), hessian_mixed)
+
+
+def test_mixed_precision():
+    assert hessian_mixed.dtype == torch.double
+    error = freq_modes_mixed.angular_frequencies - freq_modes_double.angular_frequencies
+    assert (error.abs() / freq_modes_double.angular_frequencies).max() < 1e-6
+
+
+###############################################################################
+# Vectorized Hessians
+# -------------------
+#
+# With ``vectorize``, rows of the hessian are computed in chunks of 64 in one
+# backward pass each, instead of one backward pass per row. Let's compare with computing
+# rows one by one for a cluster of 55 atoms interacting by a Lennard-Jones
+# potential, and a batch of 3 copies of it:
+def lennard_jones(coordinates):
+    n = coordinates.shape[-2]
+    index1, index2 = torch.triu_indices(n, n, 1)
+    distances = (coordinates[..., index1, :] - coordinates[..., index2, :]).norm(2, -1)
+    x6 = (3.4 / distances) ** 6
+    return (4 * 0.0104 * (x6 * x6 - x6)).sum(-1)
+
+
+cluster = torch.tensor(Icosahedron('Ar', 3, latticeconstant=5.3).get_positions())
+cluster_batch = cluster.repeat(3, 1, 1).requires_grad_()
+cluster.requires_grad_()
+timings = {}
+vectorized_hessians = {}
+for vectorize, chunk_size in [(False, None), (True, None), (True, 64), (True, 16)]:
+    start = time.time()
+    vectorized_hessians[vectorize, chunk_size] = vib.hessian(
+        cluster, energies=lennard_jones(cluster), vectorize=vectorize, chunk_size=chunk_size)
+    timings[vectorize, chunk_size] = time.time() - start
+print('timings (vectorize, chunk size):', timings)
+
+
+def test_vectorized_hessian():
+    expected = vectorized_hessians[False, None]
+    for h in vectorized_hessians.values():
+        assert torch.allclose(h, expected)
+    batch = vib.hessian(cluster_batch, energies=lennard_jones(cluster_batch), vectorize=True, chunk_size=50)
+    assert torch.allclose(batch, expected.expand(3, -1, -1))
+    scripted = torch.jit.script(vib.hessian)
+    assert torch.allclose(scripted(cluster, lennard_jones(cluster)), expected)
+
+
+###############################################################################
+# Graphs that could not be batched, for example with custom autograd functions
+# that leave PyTorch in their backward, are computed row by row instead:
+class Square(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return x * x
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, = ctx.saved_tensors
+        return SquareGradient.apply(x, grad)
+
+
+class SquareGradient(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, grad):
+        ctx.save_for_backward(x, grad)
+        return 2 * x * grad
+
+    @staticmethod
+    def backward(ctx, grad_grad):
+        x, grad = ctx.saved_tensors
+        doubled = torch.from_numpy(2 * grad_grad.detach().numpy())
+        return grad * doubled, x * doubled
+
+
+def test_vectorize_fallback():
+    x = torch.randn(4, 3, dtype=torch.double, requires_grad=True)
+    h = vib.hessian(x, energies=(Square.apply(x) * torch.arange(1.0, 4.0, dtype=torch.double)).sum(),
+                    vectorize=True)
+    assert torch.allclose(h, torch.diag(torch.arange(1.0, 4.0, dtype=torch.double).repeat(4) * 2))
+
+
+###############################################################################
+# Finite Differences
+# ------------------
+#
+# For potentials that could not be differentiated twice, the hessian could be
+# computed by finite differences of forces. The potential is called with all
+# displaced structures stacked along a new leading dimension, here in chunks of
+# 100 structures:
+calls: List[int] = []
+
+
+def counted_lennard_jones(coordinates):
+    calls.append(coordinates.shape[0])
+    return lennard_jones(coordinates)
+
+
+finite_difference = vib.finite_difference_hessian(counted_lennard_jones, cluster, delta=1e-4, chunk_size=100)
+
+
+def test_finite_difference_hessian():
+    assert calls == [100, 100, 100, 30]
+    expected = vectorized_hessians[False, None]
+    assert torch.allclose(finite_difference, expected, atol=1e-6)
+    batch = vib.finite_difference_hessian(lennard_jones, cluster_batch, delta=1e-4)
+    assert torch.allclose(batch, expected.expand(3, -1, -1), atol=1e-6)
+    forward = vib.finite_difference_hessian(lennard_jones, cluster, delta=1e-5, central=False)
+    assert torch.allclose(forward, expected, atol=1e-4)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        parallel = vib.finite_difference_hessian(lennard_jones, cluster, delta=1e-4, chunk_size=50,
+                                                 executor=executor)
+    assert torch.allclose(parallel, finite_difference)
+
+
+###############################################################################
+# Sparse Hessians
+# ---------------
+#
+# For potentials with a cutoff, :func:`nnp.vib.sparse_hessian` computes the
+# nonzero blocks of the hessian from a number of hessian-vector products that
+# does not grow with the size of the system. Let's compute hessians of periodic
+# solid argon with a pair potential of short range:
+short_cutoff = 5.0
+
+
+def solid_energy(coordinates, cell, pbc_):
+    atom_index12, shifts = pbc.neighbor_pairs(cell, coordinates, pbc_, short_cutoff, half=True)
+    distances = pbc.displacements(cell, coordinates, atom_index12, shifts).norm(2, -1)
+    x6 = (3.4 / distances) ** 6
+    return (4 * 0.0104 * (x6 * x6 - x6) * (1 - (distances / short_cutoff) ** 2) ** 3).sum(), atom_index12
+
+
+def solid(size):
+    atoms = FaceCenteredCubic('Ar', size=(size, size, size), latticeconstant=5.26)
+    atoms.rattle(0.1, seed=0)
+    return (torch.tensor(atoms.get_positions(), requires_grad=True), torch.tensor(atoms.cell.array),
+            torch.tensor(atoms.get_pbc()))
+
+
+def test_sparse_hessian():
+    coordinates, cell, pbc_ = solid(4)
+    energy, atom_index12 = solid_energy(coordinates, cell, pbc_)
+    sparse = vib.sparse_hessian(coordinates, atom_index12, energies=energy)
+    assert sparse.layout == torch.sparse_bsr
+    energy, _ = solid_energy(coordinates, cell, pbc_)
+    assert torch.allclose(sparse.to_dense(), vib.hessian(coordinates, energies=energy))
+
+
+def test_coloring():
+    num_colors = []
+    for size in (3, 6):
+        coordinates, cell, pbc_ = solid(size)
+        _, atom_index12 = solid_energy(coordinates, cell, pbc_)
+        colors = vib.color_atoms(atom_index12, coordinates.shape[0])
+        # atoms paired with the same atom, including itself, have different colors
+        pairs = torch.cat([atom_index12, atom_index12.flip(0)], 1)
+        for atom in range(coordinates.shape[0]):
+            neighbors = torch.cat([pairs[1][pairs[0] == atom], torch.tensor([atom])])
+            assert colors[neighbors].unique().shape == neighbors.unique().shape
+        num_colors.append(int(colors.max()) + 1)
+    assert max(num_colors) < 40
+
+
+###############################################################################
+# Lowest Modes
+# ------------
+#
+# When only a few of the lowest modes are needed, :func:`nnp.vib.lowest_modes`
+# finds them from hessian-vector products, without forming the hessian. Let's
+# relax the cluster of 55 atoms, and compute its 10 lowest modes. The first 6
+# are translations and rotations, with frequencies close to zero:
+relaxed = Icosahedron('Ar', 3, latticeconstant=5.3)
+relaxed.calc = md.Calculator(lambda _symbols, coordinates, _cell, _pbc: lennard_jones(coordinates))
+BFGS(relaxed, logfile=None).run(fmax=1e-6)
+relaxed_coordinates = torch.tensor(relaxed.get_positions(), requires_grad=True)
+relaxed_masses = torch.tensor(relaxed.get_masses())
+lowest = vib.lowest_modes(relaxed_masses, relaxed_coordinates, energies=lennard_jones(relaxed_coordinates), k=10)
+print(lowest.angular_frequencies)
+
+
+def test_lowest_modes():
+    h = vib.hessian(relaxed_coordinates, energies=lennard_jones(relaxed_coordinates))
+    expected = vib.vibrational_analysis(relaxed_masses, h).angular_frequencies
+    assert torch.allclose(lowest.angular_frequencies[6:], expected[6:10])
+    assert lowest.modes.shape == (10, 55, 3)
+    # each mode satisfies the generalized eigen problem
+    mass = relaxed_masses.repeat_interleave(3)
+    for frequency, mode in zip(lowest.angular_frequencies[6:], lowest.modes[6:]):
+        q = mode.flatten()
+        residual = h @ q - frequency ** 2 * mass * q
+        assert residual.norm() < 1e-4 * (h @ q).norm()
+
+
+###############################################################################
+# Molecules of Different Sizes
+# ----------------------------
+#
+# Molecules of different sizes could be padded to the same number of atoms,
+# with a mask that is ``False`` for padding atoms. Let's analyze a relaxed
+# cluster of 13 atoms together with the cluster of 55 atoms above. The
+# potential must ignore padding atoms, also in its second derivatives, so
+# distances of padding atoms are masked before taking square roots:
+def masked_lennard_jones(coordinates, mask):
+    vectors = coordinates.unsqueeze(-2) - coordinates.unsqueeze(-3)
+    pairs = (mask.unsqueeze(-1) & mask.unsqueeze(-2)).triu(1)
+    squared = torch.where(pairs, (vectors ** 2).sum(-1), torch.ones_like(vectors[..., 0]))
+    x6 = (3.4 ** 2 / squared) ** 3
+    return (4 * 0.0104 * (x6 * x6 - x6) * pairs).sum((-1, -2))
+
+
+small = Icosahedron('Ar', 2, latticeconstant=5.3)
+small.calc = md.Calculator(lambda _symbols, coordinates, _cell, _pbc: lennard_jones(coordinates))
+BFGS(small, logfile=None).run(fmax=1e-6)
+molecules = [small, relaxed]
+padded_coordinates = torch.zeros(2, 55, 3, dtype=torch.double)
+padded_masses = torch.zeros(2, 55, dtype=torch.double)
+atom_mask = torch.zeros(2, 55, dtype=torch.bool)
+for i, atoms in enumerate(molecules):
+    padded_coordinates[i, :len(atoms)] = torch.tensor(atoms.get_positions())
+    padded_masses[i, :len(atoms)] = torch.tensor(atoms.get_masses())
+    atom_mask[i, :len(atoms)] = True
+padded_coordinates.requires_grad_()
+padded_hessian = vib.hessian(padded_coordinates, energies=masked_lennard_jones(padded_coordinates, atom_mask),
+                             mask=atom_mask)
+padded = vib.vibrational_analysis(padded_masses, padded_hessian, mask=atom_mask)
+valid = vib.mode_mask(atom_mask)
+
+
+def test_padded_vibrational_analysis():
+    assert valid.sum(-1).tolist() == [39, 165]
+    for i, atoms in enumerate(molecules):
+        n = len(atoms)
+        coordinates = torch.tensor(atoms.get_positions(), requires_grad=True)
+        h = vib.hessian(coordinates, energies=lennard_jones(coordinates))
+        assert torch.allclose(padded_hessian[i, :3 * n, :3 * n], h)
+        expected = vib.vibrational_analysis(torch.tensor(atoms.get_masses()), h)
+        assert torch.allclose(padded.angular_frequencies[i, 6:3 * n], expected.angular_frequencies[6:])
+        assert padded.angular_frequencies[i, 3 * n:].isnan().all()
+        assert (padded.modes[i, :, n:] == 0).all()
+        assert (padded.modes[i, 3 * n:] == 0).all()
+    scripted = torch.jit.script(vib.vibrational_analysis)(padded_masses, padded_hessian, atom_mask)
+    assert torch.allclose(scripted.angular_frequencies, padded.angular_frequencies, equal_nan=True)
+
+
+###############################################################################
+# To keep padding small, :func:`nnp.vib.size_buckets` groups molecules of
+# similar sizes, here with at most 20% of padding atoms and at most 2 molecules
+# in each group:
+def test_size_buckets():
+    sizes = [13, 55, 12, 50, 11, 30, 14]
+    assert vib.size_buckets(sizes, max_batch_size=2) == [[1, 3], [5], [6, 0], [2, 4]]
+
+
 ###############################################################################
 # Now let's run all the tests
 if __name__ == '__main__':